@@ -0,0 +1,61 @@
+# system import
+import weakref
+
+
+class AlignmentCache(object):
+    """Caches netzob's alignment of the messages of a symbol to its fields, which is needed by
+    Field.getValues() and str(symbol) and is quite slow. The alignment is stored per symbol
+    together with its field layout and the identities of its messages, so a cached alignment is
+    never used after fields were changed or messages were replaced, added or removed. Methods
+    changing the data of messages in place have to call invalidate(), the message data is not
+    hashed on every lookup. Entries are dropped as soon as their symbol is garbage collected.
+
+    >>> values = alignments.values(symbol, symbol.fields[0])
+    """
+
+    def __init__(self):
+        self._cache = {} # id(symbol): (layout, message ids, messages, cells)
+        self._finalizers = {} # id(symbol): finalizer dropping the entry with the symbol
+
+    @staticmethod
+    def layout(symbol):
+        """Return the field layout of symbol as tuple of (name, minsize, maxsize)."""
+        return tuple((field.name, *field.domain.dataType.size) for field in symbol.fields)
+
+    def cells(self, symbol):
+        """Return the aligned messages of symbol as list of rows (one per message), each row being
+        a list of the raw field values.
+        """
+
+        layout = self.layout(symbol)
+        messages = tuple(symbol.messages)
+        ids = tuple(map(id, messages))
+        key = id(symbol)
+        cached = self._cache.get(key)
+        if cached is not None and cached[0] == layout and cached[1] == ids:
+            return cached[3]
+
+        cells = [list(row) for row in symbol.getCells(encoded=False, styled=False)]
+        # the entry keeps the messages, so that their ids are not reused while it exists
+        self._cache[key] = (layout, ids, messages, cells)
+        if key not in self._finalizers:
+            self._finalizers[key] = weakref.finalize(symbol, self._forget, key)
+        return cells
+
+    def values(self, symbol, field):
+        """Return all raw values of field in symbol, like field.getValues() without encoding."""
+
+        i_field = symbol.fields.index(field)
+        return [row[i_field] for row in self.cells(symbol)]
+
+    def invalidate(self, symbol):
+        """Drop the alignment of symbol."""
+        self._cache.pop(id(symbol), None)
+
+    def _forget(self, key):
+        self._cache.pop(key, None)
+        self._finalizers.pop(key, None)
+
+
+alignments = AlignmentCache()
+"""Cache shared by all modules."""
@@ -0,0 +1,219 @@
+# system import
+import gzip
+from os import listdir, makedirs, remove, replace
+from os.path import basename, isdir, join
+import pickle
+
+# netzob import
+from netzob.Model.Vocabulary.Field import Field
+from netzob.Model.Vocabulary.Messages.AbstractMessage import AbstractMessage
+from netzob.Model.Vocabulary.Messages.L2NetworkMessage import L2NetworkMessage
+from netzob.Model.Vocabulary.Messages.RawMessage import RawMessage
+from netzob.Model.Vocabulary.Symbol import Symbol
+from netzob.Model.Vocabulary.Types.Raw import Raw
+
+# internal import
+from WithPayloadMessage import WithPayloadMessage, loadLayers
+
+
+CHECKPOINT_VERSION = 1
+"""Version of the checkpoint format, checkpoints of other versions are not loaded."""
+
+
+def encodeMessage(m):
+    """Encode a message as plain tuple. The scapy payload is not stored, only its class, the packet
+    is dissected again from payload_data while decoding.
+    """
+
+    payload_cls = None
+    payload_data = None
+    if isinstance(m, WithPayloadMessage):
+        if m.payload is not None:
+            payload_cls = type(m.payload)
+        payload_data = m.payload_data
+
+    if isinstance(m, L2NetworkMessage):
+        l2 = (m.l2Protocol, m.l2SourceAddress, m.l2DestinationAddress)
+    else:
+        l2 = None
+
+    return (isinstance(m, WithPayloadMessage), m.data, m.date, l2, getattr(m, 'metadata', None),
+            payload_cls, payload_data)
+
+
+def decodeMessage(record):
+    """Restore a message encoded by encodeMessage()."""
+
+    with_payload, data, date, l2, metadata, payload_cls, payload_data = record
+
+    if with_payload:
+        l2Protocol = l2[0] if l2 else None
+        m = WithPayloadMessage(data, date, l2Protocol)
+        if payload_cls is not None:
+            loadLayers()
+            m.payload = payload_cls(payload_data)
+        m.payload_data = payload_data
+    elif l2:
+        m = L2NetworkMessage(data, date, *l2)
+    else:
+        m = RawMessage(data, date)
+
+    if metadata is not None:
+        m.metadata = metadata
+
+    return m
+
+
+def encodeSymbol(sym, encode_msg):
+    """Encode a symbol as plain dict of its field layout and references to its messages. All fields
+    created by l2pre are Raw fields, thus name and size are sufficient to restore them.
+    """
+
+    def refs(messages):
+        if messages is None:
+            return None
+        return [encode_msg(m) for m in messages]
+
+    return {
+        'name': sym.name,
+        'fields': [(f.name,) + tuple(f.domain.dataType.size) for f in sym.fields],
+        'messages': refs(sym.messages),
+        'orig_messages': refs(getattr(sym, 'orig_messages', None)),
+        'dedup_messages': refs(getattr(sym, 'dedup_messages', None)),
+    }
+
+
+def decodeSymbol(enc, decode_msg):
+    """Restore a symbol encoded by encodeSymbol()."""
+
+    fields = []
+    for name, minsize, maxsize in enc['fields']:
+        fields.append(Field(Raw(nbBytes=(int(minsize/8), int(maxsize/8))), name=name))
+
+    sym = Symbol(fields, [decode_msg(i) for i in enc['messages']], name=enc['name'])
+    for attr in ('orig_messages', 'dedup_messages'):
+        if enc[attr] is not None:
+            setattr(sym, attr, [decode_msg(i) for i in enc[attr]])
+
+    return sym
+
+
+def encodeState(state):
+    """Encode the output of a pipeline stage (nested lists of messages and symbols). Messages are
+    stored only once in a pool and referenced by index, as several symbols and lists share them.
+
+    :return: tuple (message pool, encoded state)
+    """
+
+    pool = []
+    index = {}
+
+    def encode_msg(m):
+        key = id(m)
+        if key not in index:
+            index[key] = len(pool)
+            pool.append(encodeMessage(m))
+        return index[key]
+
+    def encode(obj):
+        if isinstance(obj, list):
+            return ('list', [encode(item) for item in obj])
+        if isinstance(obj, Symbol):
+            return ('symbol', encodeSymbol(obj, encode_msg))
+        if isinstance(obj, AbstractMessage):
+            return ('message', encode_msg(obj))
+        raise TypeError("Can not encode object of type {}".format(type(obj)))
+
+    return pool, encode(state)
+
+
+def decodeState(pool, enc):
+    """Restore the output of a pipeline stage encoded by encodeState()."""
+
+    messages = {}
+
+    def decode_msg(i):
+        if i not in messages:
+            messages[i] = decodeMessage(pool[i])
+        return messages[i]
+
+    def decode(item):
+        tag, value = item
+        if tag == 'list':
+            return [decode(x) for x in value]
+        if tag == 'symbol':
+            return decodeSymbol(value, decode_msg)
+        return decode_msg(value)
+
+    return decode(enc)
+
+
+class Checkpoint(object):
+    """Stores the results of pipeline stages in a work directory, so that an analysis can be resumed
+    or partly rerun. Each stage is stored in a separate gzip-compressed file named by its position
+    and name, e.g. '03_cluster.ckpt'.
+    """
+
+    def __init__(self, work_dir, stages, manifest):
+        """
+        :param work_dir: directory to store the checkpoints in, created if not existing
+        :param stages: ordered list of stage names
+        :param manifest: dict describing the input (files, layer, ...), checkpoints of a different
+        input are refused
+        """
+        self.work_dir = work_dir
+        self.stages = stages
+        self.manifest = manifest
+        if not isdir(work_dir):
+            makedirs(work_dir)
+
+    def _path(self, stage):
+        return join(self.work_dir, "{:02d}_{}.ckpt".format(self.stages.index(stage), stage))
+
+    def completed(self):
+        """Return list of stages with an existing checkpoint."""
+        files = set(listdir(self.work_dir))
+        return [s for s in self.stages if basename(self._path(s)) in files]
+
+    def lastCompleted(self):
+        """Return the last stage of the longest run of completed stages, None if there is none."""
+        last = None
+        completed = self.completed()
+        for stage in self.stages:
+            if stage not in completed:
+                break
+            last = stage
+        return last
+
+    def save(self, stage, state):
+        """Store the output of a stage. Checkpoints of all following stages are removed as these
+        are outdated now.
+        """
+
+        pool, enc = encodeState(state)
+
+        # write to temporary file first, a killed process should not leave a broken checkpoint
+        path = self._path(stage)
+        with gzip.open(path + '.tmp', 'wb', compresslevel=3) as ckpt:
+            pickle.dump((CHECKPOINT_VERSION, self.manifest, pool, enc), ckpt,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        replace(path + '.tmp', path)
+
+        for later in self.stages[self.stages.index(stage)+1:]:
+            if later in self.completed():
+                remove(self._path(later))
+
+    def load(self, stage):
+        """Restore the output of a stage."""
+
+        with gzip.open(self._path(stage), 'rb') as ckpt:
+            version, manifest, pool, enc = pickle.load(ckpt)
+
+        if version != CHECKPOINT_VERSION:
+            raise ValueError("Checkpoint {} has version {}, expected {}".format(
+                self._path(stage), version, CHECKPOINT_VERSION))
+        if manifest != self.manifest:
+            raise ValueError("Checkpoint {} was created for a different input ({})".format(
+                self._path(stage), manifest))
+
+        return decodeState(pool, enc)
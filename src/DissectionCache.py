@@ -0,0 +1,250 @@
+# system import
+from contextlib import contextmanager
+from hashlib import blake2b
+import json
+from os import listdir, makedirs, remove, replace
+from os.path import basename, dirname, exists, getmtime, join
+import subprocess
+
+# others
+import numpy as np
+
+# nemere import
+from nemere.validation.messageParser import ParsedMessage
+
+
+CACHE_VERSION = 1
+
+
+def tsharkVersion():
+    """Return the first line of `tshark --version`, None if tshark is not installed."""
+    try:
+        output = subprocess.run(['tshark', '--version'], capture_output=True, text=True,
+                                check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return output.splitlines()[0].strip() if output else None
+
+
+def captureHash(path):
+    """Return a hash of the content of the capture file at path."""
+    h = blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class CachedParsedMessage(object):
+    """Stands in for nemere's ParsedMessage of a message whose dissection was loaded from the
+    DissectionCache. Provides the parts of ParsedMessage used for the FMS: the field sequence of the
+    dissector, the field names and values, the message type and the protocols.
+    """
+
+    def __init__(self, message, fields, messagetype, protocols):
+        """
+        :param message: the RawMessage of the specimens
+        :param fields: list of (field name, length in bytes) as returned by
+        ParsedMessage.getFieldSequence()
+        """
+        self.message = message
+        self._fields = fields
+        self.messagetype = messagetype
+        self.protocols = protocols
+        self.protocolname = protocols[-1] if protocols else None
+
+    def getFieldSequence(self):
+        return list(self._fields)
+
+    def getFieldNames(self):
+        return [name for name, length in self._fields]
+
+    def getFieldValues(self):
+        values = []
+        offset = 0
+        for name, length in self._fields:
+            values.append(self.message.data[offset:offset + length].hex())
+            offset += length
+        return values
+
+    def getValuesByName(self, fieldname):
+        return [value for name, value in zip(self.getFieldNames(), self.getFieldValues())
+                if name == fieldname]
+
+
+class DissectionCache(object):
+    """Persistent cache of tshark's dissections of the messages of a capture, so that the FMS of a
+    capture evaluated before is calculated without running tshark again. Entries are keyed by the
+    hash of the capture, the layer and the version of tshark. The field boundaries are stored in a
+    compact .npz file per entry: a table of the field names and the name index and length of each
+    field, the fields of all messages concatenated in the order of the capture.
+
+    Without tshark installed and if allowed explicitly, the newest entry of the capture and layer
+    recorded with any version of tshark is used, so a recorded entry serves as fixture for
+    evaluations without tshark.
+
+    >>> cache = DissectionCache('cache/dissections')
+    >>> with cache.dissections(pcap, specimens, layer):
+    ...     comparator = MessageComparator(specimens, pcap=pcap)
+    """
+
+    def __init__(self, directory, allow_any_version=False):
+        """
+        :param directory: directory of the entries
+        :param allow_any_version: use entries recorded with any version of tshark if tshark is not
+        installed
+        """
+        self.directory = directory
+        self.allow_any_version = allow_any_version
+        self.hit = None # set by dissections() to show if the last entry was loaded from the cache
+        self._tshark = tsharkVersion()
+
+    def key(self, capture_hash, layer):
+        """Return the file name of the entry of a capture and layer."""
+        h = blake2b(digest_size=8)
+        h.update("{}:{}".format(CACHE_VERSION, self._tshark).encode())
+        return "{}_l{}_{}.npz".format(capture_hash, layer, h.hexdigest())
+
+    def find(self, capture_hash, layer):
+        """Return the path of the entry of a capture and layer, None if there is none."""
+
+        if not exists(self.directory):
+            return None
+        path = join(self.directory, self.key(capture_hash, layer))
+        if exists(path):
+            return path
+        if self._tshark is None:
+            # use the newest entry recorded with any tshark version
+            prefix = "{}_l{}_".format(capture_hash, layer)
+            candidates = [join(self.directory, name) for name in listdir(self.directory)
+                          if name.startswith(prefix) and name.endswith('.npz')]
+            if candidates and not self.allow_any_version:
+                print("Warning: tshark is not installed, dissections of the capture recorded with "
+                      "another version of tshark are ignored, use --allow-any-version to use them.")
+            elif candidates:
+                path = max(candidates, key=getmtime)
+                print("Warning: tshark is not installed, using dissections recorded with {}.".format(
+                    self.recordedWith(path)))
+                return path
+        return None
+
+    @staticmethod
+    def recordedWith(path):
+        """Return the version of tshark the entry at path was recorded with."""
+        with np.load(path) as npz:
+            return json.loads(npz['meta'].tobytes().decode()).get('tshark')
+
+    @staticmethod
+    def save(path, parsed_messages, messages, meta):
+        """Write the dissections of messages (in order of the capture) to path.
+
+        :param parsed_messages: dict mapping id() of messages to their ParsedMessage
+        """
+
+        names = {}
+        types = {}
+        name_indices = []
+        lengths = []
+        offsets = [0]
+        message_types = []
+        protocols = []
+        for m in messages:
+            pm = parsed_messages.get(id(m))
+            if pm is None:
+                # not dissectable
+                message_types.append(-1)
+                protocols.append([])
+                offsets.append(len(lengths))
+                continue
+            for name, length in pm.getFieldSequence():
+                name_indices.append(names.setdefault(name, len(names)))
+                lengths.append(length)
+            offsets.append(len(lengths))
+            message_types.append(types.setdefault(str(pm.messagetype), len(types)))
+            protocols.append(list(getattr(pm, 'protocols', [])))
+
+        meta = dict(meta, version=CACHE_VERSION, names=list(names), types=list(types),
+                    protocols=protocols)
+        # an interrupted write must not leave an entry behind, as it would be found later on
+        makedirs(dirname(path), exist_ok=True)
+        tmp_path = join(dirname(path), '.' + basename(path) + '.tmp')
+        try:
+            with open(tmp_path, 'wb') as f:
+                np.savez_compressed(f,
+                    meta=np.frombuffer(json.dumps(meta).encode(), dtype=np.uint8),
+                    fields=np.array(name_indices, dtype=np.uint16),
+                    lengths=np.array(lengths, dtype=np.uint32),
+                    offsets=np.array(offsets, dtype=np.int64),
+                    types=np.array(message_types, dtype=np.int32))
+        except BaseException:
+            remove(tmp_path)
+            raise
+        replace(tmp_path, path)
+
+    @staticmethod
+    def load(path, messages):
+        """Return a list of CachedParsedMessages of messages (in order of the capture) read from
+        path, None for messages that were not dissectable.
+        """
+
+        with np.load(path) as npz:
+            meta = json.loads(npz['meta'].tobytes().decode())
+            fields = npz['fields'].tolist()
+            lengths = npz['lengths'].tolist()
+            offsets = npz['offsets'].tolist()
+            message_types = npz['types'].tolist()
+
+        if len(offsets) != len(messages) + 1:
+            raise ValueError("dissection cache '{}' contains {} messages instead of {}".format(
+                path, len(offsets) - 1, len(messages)))
+
+        names = meta['names']
+        types = meta['types']
+        parsed = []
+        for i, m in enumerate(messages):
+            if message_types[i] < 0:
+                parsed.append(None)
+                continue
+            sequence = [(names[fields[j]], lengths[j]) for j in range(offsets[i], offsets[i+1])]
+            parsed.append(CachedParsedMessage(m, sequence, types[message_types[i]],
+                                              meta['protocols'][i]))
+        return parsed
+
+    @contextmanager
+    def dissections(self, pcap, specimens, layer):
+        """Within this context, nemere's ParsedMessage.parseMultiple() returns the dissections of
+        the messages of specimens from the cache. If there is no entry for pcap yet, tshark is
+        run as usual and its dissections are stored.
+        """
+
+        capture_hash = captureHash(pcap)
+        messages = list(specimens.messagePool.values())
+        position = {id(m): i for i, m in enumerate(messages)}
+        path = self.find(capture_hash, layer)
+        cached = self.load(path, messages) if path else None
+        self.hit = cached is not None
+
+        # keep the descriptor (static or class method) to restore it afterwards
+        descriptor = ParsedMessage.__dict__['parseMultiple']
+        parseMultiple = ParsedMessage.parseMultiple
+        recorded = {} # id(message): ParsedMessage
+
+        def parseCached(msgs, *args, **kwargs):
+            msgs = list(msgs)
+            if cached is not None and all(id(m) in position for m in msgs):
+                return {m: cached[position[id(m)]] for m in msgs
+                        if cached[position[id(m)]] is not None}
+            parsed = parseMultiple(msgs, *args, **kwargs)
+            recorded.update((id(m), pm) for m, pm in parsed.items())
+            return parsed
+
+        ParsedMessage.parseMultiple = staticmethod(parseCached)
+        try:
+            yield self
+        finally:
+            ParsedMessage.parseMultiple = descriptor
+
+        if cached is None and recorded:
+            path = join(self.directory, self.key(capture_hash, layer))
+            self.save(path, recorded, messages,
+                      {'capture': capture_hash, 'layer': layer, 'tshark': self._tshark})
@@ -1,20 +1,22 @@
 # system import
 from binascii import unhexlify
 import copy
+import math
 from zlib import crc32, adler32
 
-# nemere import
-from nemere.utils.baseAlgorithms import ngrams
+# external import
+import numpy as np
 
 # netzob import
 from netzob.Common.Utils.Decorators import typeCheck
-from netzob.Inference.Vocabulary.EntropyMeasurement import EntropyMeasurement
 from netzob.Inference.Vocabulary.FormatOperations.FieldOperations import FieldOperations
 from netzob.Model.Vocabulary.Field import Field
 from netzob.Model.Vocabulary.Symbol import Symbol
 from netzob.Model.Vocabulary.Types.Raw import Raw
 
 # internal import
+from AlignmentCache import alignments
+from Profiler import profiler
 from WithPayloadMessage import WithPayloadMessage
 from utils import printFields
 
@@ -24,6 +26,19 @@ class FeatureExtraction(object):
     known information. It can detect sequences and checksums as well.
     """
 
+    chunk_size = 1000
+    """Number of messages whose data is processed at once by methods working on all messages."""
+
+    seq_equal_msb = 0.95
+    """Maximum share of unchanged values of the MSB of a two-byte sequence field, see _seqEx()."""
+
+    seq_equal = 0.25
+    """Maximum share of unchanged values of the LSB of a two-byte sequence field and of a one-byte
+    sequence field, see _seqEx()."""
+
+    seq_decrease = 0.1
+    """Maximum share of decreasing values (overflows) of a sequence field, see _seqEx()."""
+
     @typeCheck(list, set)
     def __init__(self, messages_list):
         self.messages_list = messages_list
@@ -163,6 +178,8 @@ class FeatureExtraction(object):
 
             curr_size += maxsize # increase size for next loop level
 
+        alignments.invalidate(symbol) # layout changed
+
         return new_fields[new_field_index] # return inserted field
 
 
@@ -180,6 +197,9 @@ class FeatureExtraction(object):
         :rtype: :class:`netzob.Model.Vocabulary.Symbol`
         """
 
+        # nemere import
+        from nemere.utils.baseAlgorithms import ngrams
+
         def searchForAddr(addr: str):
             addr_pos_cnt = {} # count how often a addr was seen at a position
             for m in messages:
@@ -270,22 +290,28 @@ class FeatureExtraction(object):
                 break
             minsize += maxsize
 
-        # for every possible value in keyField we sort the corresponding messages in these buckets
-        for val in set(self._getValuesQuick(symbol, keyField)):
-            newMessages = []
+        # sort every message in the bucket corresponding to its value in keyField
+        buckets = {}
+        for m in symbol.messages:
+            val = m.data[int(minsize/8):int(maxsize/8)] # maxsize as integer byte value
+            if val in buckets:
+                buckets[val].append(m)
+            else:
+                buckets[val] = [m]
 
-            for m in symbol.messages:
-                if m.data[int(minsize/8):int(maxsize/8)] == val: # maxsize as integer byte value
-                    newMessages.append(m)
+        # the messages themselves are not copied, they are shared between the symbols
+        messages = list(symbol.messages) # netzob clears the list in place, thus copy it
+        symbol.messages = []
 
-            if not newMessages:
-                raise ValueError("No messages matching this field value, something's wrong.")
+        for val, newMessages in buckets.items():
 
             newSymbol = copy.deepcopy(symbol) # TODO implement accurate copy function in netzob
             newSymbol.name = "Symbol_" + val.hex()
             newSymbol.messages = newMessages
             cluster.append(newSymbol)
 
+        symbol.messages = messages
+
         return cluster # list of Symbols based of keyField value
 
     @typeCheck(Symbol, Field)
@@ -327,6 +353,174 @@ class FeatureExtraction(object):
         return values
 
 
+    @typeCheck(Symbol, int)
+    def _sourceIndex(self, symbol, capture=0):
+        """Return an index of the messages of symbol per source. Sources are identified by the
+        address field that is assumed to be the sender (see _seqEx()) and the capture the messages
+        belong to, as counters of different captures are independent even if they interleave in
+        time. The index is stored in symbol.source_index and reused as long as the number of
+        messages does not change, methods changing symbol.messages need to update it.
+
+        :param symbol: symbol with address field(s)
+        :type symbol: :class:`netzob.Model.Vocabulary.Symbol`
+        :param capture: number of the capture the messages belong to
+        :type int:
+        :return: dict of form {(capture, source address): [row indices sorted by date]}
+        """
+
+        cached = getattr(symbol, 'source_index', None)
+        if cached is not None and cached[0] == len(symbol.messages):
+            return cached[1]
+
+        addr_fields = [field for field in symbol.fields if field.name == "Address"]
+        if not addr_fields:
+            printFields(symbol)
+            raise ValueError("No address field(s) found in field")
+
+        # just assume second is source (just a good guess, but doesn't matter much anyway)
+        src_field = addr_fields[1] if len(addr_fields) > 1 else addr_fields[0]
+
+        index = {}
+        for row, addr in enumerate(self._getValuesQuick(symbol, src_field)):
+            if (capture, addr) in index:
+                index[(capture, addr)].append(row)
+            else:
+                index[(capture, addr)] = [row]
+
+        # sort by date, keeping the order of messages with equal dates
+        dates = [m.date for m in symbol.messages]
+        for rows in index.values():
+            rows.sort(key=lambda row: dates[row])
+
+        symbol.source_index = (len(symbol.messages), index)
+        return index
+
+
+    @typeCheck(Symbol, Symbol)
+    def _mergeSourceIndex(self, sym1, sym2):
+        """Update the source index of sym1 before the messages of sym2 are appended to sym1. The
+        index is dropped if any of both symbols has none.
+        """
+
+        index1 = getattr(sym1, 'source_index', None)
+        index2 = getattr(sym2, 'source_index', None)
+        if index1 is None or index2 is None or index1[0] != len(sym1.messages) or \
+                index2[0] != len(sym2.messages):
+            sym1.source_index = None
+            return
+
+        offset = len(sym1.messages)
+        index = {key: list(rows) for key, rows in index1[1].items()}
+        for key, rows in index2[1].items():
+            index.setdefault(key, []).extend(row + offset for row in rows)
+        sym1.source_index = (offset + len(sym2.messages), index)
+
+
+    def _measureEntropy(self, messages):
+        """Return the entropy of the bytes found at each position of the messages, equal to the
+        result of netzob's EntropyMeasurement.measure_entropy(). The byte counts are accumulated
+        over chunks of chunk_size messages, thus only a chunk of message data is held at once.
+
+        :param messages: list of messages (or the TypedList of a symbol)
+        :return: list of entropy values per byte position
+        """
+
+        longest = max(len(m.data) for m in messages)
+
+        # count values per position, 256 denotes a message that is too short for the position
+        counts = np.zeros((longest, 257), dtype=np.int64)
+        pos_offsets = np.arange(longest, dtype=np.int64) * 257
+        for begin in range(0, len(messages), self.chunk_size):
+            chunk = messages[begin:begin+self.chunk_size]
+            values = np.full((len(chunk), longest), 256, dtype=np.int64)
+            for i, m in enumerate(chunk):
+                data = m.data
+                values[i, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+            counts += np.bincount((values + pos_offsets).ravel(),
+                                  minlength=longest*257).reshape(longest, 257)
+
+        entropies = []
+        for pos_counts in counts[:, :256]:
+            total = int(pos_counts.sum())
+            entropy = 0
+            for x in np.nonzero(pos_counts)[0]:
+                p_x = float(pos_counts[x]) / total
+                entropy += -p_x * math.log(p_x, 2)
+            entropies.append(entropy)
+
+        return entropies
+
+
+    def _seqCounters(self, messages, source_index, longest):
+        """Compare the bytes at each position of every message with the ones of the previous
+        message of the same source (see _seqEx()). Messages are processed in chunks of chunk_size
+        messages in the order of source_index, thus only a chunk of message data is held at once.
+        Messages too short for a position are skipped for it, a missing right neighbor counts as 0.
+
+        :param messages: list of messages (or the TypedList of a symbol)
+        :param source_index: dict of row indices sorted by date per source, see _sourceIndex()
+        :param longest: number of byte positions to compare
+        :return: dict of arrays per position: counts of unchanged ('equal') and decreased ('less')
+        values and whether the left or right neighbor behaves like the LSB or MSB of a two byte
+        sequence ('left_LSB', 'left_MSB', 'right_LSB', 'right_MSB')
+        """
+
+        counters = {'equal': np.zeros(longest, dtype=np.int64),
+                    'less': np.zeros(longest, dtype=np.int64)}
+        for flag in ('left_LSB', 'left_MSB', 'right_LSB', 'right_MSB'):
+            counters[flag] = np.ones(longest, dtype=bool)
+
+        order = np.array([row for rows in source_index.values() for row in rows], dtype=np.int64)
+        sources = np.repeat(np.arange(len(source_index)),
+                            [len(rows) for rows in source_index.values()])
+        carry = [None] * longest # last (source, left, value, right) seen per position
+
+        for begin in range(0, len(order), self.chunk_size):
+            chunk = order[begin:begin+self.chunk_size]
+            chunk_sources = sources[begin:begin+self.chunk_size]
+            # 256 denotes a message that is too short for the position
+            values = np.full((len(chunk), longest + 1), 256, dtype=np.int16)
+            for i, row in enumerate(chunk):
+                data = messages[int(row)].data[:longest]
+                values[i, :len(data)] = np.frombuffer(data, dtype=np.uint8)
+
+            for pos in range(1, longest):
+                present = np.nonzero(values[:, pos] != 256)[0]
+                if not len(present):
+                    continue
+                src = chunk_sources[present]
+                left = values[present, pos-1]
+                curr = values[present, pos]
+                right = values[present, pos+1]
+                right = np.where(right == 256, 0, right)
+                if carry[pos] is not None:
+                    src, left, curr, right = (np.concatenate(([c], a)) for c, a in
+                                              zip(carry[pos], (src, left, curr, right)))
+                carry[pos] = (src[-1], left[-1], curr[-1], right[-1])
+
+                # pairs of consecutive messages of the same source
+                same = src[1:] == src[:-1]
+                l_prev, l_curr = left[:-1][same], left[1:][same]
+                prev, curr = curr[:-1][same], curr[1:][same]
+                r_prev, r_curr = right[:-1][same], right[1:][same]
+                equal = curr == prev
+                increased = curr > prev
+                decreased = curr < prev
+
+                counters['equal'][pos] += np.count_nonzero(equal)
+                counters['less'][pos] += np.count_nonzero(decreased)
+                if np.any(equal & (l_curr < l_prev)) or np.any(increased & (l_curr >= l_prev)):
+                    counters['left_MSB'][pos] = False
+                if np.any(equal & (r_curr < r_prev)) or np.any(increased & (r_curr >= r_prev)):
+                    counters['right_MSB'][pos] = False
+                if np.any(decreased & (l_curr <= l_prev)):
+                    counters['left_LSB'][pos] = False
+                if np.any(decreased & (r_curr <= r_prev)):
+                    counters['right_LSB'][pos] = False
+
+        return counters
+
+
     @typeCheck(Symbol)
     def _seqEx(self, symbol):
         """Detect sequence fields. If fields are increasing most of the time, we can assume that it
@@ -366,18 +560,13 @@ class FeatureExtraction(object):
         if len(symbol.messages) < 50: # sample size too small
             return
 
-        # Decide which address to use as sender address (which is the one counting up the seq)
-        if len(addr_field_index) == 1:
-           addrs = self._getValuesQuick(symbol, symbol.fields[addr_field_index[0]])
-        else: # just assume second is source (just a good guess, but doesn't matter much anyway)
-            addrs = self._getValuesQuick(symbol, symbol.fields[addr_field_index[1]])
-
-        # create set of source addresses
-        src_addrs = set(addrs)
+        # rows of the messages of every source, sorted by time
+        source_index = self._sourceIndex(symbol)
 
         # create entropy list over all messages
-        e_measure = EntropyMeasurement()
-        entropies = [entr for entr in e_measure.measure_entropy(symbol.messages)]
+        entropies = self._measureEntropy(symbol.messages)
+
+        counters = self._seqCounters(symbol.messages, source_index, len(entropies))
 
         skip_next = False
         to_insert = {} # fields to insert into symbol {pos_to_insert: (field_domain, field_name)}
@@ -393,91 +582,30 @@ class FeatureExtraction(object):
                     skip_next = False
                     continue
 
-                curr_eq_prev_cnt = 0
-                curr_less_prev_cnt = 0
-                left_neighbor_LSB = True
-                left_neighbor_MSB = True
-                right_neighbor_LSB = True
-                right_neighbor_MSB = True
-
-                for src_addr in src_addrs:
-
-                    first_val = True # need to set prev_vals first
-
-                    # step through all messages of a specific source
-                    for i, data in enumerate(addrs):
-                        if data == src_addr:
-
-                            if pos >= len(symbol.messages[i].data): # message too short!
-                                break
-
-                            if first_val: # set prev_vals now and step loop
-                                l_prev_val = symbol.messages[i].data[pos-1]
-                                prev_val = symbol.messages[i].data[pos]
-                                if pos+1 >= len(symbol.messages[i].data):
-                                    r_prev_val = 0
-                                else:
-                                    r_prev_val = symbol.messages[i].data[pos+1]
-                                first_val = False
-                                continue
-
-                            # set curr_vals
-                            l_curr_val = symbol.messages[i].data[pos-1]
-                            curr_val = symbol.messages[i].data[pos]
-                            if pos+1 >= len(symbol.messages[i].data): # prevent out-of-bound error
-                                r_curr_val = 0
-                            else:
-                                r_curr_val = symbol.messages[i].data[pos+1]
-
-                            # value unchanged
-                            if curr_val == prev_val :
-                                curr_eq_prev_cnt += 1
-
-                                if l_curr_val < l_prev_val:
-                                    left_neighbor_MSB = False
-                                if r_curr_val < r_prev_val:
-                                    right_neighbor_MSB = False
-
-                            # value increased
-                            elif curr_val > prev_val:
-
-                                if l_curr_val >= l_prev_val :
-                                    left_neighbor_MSB = False
-                                if r_curr_val >= r_prev_val :
-                                    right_neighbor_MSB = False
-
-                            # value decreased (=possible overflow)
-                            else:
-                                curr_less_prev_cnt += 1
-
-                                if l_curr_val <= l_prev_val:
-                                    left_neighbor_LSB = False
-                                if r_curr_val <= r_prev_val:
-                                    right_neighbor_LSB = False
-
-                            # set prev_val for next loop step
-                            prev_val = curr_val
-                            l_prev_val = l_curr_val
-                            r_prev_val = r_curr_val
-
+                curr_eq_prev_cnt = counters['equal'][pos]
+                curr_less_prev_cnt = counters['less'][pos]
+                left_neighbor_LSB = counters['left_LSB'][pos]
+                left_neighbor_MSB = counters['left_MSB'][pos]
+                right_neighbor_LSB = counters['right_LSB'][pos]
+                right_neighbor_MSB = counters['right_MSB'][pos]
 
                 # calculate percentages
                 curr_eq_prev = curr_eq_prev_cnt/len(symbol.messages)
                 curr_less_prev = curr_less_prev_cnt/len(symbol.messages)
 
-                if first_val: # empty loop step, thus do not evaluate values
-                    pass
                 # merge byte on current position with left byte (=2-bytes sequence field)
-                if (left_neighbor_MSB and curr_eq_prev < 0.95 and curr_less_prev < 0.1) or \
-                        (left_neighbor_LSB and curr_eq_prev < 0.25):
+                if (left_neighbor_MSB and curr_eq_prev < self.seq_equal_msb and
+                        curr_less_prev < self.seq_decrease) or \
+                        (left_neighbor_LSB and curr_eq_prev < self.seq_equal):
                     to_insert.update({pos-1: (Raw(nbBytes=2), "SEQ")})
                 # merge byte on current position with right byte (=2-bytes sequence field)
-                elif (right_neighbor_MSB and curr_eq_prev < 0.95 and curr_less_prev < 0.1) or \
-                        (right_neighbor_LSB and curr_eq_prev < 0.25):
+                elif (right_neighbor_MSB and curr_eq_prev < self.seq_equal_msb and
+                        curr_less_prev < self.seq_decrease) or \
+                        (right_neighbor_LSB and curr_eq_prev < self.seq_equal):
                     to_insert.update({pos: (Raw(nbBytes=2), "SEQ")})
                     skip_next = True # we already know that the next byte is a sequence byte
                 # single-byte sequence field
-                elif curr_eq_prev < 0.25 and curr_less_prev < 0.1:
+                elif curr_eq_prev < self.seq_equal and curr_less_prev < self.seq_decrease:
                     to_insert.update({pos: (Raw(nbBytes=1), "SEQ")})
                 else:
                     # it is no sequence field, but the entropy is high, might be worth noting...
@@ -487,6 +615,19 @@ class FeatureExtraction(object):
         # insert new fields to symbol
         self._insertFields(symbol, to_insert)
 
+        # test if last protocol field is a checksum
+        with profiler.step('_checksumEx', len(symbol.messages)):
+            self._checksumEx(symbol)
+
+        return
+
+
+    @typeCheck(Symbol)
+    def _checksumEx(self, symbol):
+        """Detect a checksum field at the end of the protocol header of symbol. A four-byte field
+        with high entropy is renamed to the checksum algorithm matching the messages.
+        """
+
         # test if last protocol field is a checksum (if marked "high entropy" and has four bytes)
         # actually, it is symbol.fields[-2], because last field of the symbol is payload field
         # TODO may needs improvement, e.g. if protocol never includes a payload, this probably fails
@@ -561,6 +702,8 @@ class FeatureExtraction(object):
         if sym.messages is None:
             raise ValueError("No messages were given, this shouldn't be the case")
 
+        alignments.invalidate(sym) # layout is going to change
+
         max_len = max(len(x.data) for x in sym.messages) # size of longest message
         min_len = min(len(x.data) for x in sym.messages) # size of shortest message
         mins = maxs = 0 # cumulated minimal and maximal size of fields
@@ -611,22 +754,33 @@ class FeatureExtraction(object):
 
 
     @typeCheck(list)
-    def _basicFeatureEx(self, messages_list):
-        """Analyze basic feature (Address, SEQ fields) of messages and cluster messages by type.
+    def findAddresses(self, messages_list):
+        """Find address fields in the messages of every message set (address stage).
 
         :param messages_list: list of lists with messages
         :type list:
-        :return: list of clusters corresponding to list items
+        :return: list of symbols containing the address fields, one per message set
         """
 
-        analyzed_msgs = []
-
-        # for every message set, try to find address and SEQ fields
-        # the messages are clustered by first field (bitmask) and stored in analyzed_msgs
+        symbols = []
         for msgs in messages_list:
+            with profiler.step('_addrEx', len(msgs)):
+                symbols.append(self._addrEx(msgs))
+        return symbols
+
 
-            # try to find address fields
-            symbol = self._addrEx(msgs)
+    @typeCheck(list)
+    def clusterByType(self, symbols):
+        """Cluster the messages of every symbol by frame type (cluster stage).
+
+        :param symbols: list of symbols as returned by findAddresses()
+        :type list:
+        :return: list of clusters corresponding to list items
+        """
+
+        cluster_list = []
+
+        for capture, symbol in enumerate(symbols):
 
             # assuming first unidentified field is defining message type,
             # we are clustering the messages by type
@@ -636,17 +790,52 @@ class FeatureExtraction(object):
                     # TODO might be a big fat field at the end, that would be bad... might
                     # cut off rest if bigger that usual frame field in this case?
                     field.name = "Frame_type"
-                    cluster = self._clusterByKeyField(symbol, symbol.fields[i_field])
+                    with profiler.step('_clusterByKeyField', len(symbol.messages)):
+                        cluster = self._clusterByKeyField(symbol, symbol.fields[i_field])
                     break
 
-            # try to find sequence field(s)
             for c in cluster:
                 c.orig_messages = list(c.messages)
-                self._seqEx(c)
+                with profiler.step('_sourceIndex', len(c.messages)):
+                    self._sourceIndex(c, capture)
+
+            cluster_list.append(cluster)
+
+        return cluster_list
+
+
+    @typeCheck(list)
+    def findSequences(self, cluster_list):
+        """Find sequence and checksum fields in every symbol of the clusters (seq stage).
+
+        :param cluster_list: list of clusters as returned by clusterByType()
+        :type list:
+        :return: the same list of clusters, symbols are altered in place
+        """
+
+        for cluster in cluster_list:
+            for c in cluster:
+                with profiler.step('_seqEx', len(c.messages)):
+                    self._seqEx(c)
+
+        return cluster_list
+
 
-            analyzed_msgs.append(cluster)
+    @typeCheck(list)
+    def _basicFeatureEx(self, messages_list):
+        """Analyze basic feature (Address, SEQ fields) of messages and cluster messages by type.
+
+        :param messages_list: list of lists with messages
+        :type list:
+        :return: list of clusters corresponding to list items
+        """
+
+        # for every message set, try to find address and SEQ fields
+        # the messages are clustered by first field (bitmask)
+        symbols = self.findAddresses(messages_list)
+        cluster_list = self.clusterByType(symbols)
 
-        return analyzed_msgs
+        return self.findSequences(cluster_list)
 
 
     @typeCheck(Symbol)
@@ -673,6 +862,8 @@ class FeatureExtraction(object):
                 field_positions.append((int(begin_pos/8), int((begin_pos+end_pos)/8)))
             begin_pos += end_pos
 
+        alignments.invalidate(sym) # messages are going to change
+
         # set SEQ and Checksum field of all messages to zero
         for m in sym.messages:
             for start, end in field_positions:
@@ -681,11 +872,23 @@ class FeatureExtraction(object):
         # remove all non-unique messages
         deduplicated_data = set()
         new_messages = []
-        for m in sym.messages:
+        new_rows = {} # row of message before deduplication: row after deduplication
+        for row, m in enumerate(sym.messages):
             if m.data not in deduplicated_data:
                 deduplicated_data.add(m.data)
+                new_rows[row] = len(new_messages)
                 new_messages.append(m)
 
+        # keep the source index of the remaining messages
+        source_index = getattr(sym, 'source_index', None)
+        if source_index is not None and source_index[0] == len(sym.messages):
+            index = {}
+            for key, rows in source_index[1].items():
+                kept = [new_rows[row] for row in rows if row in new_rows]
+                if kept:
+                    index[key] = kept
+            sym.source_index = (len(new_messages), index)
+
         # set sym.messages to deduplicated list of messages
         sym.messages = new_messages
         sym.dedup_messages = list(sym.messages)
@@ -716,6 +919,7 @@ class FeatureExtraction(object):
                 # are the fields of the current symbol similar to the other sym?
                 elif self._fieldsAreSimilar(merged_sym[0], sym):
                     # add messages to existing symbol
+                    self._mergeSourceIndex(merged_sym[0], sym)
                     merged_sym[0].messages.extend(sym.messages)
                     merged_sym[0].orig_messages.extend(sym.orig_messages)
                 # the symbols differ, we need to add the symbol instead of merging
@@ -764,8 +968,7 @@ class FeatureExtraction(object):
                 if len(sym.messages) == 1:
                     entropies = [0.0] * len(sym.messages[0].data)
                 else:
-                    e_measure = EntropyMeasurement()
-                    entropies = [entr for entr in e_measure.measure_entropy(sym.messages)]
+                    entropies = self._measureEntropy(sym.messages)
                 entropy_list.append(entropies)
 
             # go through entropy per byte position
@@ -856,23 +1059,22 @@ class FeatureExtraction(object):
     #    return
 
 
-    def execute(self):
-        """Apply all detection methods at hand to the given messages.
-
-        >>> features = FeatureExtraction.FeatureExtraction(messages)
-        >>> cluster = features.execute()
+    @typeCheck(list)
+    def mergeContexts(self, cluster_list):
+        """Merge the clusters of all message sets into a single list of symbols, comparing context
+        information if there is more than one message set (context stage).
 
-        cluster contains all messages clustered by their first field.
+        :param cluster_list: list of clusters as returned by findSequences()
+        :type list:
+        :return: list of symbols sorted by name
         """
-        # TODO enrich example with actual practical example :)
-
-        print("\n> Find basic features in messages (Address, SEQ and Checksum fields)...")
-        cluster_list = self._basicFeatureEx(self.messages_list)
 
         # we got multiple pcaps and probably different context, do some context analysis...
         if len(cluster_list) > 1:
             print("\n> Find features by comparing context information...")
-            frametypes_cluster = self._contextFeatureEx(cluster_list)
+            with profiler.step('_contextFeatureEx',
+                               sum(len(c.messages) for cluster in cluster_list for c in cluster)):
+                frametypes_cluster = self._contextFeatureEx(cluster_list)
         # just use single list item for next steps
         else:
             frametypes_cluster = cluster_list[0]
@@ -882,14 +1084,46 @@ class FeatureExtraction(object):
 
         # make sure that length of last field equals length of biggest/smallest message
         for sym in frametypes_cluster:
-            self._adaptLengthFields(sym)
+            with profiler.step('_adaptLengthFields', len(sym.messages)):
+                self._adaptLengthFields(sym)
+
+        return frametypes_cluster
+
+
+    @typeCheck(list)
+    def deduplicate(self, frametypes_cluster):
+        """Deduplicate the messages of every symbol (dedup stage).
+
+        :param frametypes_cluster: list of symbols as returned by mergeContexts()
+        :type list:
+        :return: the same list of symbols, symbols are altered in place
+        """
 
         print("\n> Deduplicate messages...")
         for c in frametypes_cluster:
-            self._deduplicate(c)
+            with profiler.step('_deduplicate', len(c.messages)):
+                self._deduplicate(c)
 
-        # TODO does it make sense to merge cluster members to a single symbol (ideally self.symbol)
-        # and return this instead?
         return frametypes_cluster
 
 
+    def execute(self):
+        """Apply all detection methods at hand to the given messages.
+
+        >>> features = FeatureExtraction.FeatureExtraction(messages)
+        >>> cluster = features.execute()
+
+        cluster contains all messages clustered by their first field.
+        """
+        # TODO enrich example with actual practical example :)
+
+        print("\n> Find basic features in messages (Address, SEQ and Checksum fields)...")
+        cluster_list = self._basicFeatureEx(self.messages_list)
+
+        frametypes_cluster = self.mergeContexts(cluster_list)
+
+        frametypes_cluster = self.deduplicate(frametypes_cluster)
+
+        # TODO does it make sense to merge cluster members to a single symbol (ideally self.symbol)
+        # and return this instead?
+        return frametypes_cluster
@@ -0,0 +1,296 @@
+# system import
+from os.path import join
+
+# external import
+import numpy as np
+
+# netzob import
+from netzob.Model.Vocabulary.Messages.AbstractMessage import AbstractMessage
+from netzob.Model.Vocabulary.Messages.L2NetworkMessage import L2NetworkMessage
+from netzob.Model.Vocabulary.Symbol import Symbol
+
+# internal import
+from Profiler import profiler
+from WithPayloadMessage import WithPayloadMessage, loadLayers
+
+
+class MessageStore(object):
+    """Disk-backed storage of message bytes. All byte strings are stored one after another in a
+    memory-mapped file, so that the operating system can page them out instead of keeping every
+    message in memory.
+
+    >>> store = MessageStore('messages.bin', [b'\\x01\\x02', b'\\x03'])
+    >>> store.get(1)
+    b'\\x03'
+    """
+
+    def __init__(self, path, values, lengths=None):
+        """
+        :param path: file to store the bytes in, is overwritten
+        :param values: list of bytes to store, rows are referenced by list index. Any iterable of
+        bytes if lengths is given, so that the values do not need to be held in memory at once
+        :param lengths: lengths of the values
+        """
+        self.path = path
+
+        if lengths is None:
+            lengths = [len(v) for v in values]
+        lengths = np.asarray(lengths, dtype=np.int64)
+        self.offsets = np.zeros(len(lengths), dtype=np.int64)
+        if len(lengths) > 1:
+            self.offsets[1:] = np.cumsum(lengths[:-1])
+        self.lengths = lengths
+
+        # a memmap can not be empty, thus allocate at least one byte
+        self.buffer = np.memmap(path, dtype=np.uint8, mode='w+', shape=(max(int(lengths.sum()), 1),))
+        for row, value in enumerate(values):
+            offset = self.offsets[row]
+            self.buffer[offset:offset+len(value)] = np.frombuffer(value, dtype=np.uint8)
+        self.buffer.flush()
+
+    @classmethod
+    def open(cls, path, offsets, lengths):
+        """Open an existing store copy-on-write: changed rows are kept in memory only, the file
+        stays untouched.
+
+        :param offsets: offsets of the rows, see self.offsets of the store that created path
+        :param lengths: lengths of the rows, see self.lengths
+        """
+        store = cls.__new__(cls)
+        store.path = path
+        store.offsets = offsets
+        store.lengths = lengths
+        store.buffer = np.memmap(path, dtype=np.uint8, mode='c')
+        return store
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def span(self, row):
+        """Return (offset, length) of row in the store."""
+        return int(self.offsets[row]), int(self.lengths[row])
+
+    def get(self, row):
+        """Return bytes stored in row."""
+        return self.read(*self.span(row))
+
+    def read(self, offset, length):
+        """Return length bytes stored at offset."""
+        return self.buffer[offset:offset+length].tobytes()
+
+    def set(self, row, value):
+        """Overwrite bytes of row, only possible if size does not change.
+
+        :return: True if value was stored, False if its size differs
+        """
+        offset, length = self.span(row)
+        if len(value) != length:
+            return False
+        self.write(offset, value)
+        return True
+
+    def write(self, offset, value):
+        """Overwrite the bytes at offset with value."""
+        self.buffer[offset:offset+len(value)] = np.frombuffer(value, dtype=np.uint8)
+
+
+class MappedMessage(WithPayloadMessage):
+    """Message whose data and payload data are kept in a MessageStore. The payload is dissected
+    again from payload_data whenever it is accessed, instead of keeping the scapy packet around.
+    Data of a different size than the stored one is kept in memory instead.
+    """
+
+    def __init__(self, store, row, payload_row, date, l2Protocol=None, payload_cls=None):
+        self._setup(store, store.span(row),
+                    store.span(payload_row) if payload_row is not None else None,
+                    date, l2Protocol, payload_cls)
+
+    def _setup(self, store, span, payload_span, date, l2Protocol, payload_cls):
+        """Initialize message with the (offset, length) of its data and payload data in store."""
+        self._store = store
+        self._span = None # keep data in memory until super() is done
+        self._payload_span = payload_span
+        self._payload_cls = payload_cls
+        super().__init__(b'', date, l2Protocol)
+        self._span = span
+
+    @property
+    def data(self):
+        if self._span is None:
+            return self._resident_data
+        return self._store.read(*self._span)
+
+    @data.setter
+    def data(self, data):
+        if self._span is not None and len(data) == self._span[1]:
+            self._store.write(self._span[0], data)
+            return
+        self._span = None
+        self._resident_data = data
+
+    @property
+    def payload_data(self):
+        if self._payload_span is None:
+            return getattr(self, '_resident_payload_data', None)
+        return self._store.read(*self._payload_span)
+
+    @payload_data.setter
+    def payload_data(self, payload_data):
+        # setter is called by super().__init__ only
+        if getattr(self, '_payload_span', None) is None:
+            self._resident_payload_data = payload_data
+
+    def residentBytes(self):
+        """Return number of bytes of data and payload data kept in memory instead of the store."""
+        size = len(self._resident_data) if self._span is None else 0
+        if self._payload_span is None:
+            size += len(getattr(self, '_resident_payload_data', None) or b'')
+        return size
+
+    def cut(self, offset=None, payload_cls=None):
+        """Return a new message of the bytes of this one, the bytes from offset on being its
+        payload. Both refer to the same bytes in the store, nothing is copied, thus changing the
+        data of one changes the other one, too.
+
+        :param offset: start of the payload, no payload if None
+        :param payload_cls: scapy class to dissect the payload with
+        :return: new MappedMessage, None if the data of this message is not stored or it already
+        has a payload
+        """
+        if self._span is None or self._payload_span is not None or \
+                getattr(self, '_resident_payload_data', None) is not None:
+            return None
+
+        start, length = self._span
+        new_m = MappedMessage.__new__(MappedMessage)
+        if offset is None:
+            new_m._setup(self._store, self._span, None, self.date, self.l2Protocol, None)
+        else:
+            new_m._setup(self._store, (start, offset), (start + offset, length - offset),
+                         self.date, self.l2Protocol, payload_cls)
+        new_m.metadata = self.metadata
+        return new_m
+
+    @property
+    def payload(self):
+        if self._payload_cls is None:
+            return None
+        loadLayers()
+        profiler.count('dissections')
+        return self._payload_cls(self.payload_data)
+
+    @payload.setter
+    def payload(self, payload):
+        # setter is called by super().__init__ only
+        if payload is not None:
+            self._payload_cls = type(payload)
+
+
+def messageBytes(state):
+    """Return number of bytes of message data (and payload data) referenced by a pipeline state
+    (nested lists of messages and symbols) that are held in memory, bytes of MappedMessages in a
+    MessageStore are not counted. Shared messages are counted once.
+    """
+
+    seen = set()
+    size = 0
+    for m in _iterMessages(state):
+        if id(m) in seen:
+            continue
+        seen.add(id(m))
+        if isinstance(m, MappedMessage):
+            size += m.residentBytes()
+        else:
+            size += len(m.data) + len(getattr(m, 'payload_data', None) or b'')
+    return size
+
+
+def isMapped(state):
+    """Return True if a pipeline state references any MappedMessage."""
+    return any(isinstance(m, MappedMessage) for m in _iterMessages(state))
+
+
+def messageCount(state):
+    """Return number of messages in a pipeline state (nested lists of messages and symbols), the
+    original messages kept by symbols are not counted.
+    """
+
+    if isinstance(state, list):
+        return sum(messageCount(item) for item in state)
+    if isinstance(state, Symbol):
+        return len(state.messages)
+    if isinstance(state, AbstractMessage):
+        return 1
+    return 0
+
+
+def _iterMessages(state):
+    if isinstance(state, list):
+        for item in state:
+            yield from _iterMessages(item)
+    elif isinstance(state, Symbol):
+        yield from state.messages
+        for attr in ('orig_messages', 'dedup_messages'):
+            yield from getattr(state, attr, None) or []
+    elif isinstance(state, AbstractMessage):
+        yield state
+
+
+def spillMessages(state, path):
+    """Move the bytes of all messages referenced by a pipeline state (nested lists of messages and
+    symbols) into a MessageStore at path and replace the messages by MappedMessages. Messages shared
+    by several lists or symbols stay shared.
+
+    :return: the new state
+    """
+
+    # collect unique messages and their rows in the store
+    messages = []
+    rows = {}
+    for m in _iterMessages(state):
+        if id(m) not in rows:
+            rows[id(m)] = len(messages)
+            messages.append(m)
+
+    # the bytes are copied message by message, as they might be mapped from another store
+    lengths = [len(m.data) for m in messages]
+    payload_messages = []
+    payload_rows = {}
+    for m in messages:
+        payload_data = getattr(m, 'payload_data', None)
+        if payload_data is not None:
+            payload_rows[id(m)] = len(lengths)
+            lengths.append(len(payload_data))
+            payload_messages.append(m)
+
+    values = (v for values in ((m.data for m in messages),
+                               (m.payload_data for m in payload_messages)) for v in values)
+    store = MessageStore(path, values, lengths)
+
+    # create mapped messages, but keep all information of the old message objects
+    mapped = {}
+    for m in messages:
+        l2Protocol = m.l2Protocol if isinstance(m, L2NetworkMessage) else None
+        payload = getattr(m, 'payload', None)
+        new_m = MappedMessage(store, rows[id(m)], payload_rows.get(id(m)), m.date, l2Protocol,
+                              type(payload) if payload is not None else None)
+        new_m.metadata = getattr(m, 'metadata', None)
+        mapped[id(m)] = new_m
+
+    def replace(obj):
+        if isinstance(obj, list):
+            return [replace(item) for item in obj]
+        if isinstance(obj, Symbol):
+            obj.messages = [mapped[id(m)] for m in obj.messages]
+            for attr in ('orig_messages', 'dedup_messages'):
+                if getattr(obj, attr, None) is not None:
+                    setattr(obj, attr, [mapped[id(m)] for m in getattr(obj, attr)])
+            return obj
+        return mapped[id(obj)]
+
+    return replace(state)
+
+
+def storePath(directory, stage):
+    """Return path of the message store created after the given stage."""
+    return join(directory, "messages_{}.bin".format(stage))
@@ -0,0 +1,270 @@
+# system import
+from importlib import import_module
+import json
+from os import getpid, makedirs, rename, replace
+from os.path import abspath, basename, dirname, isdir, join, normpath
+from shutil import rmtree
+
+# external import
+import numpy as np
+
+# netzob import
+from netzob.Model.Vocabulary.Messages.L2NetworkMessage import L2NetworkMessage
+
+# internal import
+from Checkpoint import decodeSymbol
+from MessageStore import MappedMessage, MessageStore
+from ModelCompiler import ModelCompiler, symbolLayouts
+
+
+MODEL_VERSION = 1
+"""Version of the model format, models of other versions are not loaded."""
+
+MESSAGE_LISTS = ('messages', 'orig_messages', 'dedup_messages')
+"""Lists of messages of a symbol stored in the model."""
+
+
+def _className(cls):
+    return "{}:{}".format(cls.__module__, cls.__qualname__)
+
+
+def _loadClass(name):
+    module, qualname = name.split(':')
+    obj = import_module(module)
+    for attr in qualname.split('.'):
+        obj = getattr(obj, attr)
+    return obj
+
+
+def save_model(cluster, path, payload_offsets=None, manifest=None):
+    """Store the inferred symbols in the directory path. The model consists of
+
+    - model.json: version, manifest, payload offsets and the layout of every symbol (name, frame
+      type, fields with name, offset and size range, checksum algorithm)
+    - messages.bin: data and payload data of all messages, see MessageStore
+    - messages.npz: per message the rows in messages.bin, date, l2 protocol, payload class and
+      context, and the references of every symbol to its messages
+
+    The model is written to a temporary directory next to path and renamed into place, thus an
+    existing model at path is only replaced once the new one is complete. Messages of a model
+    loaded from path still map the old messages.bin, which stays valid until they are gone.
+
+    :param payload_offsets: payload offsets found by the PayloadFinder (known_offsets)
+    :param manifest: dict describing the inference, e.g. files, layer and runtime
+    """
+
+    final_path = normpath(path)
+    parent = dirname(abspath(final_path))
+    path = join(parent, '.{}.tmp-{}'.format(basename(final_path), getpid()))
+    if isdir(path):
+        rmtree(path)
+    makedirs(path)
+    try:
+        _writeModel(cluster, path, payload_offsets, manifest)
+    except BaseException:
+        rmtree(path)
+        raise
+
+    if isdir(final_path):
+        # the old files are only unlinked, memory maps of them stay valid
+        old_path = join(parent, '.{}.old-{}'.format(basename(final_path), getpid()))
+        if isdir(old_path):
+            rmtree(old_path)
+        replace(final_path, old_path)
+        rename(path, final_path)
+        rmtree(old_path)
+    else:
+        rename(path, final_path)
+
+    return final_path
+
+
+def _writeModel(cluster, path, payload_offsets, manifest):
+    """Write the files of a model to the directory path, see save_model()."""
+
+    # collect unique messages of all symbols
+    messages = []
+    rows = {}
+    refs = {name: [] for name in MESSAGE_LISTS}
+    for sym in cluster:
+        for name in MESSAGE_LISTS:
+            for m in getattr(sym, name, None) or []:
+                if id(m) not in rows:
+                    rows[id(m)] = len(messages)
+                    messages.append(m)
+                refs[name].append(rows[id(m)])
+
+    # message bytes, payload data is appended after the data of all messages
+    values = [m.data for m in messages]
+    payload_rows = np.full(len(messages), -1, dtype=np.int64)
+    for i, m in enumerate(messages):
+        payload_data = getattr(m, 'payload_data', None)
+        if payload_data is not None:
+            payload_rows[i] = len(values)
+            values.append(payload_data)
+    store = MessageStore(join(path, 'messages.bin'), values)
+    del values
+
+    # strings and contexts are shared by many messages, store them once
+    l2Protocols = []
+    payload_classes = []
+    contexts = []
+    context_ids = {} # canonical JSON of a context: index in contexts
+    context_keys = {} # id(metadata): canonical JSON, metadata objects are alive during the loop
+    l2_index = np.full(len(messages), -1, dtype=np.int32)
+    payload_index = np.full(len(messages), -1, dtype=np.int32)
+    context_index = np.full(len(messages), -1, dtype=np.int32)
+    for i, m in enumerate(messages):
+        if isinstance(m, L2NetworkMessage) and m.l2Protocol is not None:
+            if m.l2Protocol not in l2Protocols:
+                l2Protocols.append(m.l2Protocol)
+            l2_index[i] = l2Protocols.index(m.l2Protocol)
+        payload = getattr(m, 'payload', None)
+        if payload is not None:
+            cls = _className(type(payload))
+            if cls not in payload_classes:
+                payload_classes.append(cls)
+            payload_index[i] = payload_classes.index(cls)
+        metadata = getattr(m, 'metadata', None)
+        if metadata:
+            # every message has a metadata object of its own, compare their content
+            if id(metadata) not in context_keys:
+                context_keys[id(metadata)] = _contextKey(metadata)
+            key = context_keys[id(metadata)]
+            if key not in context_ids:
+                context_ids[key] = len(contexts)
+                contexts.append(metadata)
+            context_index[i] = context_ids[key]
+
+    np.savez(join(path, 'messages.npz'),
+             offsets=store.offsets, lengths=store.lengths, payload_rows=payload_rows,
+             dates=np.array([m.date for m in messages], dtype=np.float64),
+             l2Protocols=l2_index, payload_classes=payload_index, contexts=context_index,
+             **{'refs_' + name: np.array(refs[name], dtype=np.int64) for name in MESSAGE_LISTS})
+
+    symbols = []
+    for sym, layout in zip(cluster, symbolLayouts(cluster)):
+        layout['frame_type'] = layout['frame_type'].hex() if layout['frame_type'] else None
+        checksums = [f['name'] for f in layout['fields'] if f['name'] in ('crc32', 'adler32')]
+        layout['checksum'] = checksums[-1] if checksums else None
+        for name in MESSAGE_LISTS:
+            msgs = getattr(sym, name, None)
+            layout[name] = len(msgs) if msgs is not None else None
+        symbols.append(layout)
+
+    model = {
+        'version': MODEL_VERSION,
+        'manifest': manifest or {},
+        'payload_offsets': sorted(payload_offsets or []),
+        'l2Protocols': l2Protocols,
+        'payload_classes': payload_classes,
+        'contexts': contexts,
+        'symbols': symbols,
+    }
+    with open(join(path, 'model.json'), 'w') as modelfile:
+        json.dump(model, modelfile, indent=1)
+
+
+def _contextKey(metadata):
+    """Return the context information of a message as canonical JSON, so that equal contexts are
+    stored once. Raises TypeError if it can not be stored in model.json, as it would not be loaded
+    the same.
+    """
+    try:
+        return json.dumps(metadata, sort_keys=True)
+    except TypeError as e:
+        raise TypeError("Context information {!r} can not be stored in a model: {}".format(
+            metadata, e))
+
+
+def load_model(path):
+    """Load a model stored by save_model(). Only the description of the symbols is read, messages
+    are loaded when Model.cluster() is called for the first time.
+    """
+    return Model(path)
+
+
+class Model(object):
+    """Inferred protocol model loaded from a directory (see save_model()).
+
+    >>> model = load_model('reports/model')
+    >>> model.symbols[0]['fields']
+    >>> compiler = model.compiler()
+    >>> cluster = model.cluster()
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(join(path, 'model.json')) as modelfile:
+            model = json.load(modelfile)
+        if model['version'] != MODEL_VERSION:
+            raise ValueError("Model {} has version {}, expected {}".format(
+                path, model['version'], MODEL_VERSION))
+
+        self.manifest = model['manifest']
+        self.payload_offsets = model['payload_offsets']
+        self.l2Protocols = model['l2Protocols']
+        self.payload_classes = model['payload_classes']
+        self.contexts = model['contexts']
+        self.symbols = model['symbols']
+        for layout in self.symbols:
+            if layout['frame_type'] is not None:
+                layout['frame_type'] = bytes.fromhex(layout['frame_type'])
+        self._cluster = None
+
+    def compiler(self):
+        """Return a ModelCompiler to parse new traffic, no messages are loaded for this."""
+        return ModelCompiler(self.symbols)
+
+    def cluster(self):
+        """Return the symbols with their messages as netzob symbols. Message data is mapped from
+        messages.bin and read on access only.
+        """
+
+        if self._cluster is not None:
+            return self._cluster
+
+        index = np.load(join(self.path, 'messages.npz'))
+
+        store = MessageStore.open(join(self.path, 'messages.bin'), index['offsets'],
+                                  index['lengths'])
+
+        payload_rows = index['payload_rows']
+        dates = index['dates']
+        l2_index = index['l2Protocols']
+        payload_index = index['payload_classes']
+        context_index = index['contexts']
+        payload_classes = [_loadClass(name) for name in self.payload_classes]
+
+        messages = {}
+        def decode_msg(i):
+            if i not in messages:
+                payload_row = int(payload_rows[i])
+                m = MappedMessage(store, i, payload_row if payload_row >= 0 else None,
+                                  float(dates[i]),
+                                  self.l2Protocols[l2_index[i]] if l2_index[i] >= 0 else None,
+                                  payload_classes[payload_index[i]] if payload_index[i] >= 0
+                                  else None)
+                if context_index[i] >= 0:
+                    m.metadata = self.contexts[context_index[i]]
+                messages[i] = m
+            return messages[i]
+
+        refs = {name: index['refs_' + name].tolist() for name in MESSAGE_LISTS}
+        positions = {name: 0 for name in MESSAGE_LISTS}
+        cluster = []
+        for layout in self.symbols:
+            enc = {'name': layout['name'],
+                   'fields': [(f['name'], f['minsize']*8, f['maxsize']*8)
+                              for f in layout['fields']]}
+            for name in MESSAGE_LISTS:
+                if layout[name] is None:
+                    enc[name] = None
+                    continue
+                start = positions[name]
+                positions[name] += layout[name]
+                enc[name] = refs[name][start:positions[name]]
+            cluster.append(decodeSymbol(enc, decode_msg))
+
+        self._cluster = cluster
+        return cluster
@@ -0,0 +1,228 @@
+# system import
+from collections import Counter
+import struct
+from zlib import crc32, adler32
+
+import numpy as np
+
+# internal import
+from utils import fieldOffsets
+
+
+CHECKSUM_FUNCTIONS = {'crc32': crc32, 'adler32': adler32}
+
+
+def symbolLayouts(cluster):
+    """Return the layout of every symbol as plain data, as needed by ModelCompiler.
+
+    :return: list of dicts with name, frame_type (value of the Frame_type field) and fields (list of
+    dicts with name, start, minsize and maxsize in bytes)
+    """
+
+    layouts = []
+    for symbol in cluster:
+        fields = []
+        frame_type = None
+        for field, start, end in fieldOffsets(symbol):
+            minsize, maxsize = (int(bits/8) for bits in field.domain.dataType.size)
+            fields.append({'name': field.name, 'start': start, 'minsize': minsize,
+                           'maxsize': maxsize})
+            if field.name == "Frame_type" and frame_type is None and symbol.messages:
+                frame_type = symbol.messages[0].data[start:end]
+        layouts.append({'name': symbol.name, 'frame_type': frame_type, 'fields': fields})
+    return layouts
+
+
+class ModelCompiler(object):
+    """Compiles the inferred symbols into a parser for new traffic that works without netzob.
+    Frames are copied into a byte matrix once, the symbol of every frame is found by a lookup of
+    its frame type and all fields at fixed offsets are sliced for all frames of a symbol at once.
+    The result is a columnar table (dict of numpy arrays).
+
+    Fields are named like in the boofuzz template, e.g. 'Address-1', 'Address-2', 'SEQ-1'. Only
+    fields following fixed-size fields have a fixed offset, fields after a variable-size field are
+    not extracted.
+
+    >>> compiler = ModelCompiler.fromCluster(cluster)
+    >>> table = compiler.parse([m.data for m in messages])
+    >>> table['symbol'], table['Address-1'], table['Address-1_valid']
+    """
+
+    def __init__(self, layouts):
+        """
+        :param layouts: symbol layouts as returned by symbolLayouts()
+        """
+
+        self.names = [layout['name'] for layout in layouts]
+
+        # dispatch tables: (offset, size): (sorted frame type keys, symbol index per key)
+        self.dispatch = {}
+        groups = {}
+        for i_sym, layout in enumerate(layouts):
+            for field in layout['fields']:
+                if field['name'] == "Frame_type":
+                    break
+            else:
+                continue
+            if layout['frame_type'] is None or len(layout['frame_type']) > 8:
+                continue
+            keys = groups.setdefault((field['start'], len(layout['frame_type'])), {})
+            # the first symbol wins if symbols of several traces have the same frame type
+            keys.setdefault(int.from_bytes(layout['frame_type'], 'big'), i_sym)
+        for position, keys in groups.items():
+            ordered = sorted(keys)
+            self.dispatch[position] = (np.array(ordered, dtype=np.uint64),
+                                       np.array([keys[k] for k in ordered], dtype=np.int32))
+
+        # fields with fixed offset per symbol: (label, start, size)
+        self.columns = {} # label: maximum size
+        self.fields = []
+        self.checksums = [] # per symbol: (algorithm, start) or None
+        for layout in layouts:
+            fields = []
+            checksum = None
+            counter = Counter()
+            for field in layout['fields']:
+                if field['minsize'] != field['maxsize']:
+                    break
+                counter[field['name']] += 1
+                label = "{}-{}".format(field['name'], counter[field['name']])
+                size = field['maxsize']
+                if size > 0 and field['name'] != "Frame_type":
+                    fields.append((label, field['start'], size))
+                    self.columns[label] = max(size, self.columns.get(label, 0))
+                    if field['name'] in CHECKSUM_FUNCTIONS and size == 4:
+                        checksum = (field['name'], field['start'])
+            self.fields.append(fields)
+            self.checksums.append(checksum)
+
+        # per symbol struct to parse single frames
+        self.structs = []
+        for fields in self.fields:
+            fmt = ">"
+            pos = 0
+            for _, start, size in fields:
+                fmt += "{}x{}s".format(start - pos, size) if start > pos else "{}s".format(size)
+                pos = start + size
+            self.structs.append(struct.Struct(fmt))
+
+        self.width = max([start + size for fields in self.fields for _, start, size in fields] +
+                         [offset + size for offset, size in self.dispatch] + [0])
+
+    @classmethod
+    def fromCluster(cls, cluster):
+        return cls(symbolLayouts(cluster))
+
+    def matrix(self, frames):
+        """Copy the first bytes of all frames into a byte matrix (zero padded).
+
+        :return: tuple (matrix of shape (number of frames, width), array of frame lengths)
+        """
+
+        lengths = np.fromiter((len(f) for f in frames), dtype=np.int64, count=len(frames))
+        buf = np.frombuffer(b''.join(frames), dtype=np.uint8)
+        starts = np.zeros(len(frames), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=starts[1:])
+
+        matrix = np.zeros((len(frames), self.width), dtype=np.uint8)
+        cols = np.arange(self.width)
+        mask = cols[None, :] < lengths[:, None]
+        matrix[mask] = buf[(starts[:, None] + cols[None, :])[mask]]
+        return matrix, lengths
+
+    @staticmethod
+    def _integers(matrix, start, size):
+        """Return the big-endian integer value of matrix[:, start:start+size] per row."""
+        values = np.zeros(len(matrix), dtype=np.uint64)
+        for i in range(start, start + size):
+            values = (values << np.uint64(8)) | matrix[:, i].astype(np.uint64)
+        return values
+
+    def classify(self, frames, matrix=None, lengths=None):
+        """Return the index of the symbol (in self.names) of every frame, -1 if unknown."""
+
+        if matrix is None:
+            matrix, lengths = self.matrix(frames)
+        symbols = np.full(len(matrix), -1, dtype=np.int32)
+        for (offset, size), (keys, indices) in self.dispatch.items():
+            todo = (symbols < 0) & (lengths >= offset + size)
+            values = self._integers(matrix[todo], offset, size)
+            pos = np.minimum(np.searchsorted(keys, values), len(keys) - 1)
+            found = keys[pos] == values
+            rows = np.flatnonzero(todo)
+            symbols[rows[found]] = indices[pos[found]]
+        return symbols
+
+    def parse(self, frames, checksums=False):
+        """Parse frames into a columnar table.
+
+        :param frames: list of raw frames (bytes)
+        :param checksums: validate crc32 and adler32 fields (slower, done per frame)
+        :return: dict with 'symbol' (index in self.names, -1 if unknown), 'length' and one column
+        per field label with a boolean column '<label>_valid'. Fields up to 8 bytes are stored as
+        unsigned integers, longer fields as rows of bytes. With checksums, 'checksum_ok' is added.
+        """
+
+        matrix, lengths = self.matrix(frames)
+        symbols = self.classify(frames, matrix, lengths)
+
+        table = {'symbol': symbols, 'length': lengths}
+        for label, size in self.columns.items():
+            if size <= 8:
+                table[label] = np.zeros(len(frames), dtype=np.uint64)
+            else:
+                table[label] = np.zeros((len(frames), size), dtype=np.uint8)
+            table[label + '_valid'] = np.zeros(len(frames), dtype=bool)
+
+        for i_sym, fields in enumerate(self.fields):
+            rows = np.flatnonzero(symbols == i_sym)
+            if not len(rows):
+                continue
+            sub = matrix[rows]
+            for label, start, size in fields:
+                valid = lengths[rows] >= start + size
+                if size <= 8:
+                    table[label][rows] = self._integers(sub, start, size)
+                else:
+                    table[label][rows, :size] = sub[:, start:start+size]
+                table[label + '_valid'][rows] = valid
+
+        if checksums:
+            ok = np.zeros(len(frames), dtype=bool)
+            for i_sym, checksum in enumerate(self.checksums):
+                if checksum is None:
+                    continue
+                function = CHECKSUM_FUNCTIONS[checksum[0]]
+                start = checksum[1]
+                for row in np.flatnonzero(symbols == i_sym):
+                    data = frames[row]
+                    ok[row] = len(data) >= start + 4 and \
+                        function(data[:start]).to_bytes(4, 'little') == data[start:start+4]
+            table['checksum_ok'] = ok
+
+        return table
+
+    def parseFrame(self, data):
+        """Parse a single frame.
+
+        :return: tuple (symbol name, dict of field label and value), (None, {}) if unknown
+        """
+
+        i_sym = -1
+        for (offset, size), (keys, indices) in self.dispatch.items():
+            if len(data) >= offset + size:
+                key = int.from_bytes(data[offset:offset+size], 'big')
+                pos = int(np.searchsorted(keys, key))
+                if pos < len(keys) and int(keys[pos]) == key:
+                    i_sym = int(indices[pos])
+                    break
+        if i_sym < 0:
+            return None, {}
+
+        fields = self.fields[i_sym]
+        unpacker = self.structs[i_sym]
+        if len(data) >= unpacker.size:
+            values = unpacker.unpack_from(data)
+        else:
+            values = [data[start:start+size] for _, start, size in fields]
+        return self.names[i_sym], {label: value for (label, _, _), value in zip(fields, values)}
@@ -8,10 +8,9 @@ from netzob.Model.Vocabulary.Messages.RawMessage import RawMessage
 from netzob.Model.Vocabulary.Messages.L2NetworkMessage import L2NetworkMessage
 
 # internal import
-from WithPayloadMessage import WithPayloadMessage
-
-# external import
-from scapy.all import Ether, IP, IPv6, IPv46, load_layer
+from MessageStore import MappedMessage
+from Profiler import profiler
+from WithPayloadMessage import WithPayloadMessage, loadLayers
 
 
 class PayloadFinder(object):
@@ -24,9 +23,19 @@ class PayloadFinder(object):
     """
     # TODO example usage above
 
-    def __init__(self, known_IPs=set(), known_MACs=set()):
-        self.known_IPs = known_IPs
-        self.known_MACs = known_MACs
+    separator = 0.2
+    """Share of the message sizes considered "small" when looking for payload offset candidates,
+    see _offsetCandidates()."""
+
+    msgs_to_test = 50
+    """Number of messages without any payload found after which testing an offset stops, see
+    _testOffsets()."""
+
+    def __init__(self, known_IPs=None, known_MACs=None):
+        # sets of their own, a shared default would leak addresses between finders
+        self.known_IPs = known_IPs if known_IPs is not None else set()
+        self.known_MACs = known_MACs if known_MACs is not None else set()
+        self.known_offsets = {} # offset: number of findPayload() runs it was found in
         pass
 
     @typeCheck(list, float)
@@ -66,10 +75,9 @@ class PayloadFinder(object):
     def _testOffsets(self, offsets, messages, msgsToTest=50, debug=False, omit_ether=False):
         # TODO A description would be great
 
-        load_layer("http")
-        load_layer("dns")
-        load_layer("tls")
-        load_layer("dhcp")
+        loadLayers()
+        # external import
+        from scapy.all import Ether, IP, IPv6, IPv46
 
         def runTest(msgs, protos):
             """Try for all given messages if any protocol included in protos can be found.
@@ -138,10 +146,12 @@ class PayloadFinder(object):
                         if offset > len(m.data)-40: # at least 40 bytes of IPv6 Header
                             break # next message please!
                         packet = IPv46(m.data[offset:])
+                        profiler.count('dissections')
                     else:
                         if offset > len(m.data)-14: # at least 14 bytes of Ethernet Header
                             break # next message please!
                         packet = Ether(m.data[offset:])
+                        profiler.count('dissections')
 
                     if tryAndStore(packet):
                         offsets[offset]+=1
@@ -162,10 +172,12 @@ class PayloadFinder(object):
                                 if offset > len(m.data)-40: # at least 40 bytes of IPv6 Header
                                     break # next message please!
                                 packet = IPv46(m.data[offset:])
+                                profiler.count('dissections')
                             else:
                                 if offset > len(m.data)-14: # at least 14 bytes of Ethernet Header
                                     break # next message please!
                                 packet = Ether(m.data[offset:])
+                                profiler.count('dissections')
 
                             if tryAndStore(packet):
                                 offsets[offset] = 1
@@ -196,23 +208,27 @@ class PayloadFinder(object):
         # try offsets for all messages to find payload, remember messages without payload 
         if debug:
             print("\nTesting possible offsets for payloads...")
-        nopayload = runTest(messages, [DNS, HTTP, TLS, DHCP])
+        with profiler.step('runTest DNS,HTTP,TLS,DHCP', len(messages)):
+            nopayload = runTest(messages, [DNS, HTTP, TLS, DHCP])
 
         # try messages without payload again, now for layer3 with known IPs
-        nopayload = runTest(nopayload, [IP, IPv6])
+        with profiler.step('runTest IP,IPv6', len(nopayload)):
+            nopayload = runTest(nopayload, [IP, IPv6])
 
         # try messages without payload again, now for layer2 with known MACs
         if not omit_ether:
-            nopayload = runTest(nopayload, [Ether])
+            with profiler.step('runTest Ether', len(nopayload)):
+                nopayload = runTest(nopayload, [Ether])
 
         # most used offset first on next run
         offsets = sortOffsets(offsets, clean=True)
 
         # try all messages again, now for layer2 with known MACs only
-        if omit_ether:
-            nopayload = runTest(messages, [IP, IPv6])
-        else:
-            nopayload = runTest(messages, [Ether])
+        with profiler.step('runTest again', len(messages)):
+            if omit_ether:
+                nopayload = runTest(messages, [IP, IPv6])
+            else:
+                nopayload = runTest(messages, [Ether])
 
         offsets = sortOffsets(offsets)
 
@@ -239,26 +255,29 @@ class PayloadFinder(object):
         """
         # TODO more explanation please!
 
+        loadLayers()
+        # external import
+        from scapy.all import Ether, IP, IPv6, IPv46
+
         parsed_messages = []
 
         for m in messages:
 
-            if isinstance(m, L2NetworkMessage):
-                new_m = WithPayloadMessage(m.data, m.date, m.l2Protocol)
-            else:
-                new_m = WithPayloadMessage(m.data, m.date)
-            new_m.metadata = m.metadata
+            data = m.data # read once, it might be stored on disk (see MessageStore)
+            found = None # (offset, packet) of the payload
 
             for offset in offsets:
 
                 if omit_ether:
-                    if offset > len(m.data)-40: # at least 40 bytes of IPv6 Header
+                    if offset > len(data)-40: # at least 40 bytes of IPv6 Header
                         break # next message please!
-                    packet = IPv46(m.data[offset:])
+                    packet = IPv46(data[offset:])
+                    profiler.count('dissections')
                 else:
-                    if offset > len(m.data)-14: # at least 14 bytes of Ethernet Header
+                    if offset > len(data)-14: # at least 14 bytes of Ethernet Header
                         break # next message please!
-                    packet = Ether(m.data[offset:])
+                    packet = Ether(data[offset:])
+                    profiler.count('dissections')
 
                 offset_is_fine = False
 
@@ -277,15 +296,28 @@ class PayloadFinder(object):
                         offset_is_fine = True
 
                 if offset_is_fine: # parsing seems to be fine
-
-                    new_m.payload = packet # store parsed scapy packet
-                    new_m.payload_data = m.data[offset:] # store bytes
-                    new_m.data = m.data[:offset] # cut off payload for good
-
+                    found = (offset, packet)
                     break # offset found, stop trying others
                 else:
                     continue # try another offsets
 
+            # messages in a MessageStore keep their bytes there, the payload is dissected again
+            # when accessed instead of keeping the scapy packet in memory
+            new_m = None
+            if isinstance(m, MappedMessage):
+                new_m = m.cut(found[0], type(found[1])) if found else m.cut()
+            if new_m is None:
+                if isinstance(m, L2NetworkMessage):
+                    new_m = WithPayloadMessage(data, m.date, m.l2Protocol)
+                else:
+                    new_m = WithPayloadMessage(data, m.date)
+                new_m.metadata = m.metadata
+                if found:
+                    offset, packet = found
+                    new_m.payload = packet # store parsed scapy packet
+                    new_m.payload_data = data[offset:] # store bytes
+                    new_m.data = data[:offset] # cut off payload for good
+
             parsed_messages.append(new_m)
 
         return parsed_messages
@@ -304,22 +336,38 @@ class PayloadFinder(object):
         return
 
     @typeCheck(list)
-    def findPayload(self, messages, separator=0.2, debug=False, omit_ether=False):
+    def findPayload(self, messages, separator=None, debug=False, omit_ether=False):
         """This method returns the list of messages with reduced payload if known protocols were
         found in the old payload.
+
+        :param separator: see _offsetCandidates(), defaults to self.separator
         """
         # TODO examples
 
+        if separator is None:
+            separator = self.separator
+
         # create a list of candidate payload offsets and test messages based on message sizes
-        candidates, testMessages = self._offsetCandidates(messages, separator)
+        with profiler.step('_offsetCandidates', len(messages)):
+            candidates, testMessages = self._offsetCandidates(messages, separator)
+
+        # offsets found in previous runs are good candidates as well
+        for offset in self.known_offsets:
+            candidates.setdefault(offset, 0)
 
         # find payload offsets by trying the candidates on message set
-        offsets = self._testOffsets(offsets=candidates, \
-                                    messages=testMessages, \
-                                    debug=debug, \
-                                    omit_ether=omit_ether)
+        with profiler.step('_testOffsets', len(testMessages)):
+            offsets = self._testOffsets(offsets=candidates, \
+                                        messages=testMessages, \
+                                        msgsToTest=self.msgs_to_test, \
+                                        debug=debug, \
+                                        omit_ether=omit_ether)
 
         # cutoff payloads and parse their contents
-        parsed_messages = self._parsePayloads(messages, offsets, omit_ether)
+        with profiler.step('_parsePayloads', len(messages)):
+            parsed_messages = self._parsePayloads(messages, offsets, omit_ether)
+
+        for offset in offsets:
+            self.known_offsets[offset] = self.known_offsets.get(offset, 0) + 1
 
         return parsed_messages
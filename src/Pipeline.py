@@ -0,0 +1,243 @@
+# system import
+import atexit
+from shutil import rmtree
+from tempfile import mkdtemp
+from time import time
+
+# internal import
+from Checkpoint import Checkpoint
+from FeatureExtraction import FeatureExtraction
+from MessageStore import isMapped, messageBytes, messageCount, spillMessages, storePath
+from PayloadFinder import PayloadFinder
+from Profiler import profiler
+from Sampler import StratifiedSampler
+from stages import STAGES
+from utils import import_messages
+
+
+PARAMETERS = {
+    'separator': PayloadFinder,
+    'msgs_to_test': PayloadFinder,
+    'seq_equal_msb': FeatureExtraction,
+    'seq_equal': FeatureExtraction,
+    'seq_decrease': FeatureExtraction,
+}
+"""Tunable thresholds of the heuristics and the class defining them and their defaults."""
+
+
+class Pipeline(object):
+    """Runs the analysis of l2pre as a sequence of explicit stages. The output of every stage is
+    handed over to the next one and - if a work directory is given - stored as checkpoint, so that
+    an interrupted analysis can be resumed or only a part of the stages can be rerun.
+
+    >>> pipeline = Pipeline(files, work_dir='work')
+    >>> cluster = pipeline.run(resume=True)
+    """
+
+    def __init__(self, files, layer=1, no_tunnel=False, work_dir=None, memory_limit=None,
+                 sample_size=None, parameters=None):
+        """
+        :param work_dir: directory to store checkpoints in, no checkpoints are stored if None
+        :param memory_limit: maximum size of message data in MiB to keep in memory, message data
+        is moved to disk-backed storage if it grows bigger
+        :param sample_size: infer the format on a stratified sample of this size per capture and
+        assign all messages afterwards
+        :param parameters: dict overriding the defaults of the thresholds in PARAMETERS
+        """
+        self.files = files
+        self.layer = layer
+        self.no_tunnel = no_tunnel
+        self.work_dir = work_dir
+        self.memory_limit = memory_limit
+        self.features = FeatureExtraction([])
+        self.finder = PayloadFinder() # kept over several runs to reuse known IPs, MACs and offsets
+        self.timings = {} # stage: runtime in seconds
+
+        self.parameters = dict(parameters or {})
+        for name, value in self.parameters.items():
+            if name not in PARAMETERS:
+                raise ValueError("Unknown parameter '{}', use one of {}".format(
+                    name, list(PARAMETERS)))
+            owner = self.finder if PARAMETERS[name] is PayloadFinder else self.features
+            setattr(owner, name, value)
+
+        self.sampler = None
+        self.sample_report = None
+        self.full_messages_list = None
+        if sample_size:
+            self.sampler = StratifiedSampler(sample_size)
+
+        self.checkpoint = None
+        if work_dir:
+            manifest = {'files': list(files), 'layer': layer, 'no_tunnel': no_tunnel,
+                        'sample_size': sample_size, 'parameters': self.parameters}
+            self.checkpoint = Checkpoint(work_dir, STAGES, manifest)
+
+        self._stage_functions = {
+            'import': self._importStage,
+            'payload': self._payloadStage,
+            'address': self._addressStage,
+            'cluster': self.features.clusterByType,
+            'seq': self.features.findSequences,
+            'context': self.features.mergeContexts,
+            'dedup': self.features.deduplicate,
+        }
+
+    def _importStage(self, messages_list):
+        # messages might have been imported by the caller already
+        if messages_list is not None:
+            return messages_list
+        print("\nImport PCAP files...")
+        # each item on list contains the messages of one file
+        return import_messages(self.files, importLayer=self.layer)
+
+    def _sample(self, messages_list):
+        """Keep all imported messages for classification and continue with a sample only."""
+        self.full_messages_list = messages_list
+        print("\nDraw stratified sample of at most {} messages per capture...".format(
+            self.sampler.sample_size))
+        return [self.sampler.sample(msgs) for msgs in messages_list]
+
+    def _classifyFull(self, cluster):
+        """Assign all imported messages to the symbols inferred on the sample."""
+
+        full_messages_list = self.full_messages_list
+        if full_messages_list is None:
+            if self.checkpoint is None or 'import' not in self.checkpoint.completed():
+                print("\nAll messages are unavailable, skip classification of the capture.")
+                return
+            full_messages_list = self.checkpoint.load('import')
+
+        print("\nAssign all messages to inferred symbols...")
+        with profiler.step('classify',
+                           messageCount(full_messages_list) if profiler.enabled else None):
+            self.sample_report = self.sampler.classify(cluster, full_messages_list)
+        self.sampler.printReport(self.sample_report)
+
+    def _payloadStage(self, messages_list):
+        print("\nTry to find and cut off payloads with known protocols...")
+        messages_list_without_payload = []
+        for msgs in messages_list:
+            messages_list_without_payload.append(
+                    self.finder.findPayload(msgs, omit_ether=self.no_tunnel))
+        return messages_list_without_payload
+
+    def _addressStage(self, messages_list):
+        print("\nStart feature detection...")
+        print("\n> Find basic features in messages (Address, SEQ and Checksum fields)...")
+        return self.features.findAddresses(messages_list)
+
+    def _spillIfNeeded(self, stage, state):
+        """Move message data of state to disk if it exceeds the memory limit. The messages of the
+        payload stage still refer to the bytes of the imported messages in their store (see
+        MappedMessage.cut()), they are moved to a store of their own if the imported messages are
+        kept for the classification, as later stages change message data in place.
+        """
+
+        if self.memory_limit is None:
+            return state
+
+        size = messageBytes(state)
+        if size > self.memory_limit * 2**20:
+            reason = "Message data ({:.1f} MiB) exceeds memory limit".format(size / 2**20)
+        elif stage == 'payload' and self.full_messages_list is not None and isMapped(state):
+            reason = "Message data is shared with all imported messages"
+        else:
+            return state
+
+        if self.work_dir is None:
+            self.work_dir = mkdtemp(prefix='l2pre_')
+            # the stores are mapped as long as the messages are used
+            atexit.register(rmtree, self.work_dir, True)
+        path = storePath(self.work_dir, stage)
+        print("\n{}, moving it to '{}'...".format(reason, path))
+        return spillMessages(state, path)
+
+    def inferenceRuntime(self):
+        """Return runtime of all stages run so far, except the import."""
+        return sum(t for stage, t in self.timings.items() if stage != 'import')
+
+    def summary(self):
+        """Return description of the analysis as plain data, as stored with models and snapshots."""
+        return {
+            'files': list(self.files),
+            'layer': self.layer,
+            'no_tunnel': self.no_tunnel,
+            'runtime': self.inferenceRuntime(),
+            'timings': dict(self.timings),
+            'sample_report': self.sample_report,
+            'parameters': dict(self.parameters),
+        }
+
+    def run(self, messages_list=None, from_stage=None, to_stage=None, resume=False):
+        """Run the stages from_stage to to_stage (both included).
+
+        :param messages_list: already imported messages, the files are imported otherwise. If
+        from_stage is a later stage, the output of the stage before it instead
+        :param from_stage: first stage to run, its predecessor needs to have a checkpoint if
+        messages_list is None
+        :param to_stage: last stage to run, defaults to the last stage
+        :param resume: continue after the last stage with a checkpoint
+        :return: output of the last stage that was run
+        """
+
+        if from_stage is None:
+            from_stage = STAGES[0]
+        if to_stage is None:
+            to_stage = STAGES[-1]
+        for stage in (from_stage, to_stage):
+            if stage not in STAGES:
+                raise ValueError("Unknown stage '{}', use one of {}".format(stage, STAGES))
+
+        if self.checkpoint is None and \
+                (resume or (from_stage != STAGES[0] and messages_list is None)):
+            raise ValueError("A work directory is needed to resume or to start at a later stage")
+
+        # figure out where to start and load the state of the previous stage if needed
+        start = STAGES.index(from_stage)
+        if resume:
+            last = self.checkpoint.lastCompleted()
+            if last is not None:
+                start = max(start, STAGES.index(last) + 1)
+        if start > STAGES.index(to_stage):
+            print("\nStage '{}' already completed, loading checkpoint...".format(to_stage))
+            state = self.checkpoint.load(to_stage)
+            if self.sampler is not None and to_stage == STAGES[-1]:
+                self._classifyFull(state)
+            return state
+
+        state = messages_list
+        if start > 0 and (messages_list is None or start != STAGES.index(from_stage)):
+            previous = STAGES[start-1]
+            if previous not in self.checkpoint.completed():
+                raise ValueError("No checkpoint of stage '{}' found in {}, can not start at "
+                                 "stage '{}'".format(previous, self.checkpoint.work_dir,
+                                                     STAGES[start]))
+            print("\nResume after stage '{}'...".format(previous))
+            state = self._spillIfNeeded(previous, self.checkpoint.load(previous))
+
+        # the output of the import holds all messages, continue with the sample as in a full run
+        if start == 1 and self.sampler is not None:
+            state = self._sample(state)
+
+        for stage in STAGES[start:STAGES.index(to_stage)+1]:
+            stage_start_time = time()
+            with profiler.step(stage, messageCount(state) if profiler.enabled else None):
+                state = self._stage_functions[stage](state)
+            self.timings[stage] = time() - stage_start_time
+
+            if self.checkpoint is not None:
+                self.checkpoint.save(stage, state)
+
+            # message sets are complete after these stages, later stages only rearrange them
+            if stage in ('import', 'payload'):
+                state = self._spillIfNeeded(stage, state)
+
+            # the checkpoint of the import keeps all messages, the following stages only the sample
+            if stage == 'import' and self.sampler is not None:
+                state = self._sample(state)
+
+        if self.sampler is not None and to_stage == STAGES[-1]:
+            self._classifyFull(state)
+
+        return state
@@ -0,0 +1,169 @@
+# system import
+import cProfile
+from contextlib import contextmanager
+import json
+from os import sysconf
+from resource import getrusage, RUSAGE_SELF
+from time import perf_counter, process_time
+import tracemalloc
+
+
+def currentRSS():
+    """Return the current resident set size of the process in MiB, None if it is not available
+    (only Linux provides /proc/self/statm).
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, ValueError, IndexError):
+        return None
+    return pages * sysconf('SC_PAGE_SIZE') / 2**20
+
+
+class Profiler(object):
+    """Records wall time, CPU time, number of messages, counted events (e.g. scapy dissections)
+    and memory of the stages of an analysis and their steps. The resident set size is read on
+    entry and exit of every step, its change is the memory a step keeps (or frees) and the size on
+    exit is what the process holds after the step, as opposed to ru_maxrss which only grows over
+    the lifetime of the process. Steps are nested, a step is recorded
+    under the path of the steps it is run in (e.g. 'payload/runTest DNS,HTTP,TLS,DHCP'), repeated
+    steps are summed up. Disabled, step() and count() do nothing.
+
+    >>> profiler.enable(trace_memory=True)
+    >>> with profiler.step('payload', len(messages)):
+    ...     profiler.count('dissections')
+    >>> profiler.write('profile.json')
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.trace_memory = False
+        self.records = {} # path: dict with the sums of all runs of the step
+        self.counters = {} # name: number of events counted so far
+        self._stack = [] # [name, peak of Python allocations] of the running steps
+        self._cprofile = None
+
+    def enable(self, trace_memory=False, cprofile=False):
+        """Start recording.
+
+        :param trace_memory: record the peak of Python allocations per step with tracemalloc,
+        which slows down the analysis noticeably. The peak resident set size of the process is
+        recorded anyway, like the resident set size on entry and exit of each step
+        :param cprofile: run cProfile as well, see dumpStats()
+        """
+        self.enabled = True
+        self.trace_memory = trace_memory
+        if trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if cprofile:
+            self._cprofile = cProfile.Profile()
+            self._cprofile.enable()
+
+    def reset(self):
+        """Drop all records, e.g. between several analyses in one process."""
+        self.records = {}
+        self.counters = {}
+
+    def count(self, name, n=1):
+        """Count n events of name in the running steps."""
+        if self.enabled:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def step(self, name, messages=None):
+        """Record the code run in this context as step name.
+
+        :param messages: number of messages the step works on
+        """
+
+        if not self.enabled:
+            yield
+            return
+
+        path = '/'.join([frame[0] for frame in self._stack] + [name])
+        # created on entry, so that steps are ordered by their first start
+        record = self.records.setdefault(path, {'calls': 0, 'wall': 0.0, 'cpu': 0.0,
+                                                'messages': 0, 'peak_mib': None,
+                                                'rss_exit_mib': None, 'rss_delta_mib': None})
+        frame = [name, 0]
+        if self.trace_memory:
+            # remember the peak of the enclosing step before measuring this one
+            if self._stack:
+                self._stack[-1][1] = max(self._stack[-1][1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+        self._stack.append(frame)
+        counters = dict(self.counters)
+        rss_start = currentRSS()
+        start = perf_counter()
+        cpu_start = process_time()
+        try:
+            yield
+        finally:
+            wall = perf_counter() - start
+            cpu = process_time() - cpu_start
+            self._stack.pop()
+
+            record['calls'] += 1
+            record['wall'] += wall
+            record['cpu'] += cpu
+            record['messages'] += messages or 0
+            for counter, value in self.counters.items():
+                delta = value - counters.get(counter, 0)
+                if delta:
+                    record[counter] = record.get(counter, 0) + delta
+            rss = currentRSS()
+            if rss is not None and rss_start is not None:
+                record['rss_exit_mib'] = max(record['rss_exit_mib'] or 0, rss)
+                record['rss_delta_mib'] = (record['rss_delta_mib'] or 0) + rss - rss_start
+            if self.trace_memory:
+                peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+                record['peak_mib'] = max(record['peak_mib'] or 0, peak / 2**20)
+                if self._stack:
+                    self._stack[-1][1] = max(self._stack[-1][1], peak)
+
+    def report(self):
+        """Return the records as plain data, steps in the order they were started first. rss_mib is
+        the peak resident set size of the process.
+        """
+        return {
+            'trace_memory': self.trace_memory,
+            # ru_maxrss is in KiB on Linux
+            'rss_mib': getrusage(RUSAGE_SELF).ru_maxrss / 1024,
+            'steps': [dict(record, step=path) for path, record in self.records.items()],
+        }
+
+    def write(self, path):
+        """Write report() to path as JSON."""
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+    def dumpStats(self, path):
+        """Stop cProfile and write its statistics to path, to be read with pstats."""
+        if self._cprofile is not None:
+            self._cprofile.disable()
+            self._cprofile.dump_stats(path)
+
+    def printReport(self):
+        """Print the records as table."""
+
+        counters = sorted({name for record in self.records.values() for name in record} -
+                          {'calls', 'wall', 'cpu', 'messages', 'peak_mib', 'rss_exit_mib',
+                           'rss_delta_mib'})
+        print("\n{:<45} {:>6} {:>9} {:>9} {:>9}".format("Step", "calls", "wall [s]", "CPU [s]",
+                                                       "messages") +
+              "".join(" {:>11}".format(name) for name in counters) +
+              (" {:>9}".format("peak MiB") if self.trace_memory else "") +
+              " {:>9} {:>9}".format("RSS MiB", "RSS +MiB"))
+        for path, record in self.records.items():
+            depth = path.count('/')
+            name = "  " * depth + path.rsplit('/', 1)[-1]
+            print("{:<45} {:>6} {:9.3f} {:9.3f} {:>9}".format(
+                    name[:45], record['calls'], record['wall'], record['cpu'], record['messages']) +
+                  "".join(" {:>11}".format(record.get(counter, 0)) for counter in counters) +
+                  (" {:9.1f}".format(record['peak_mib']) if self.trace_memory else "") +
+                  "".join(" {:9.1f}".format(record[key]) if record[key] is not None
+                          else " {:>9}".format("-") for key in ('rss_exit_mib', 'rss_delta_mib')))
+
+
+profiler = Profiler()
+"""Profiler shared by all modules, enabled by l2pre.py --profile."""
@@ -0,0 +1,234 @@
+# system import
+from math import log2
+from random import Random
+
+# internal import
+from FeatureExtraction import FeatureExtraction
+from utils import fieldOffsets
+
+
+class StratifiedSampler(object):
+    """Draws a representative sample of messages, so that the format can be inferred on the sample
+    instead of the whole capture. The messages are stratified by source address, frame type and
+    size. Every source gets at least min_per_source messages per frame type (if available), as the
+    sequence detection needs enough messages per source, the rest of the sample is allocated
+    proportionally to the size of the strata. After inference, classify() assigns all messages of
+    the capture to the inferred symbols and reports how much sample and capture disagree.
+
+    >>> sampler = StratifiedSampler(5000)
+    >>> sample = sampler.sample(messages)
+    """
+
+    def __init__(self, sample_size, min_per_source=50, pilot_size=2000, seed=0):
+        """
+        :param sample_size: number of messages to draw per message list
+        :param min_per_source: minimum number of messages per source and frame type
+        :param pilot_size: number of messages used to find address and frame type positions
+        :param seed: seed of the random selection within strata, for reproducible samples
+        """
+        self.sample_size = sample_size
+        self.min_per_source = min_per_source
+        self.pilot_size = pilot_size
+        self.seed = seed
+
+    def _strataPositions(self, messages):
+        """Find byte positions of the source address and the frame type field on an evenly spaced
+        pilot sample, using the same rules as the actual analysis.
+
+        :return: tuple ((start, end) of source address, (start, end) of frame type), both None if
+        no address was found
+        """
+
+        step = max(1, len(messages) // self.pilot_size)
+        pilot = list(messages[::step])
+        try:
+            symbol = FeatureExtraction([]).findAddresses([pilot])[0]
+        except ValueError:
+            return None, None
+
+        addr_pos = [(start, end) for field, start, end in fieldOffsets(symbol)
+                    if field.name == "Address"]
+        type_pos = [(start, end) for field, start, end in fieldOffsets(symbol)
+                    if field.name == "Field"]
+
+        # second address is assumed to be the source, see FeatureExtraction._seqEx()
+        src_pos = addr_pos[1] if len(addr_pos) > 1 else addr_pos[0]
+        return src_pos, type_pos[0] if type_pos else None
+
+    def sample(self, messages):
+        """Return a stratified sample of messages, keeping their original order.
+
+        :param messages: list of messages
+        :type list:
+        :return: list of sampled messages
+        """
+
+        if len(messages) <= self.sample_size:
+            return list(messages)
+
+        src_pos, type_pos = self._strataPositions(messages)
+
+        # sort message indices into strata {(source, frame type, size bucket): [indices]}
+        strata = {}
+        for i, m in enumerate(messages):
+            data = m.data
+            src = data[src_pos[0]:src_pos[1]] if src_pos else None
+            frame_type = data[type_pos[0]:type_pos[1]] if type_pos else None
+            size_bucket = int(log2(len(data))) if data else 0
+            strata.setdefault((src, frame_type, size_bucket), []).append(i)
+
+        rand = Random(self.seed)
+        chosen = set()
+
+        # guarantee min_per_source messages per source and frame type, taken from its strata
+        by_source = {}
+        for key, indices in strata.items():
+            by_source.setdefault(key[:2], []).extend(indices)
+        for indices in by_source.values():
+            if len(indices) <= self.min_per_source:
+                chosen.update(indices)
+            else:
+                chosen.update(rand.sample(indices, self.min_per_source))
+
+        # allocate the remaining sample proportionally to the strata sizes
+        remaining = self.sample_size - len(chosen)
+        if remaining > 0:
+            for indices in strata.values():
+                candidates = [i for i in indices if i not in chosen]
+                quota = round(remaining * len(indices) / len(messages))
+                chosen.update(rand.sample(candidates, min(quota, len(candidates))))
+
+        return [messages[i] for i in sorted(chosen)]
+
+    @staticmethod
+    def _fixedFields(symbol):
+        """Return the fields of symbol that have the same value in all of its messages as list of
+        (start, end, value). Only fields up to the first field of variable size are considered, as
+        the positions of the fields behind it are not known without parsing.
+        """
+
+        fixed = []
+        for field, start, end in fieldOffsets(symbol):
+            values = {m.data[start:end] for m in symbol.messages}
+            if len(values) == 1:
+                value = values.pop()
+                if len(value) == end - start:
+                    fixed.append((start, end, value))
+            min_size, max_size = field.domain.dataType.size
+            if min_size != max_size:
+                break
+        return fixed
+
+    @staticmethod
+    def _choose(data, candidates):
+        """Choose the symbol for data among symbols sharing its frame type (e.g. symbols split by
+        context), by the values of their other fixed fields.
+
+        :param candidates: list of (symbol, fixed fields) as returned by _fixedFields()
+        :return: tuple (symbol, whether another symbol fits data as well)
+        """
+
+        scores = []
+        for symbol, fixed in candidates:
+            matching = sum(data[start:end] == value for start, end, value in fixed)
+            # symbols whose fixed fields all match first, the more specific one of those
+            scores.append((matching == len(fixed), matching))
+        best = max(scores)
+        return candidates[scores.index(best)][0], scores.count(best) > 1
+
+    def classify(self, cluster, messages_list):
+        """Assign all messages to the inferred symbols by their frame type and store them in
+        symbol.assigned_messages. Symbols sharing a frame type (e.g. symbols split by context) are
+        told apart by the values of their other fixed fields, messages fitting several of them
+        equally well are ambiguous and assigned to the first one. Messages of unknown frame type or
+        shorter than the fixed part of the symbol's format disagree with the model inferred on the
+        sample.
+
+        :param cluster: list of inferred symbols
+        :param messages_list: list of lists with all messages of the captures
+        :return: dict with the classification report
+        """
+
+        # dispatch table {(type start, type end): {type value: [symbols]}}
+        dispatch = {}
+        min_sizes = {}
+        sample_cnt = {}
+        for symbol in cluster:
+            symbol.assigned_messages = []
+            min_sizes[symbol.name] = sum(int(f.domain.dataType.size[0]/8) for f in symbol.fields)
+            sample_cnt[symbol.name] = len(getattr(symbol, 'orig_messages', symbol.messages))
+            for field, start, end in fieldOffsets(symbol):
+                if field.name == "Frame_type":
+                    value = symbol.messages[0].data[start:end]
+                    dispatch.setdefault((start, end), {}).setdefault(value, []).append(symbol)
+                    break
+
+        # symbols sharing a frame type are chosen by their fixed fields, see _choose()
+        shared = {}
+        for symbols in dispatch.values():
+            for value, candidates in symbols.items():
+                if len(candidates) > 1:
+                    symbols[value] = [(symbol, self._fixedFields(symbol)) for symbol in candidates]
+                    shared[value.hex()] = [symbol.name for symbol in candidates]
+                else:
+                    symbols[value] = [(candidates[0], None)]
+
+        total = unknown = too_short = ambiguous = 0
+        for messages in messages_list:
+            for m in messages:
+                total += 1
+                data = m.data
+                symbol = None
+                for (start, end), symbols in dispatch.items():
+                    candidates = symbols.get(data[start:end])
+                    if candidates is not None:
+                        break
+                else:
+                    unknown += 1
+                    continue
+                if len(candidates) == 1:
+                    symbol = candidates[0][0]
+                else:
+                    symbol, tied = self._choose(data, candidates)
+                    ambiguous += tied
+                if len(data) < min_sizes[symbol.name]:
+                    too_short += 1
+                symbol.assigned_messages.append(m)
+
+        # compare share of frame types within the sample and within the whole capture
+        sample_total = sum(sample_cnt.values())
+        distance = 0.0
+        for symbol in cluster:
+            sample_share = sample_cnt[symbol.name] / sample_total if sample_total else 0.0
+            full_share = len(symbol.assigned_messages) / total if total else 0.0
+            distance += abs(sample_share - full_share) / 2
+
+        return {
+            'total': total,
+            'sampled': sample_total,
+            'unknown_type': unknown,
+            'too_short': too_short,
+            'ambiguous': ambiguous,
+            'shared_types': shared,
+            'type_distribution_distance': distance,
+        }
+
+    @staticmethod
+    def printReport(report):
+        """Print a classification report returned by classify()."""
+
+        total = report['total'] or 1
+        print("\nInferred on {} of {} messages ({:.1%}).".format(
+            report['sampled'], report['total'], report['sampled'] / total))
+        print("Messages of unknown frame type: {} ({:.2%})".format(
+            report['unknown_type'], report['unknown_type'] / total))
+        print("Messages shorter than inferred format: {} ({:.2%})".format(
+            report['too_short'], report['too_short'] / total))
+        if report['shared_types']:
+            print("Frame types shared by several symbols: {}".format("; ".join(
+                "{} ({})".format(value, ", ".join(names))
+                for value, names in report['shared_types'].items())))
+            print("Messages fitting several symbols of their frame type: {} ({:.2%})".format(
+                report['ambiguous'], report['ambiguous'] / total))
+        print("Distance of frame type distributions (sample vs. capture): {:.3f}".format(
+            report['type_distribution_distance']))
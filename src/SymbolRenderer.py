@@ -0,0 +1,97 @@
+# system import
+from collections import Counter
+import sys
+
+# internal import
+from utils import fieldOffsets
+
+
+class SymbolRenderer(object):
+    """Renders the messages of a symbol as hex table, similar to print(symbol) with a HexaString
+    encoding function, but without netzob's alignment of every message. Messages are sliced at the
+    byte positions of the fields (see utils.fieldOffsets()), the last field takes the rest of the
+    message. Rows are written one by one to the given stream.
+
+    >>> renderer = SymbolRenderer(max_rows=30)
+    >>> renderer.render(symbol)
+    """
+
+    def __init__(self, max_rows=None, col_width=None, compact=False):
+        """
+        :param max_rows: maximum number of messages to show, all if None
+        :param col_width: maximum width of a column, longer values are cut off
+        :param compact: print a summary of the fields instead of the messages
+        """
+        self.max_rows = max_rows
+        self.col_width = col_width
+        self.compact = compact
+
+    def _rows(self, symbol, messages):
+        """Yield the field values of every message as list of hex strings."""
+        offsets = fieldOffsets(symbol)
+        for m in messages:
+            data = m.data
+            row = [data[start:end].hex() for _, start, end in offsets[:-1]]
+            row.append(data[offsets[-1][1]:].hex())
+            yield row
+
+    def _cell(self, value, width, cut=True):
+        if cut and self.col_width and len(value) > self.col_width:
+            value = value[:self.col_width-3] + '...'
+        return value.ljust(width)
+
+    def writeTable(self, header, rows, out):
+        """Write table in the style of netzob's MatrixList. rows can be an iterator, if col_width
+        is set (widths are known in advance then), it is consumed only once.
+        """
+
+        if self.col_width:
+            widths = [max(len(h), self.col_width) for h in header]
+        else:
+            rows = list(rows)
+            widths = [len(h) for h in header]
+            for row in rows:
+                widths = [max(w, len(v)) for w, v in zip(widths, row)]
+
+        line = ' | '.join('-' * w for w in widths)
+        out.write(' | '.join(self._cell(h, w, cut=False) for h, w in zip(header, widths)) + '\n')
+        out.write(line + '\n')
+        for row in rows:
+            out.write(' | '.join(self._cell(v, w) for v, w in zip(row, widths)) + '\n')
+        out.write(line + '\n')
+
+    def _summary(self, symbol, messages, out):
+        """Write one line per field: size range, number of distinct values and most common value."""
+
+        header = ["Field", "Size", "Distinct", "Most common"]
+        columns = list(zip(*self._rows(symbol, messages))) or [()] * len(symbol.fields)
+        rows = []
+        for field, values in zip(symbol.fields, columns):
+            minsize, maxsize = (int(bits/8) for bits in field.domain.dataType.size)
+            size = str(maxsize) if minsize == maxsize else "{}-{}".format(minsize, maxsize)
+            counter = Counter(values)
+            common = repr(counter.most_common(1)[0][0]) if counter else ''
+            rows.append([field.name, size, str(len(counter)), common])
+        self.writeTable(header, rows, out)
+
+    def render(self, symbol, out=sys.stdout, messages=None):
+        """Write the table of a symbol to out.
+
+        :param symbol: symbol to render
+        :param out: stream to write to, e.g. an open file
+        :param messages: messages to render instead of symbol.messages
+        """
+
+        if messages is None:
+            messages = symbol.messages
+
+        if self.compact:
+            self._summary(symbol, messages, out)
+            return
+
+        if self.max_rows is not None:
+            messages = messages[:self.max_rows]
+
+        header = [field.name for field in symbol.fields]
+        rows = ([repr(v) for v in row] for row in self._rows(symbol, messages))
+        self.writeTable(header, rows, out)
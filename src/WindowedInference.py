@@ -0,0 +1,180 @@
+# system import
+from bisect import bisect_right
+from shutil import rmtree
+
+# internal import
+from Pipeline import Pipeline
+
+
+def symbolLayout(symbol):
+    """Return a compact description of the field layout of a symbol, e.g.
+    'Frame_type:4 Address:6 Address:6 SEQ:2 Field:0-12'.
+    """
+    layout = []
+    for field in symbol.fields:
+        minsize, maxsize = (int(bits/8) for bits in field.domain.dataType.size)
+        if minsize == maxsize:
+            layout.append("{}:{}".format(field.name, maxsize))
+        else:
+            layout.append("{}:{}-{}".format(field.name, minsize, maxsize))
+    return ' '.join(layout)
+
+
+class WindowedInference(object):
+    """Infers the protocol format separately for consecutive time windows of long-running captures
+    to detect when the format changes, e.g. because of firmware updates or channel changes. Windows
+    do not overlap, thus every message is analyzed exactly once. The payload finder is shared by
+    all windows, so that known IPs, MACs and payload offsets of earlier windows are reused. With a
+    memory limit, message data spilled to disk is removed after each window.
+
+    >>> windowed = WindowedInference(window=3600)
+    >>> timeline = windowed.execute(messages_list)
+    """
+
+    def __init__(self, window=None, adaptive=None, no_tunnel=False, memory_limit=None,
+                 sample_size=None):
+        """
+        :param window: fixed window size in seconds
+        :param adaptive: target number of messages per window, a window ends at the biggest pause
+        between messages close to this number
+        :param memory_limit: maximum size of message data in MiB to keep in memory, see Pipeline
+        :param sample_size: infer the format of each window on a stratified sample of this size per
+        capture, see Pipeline
+        """
+        if bool(window) == bool(adaptive):
+            raise ValueError("Either a fixed or an adaptive window size needs to be given")
+        self.window = window
+        self.adaptive = adaptive
+        self.pipeline = Pipeline([], no_tunnel=no_tunnel, memory_limit=memory_limit,
+                                 sample_size=sample_size)
+
+    def _boundaries(self, dates):
+        """Return list of (start, end) dates of the windows for the sorted list of dates."""
+
+        if not dates:
+            return []
+
+        if self.window:
+            boundaries = []
+            start = dates[0]
+            while start <= dates[-1]:
+                boundaries.append((start, start + self.window))
+                start += self.window
+            return boundaries
+
+        # adaptive: cut at the biggest gap within +-10% around every multiple of self.adaptive
+        boundaries = []
+        slack = max(1, self.adaptive // 10)
+        begin = 0
+        while len(dates) - begin > self.adaptive + slack:
+            low = max(begin + 1, begin + self.adaptive - slack)
+            high = begin + self.adaptive + slack
+            cut = max(range(low, high), key=lambda i: dates[i] - dates[i-1])
+            boundaries.append((dates[begin], dates[cut]))
+            begin = cut
+        boundaries.append((dates[begin], dates[-1] + 1))
+        return boundaries
+
+    def split(self, messages_list):
+        """Split messages into windows by their date.
+
+        :param messages_list: list of lists with messages (one list per capture)
+        :return: list of tuples (start, end, messages_list of the window)
+        """
+
+        dates = sorted(m.date for msgs in messages_list for m in msgs)
+        boundaries = self._boundaries(dates)
+        starts = [start for start, _ in boundaries]
+
+        # single pass over all messages, sorting each into its window
+        window_lists = [[[] for _ in messages_list] for _ in boundaries]
+        for i_list, msgs in enumerate(messages_list):
+            for m in msgs:
+                window_lists[bisect_right(starts, m.date) - 1][i_list].append(m)
+
+        windows = []
+        for (start, end), window_list in zip(boundaries, window_lists):
+            window_list = [msgs for msgs in window_list if msgs]
+            if window_list:
+                windows.append((start, end, window_list))
+        return windows
+
+    def execute(self, messages_list):
+        """Run the inference per window.
+
+        :return: list of dicts, one per window, with start, end, number of messages and a dict of
+        symbol names and their layout (empty if inference failed for this window)
+        """
+
+        timeline = []
+        windows = self.split(messages_list)
+        for i, (start, end, window_list) in enumerate(windows):
+            print("\n>> Window {}/{}: {:.0f}-{:.0f} ({} messages)".format(
+                i+1, len(windows), start, end, sum(len(msgs) for msgs in window_list)))
+            entry = {
+                'start': start,
+                'end': end,
+                'messages': sum(len(msgs) for msgs in window_list),
+                'symbols': {},
+            }
+            try:
+                cluster = self.pipeline.run(window_list)
+            except ValueError as e:
+                print("Inference failed for this window: {}".format(e))
+                entry['error'] = str(e)
+            else:
+                entry['symbols'] = {sym.name: symbolLayout(sym) for sym in cluster}
+                if self.pipeline.sample_report is not None:
+                    entry['sample_report'] = self.pipeline.sample_report
+            finally:
+                # a fresh temporary folder per window, the data of this one is not needed anymore
+                if self.pipeline.work_dir is not None:
+                    rmtree(self.pipeline.work_dir, True)
+                    self.pipeline.work_dir = None
+            timeline.append(entry)
+
+        return timeline
+
+    @staticmethod
+    def changes(timeline):
+        """Compare consecutive windows of a timeline.
+
+        :return: list of dicts describing the windows in which symbols appeared, disappeared or
+        changed their layout
+        """
+
+        changes = []
+        prev = None
+        for entry in timeline:
+            if 'error' in entry:
+                continue
+            if prev is not None:
+                added = sorted(set(entry['symbols']) - set(prev['symbols']))
+                removed = sorted(set(prev['symbols']) - set(entry['symbols']))
+                changed = {name: (prev['symbols'][name], layout)
+                           for name, layout in entry['symbols'].items()
+                           if name in prev['symbols'] and prev['symbols'][name] != layout}
+                if added or removed or changed:
+                    changes.append({
+                        'start': entry['start'],
+                        'added': added,
+                        'removed': removed,
+                        'changed': changed,
+                    })
+            prev = entry
+        return changes
+
+    @staticmethod
+    def printChanges(changes):
+        """Print the changes returned by changes()."""
+
+        if not changes:
+            print("\nThe format did not change between windows.")
+        for change in changes:
+            print("\nFormat changed in window starting at {:.0f}:".format(change['start']))
+            for name in change['added']:
+                print("  + {}".format(name))
+            for name in change['removed']:
+                print("  - {}".format(name))
+            for name, (old, new) in change['changed'].items():
+                print("  ~ {}: {} -> {}".format(name, old, new))
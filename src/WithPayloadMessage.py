@@ -1,13 +1,32 @@
 # Based on https://github.com/netzob/netzob/blob/49ee3e5e7d6dce67496afd5a75827a78be0c9f70/netzob/src/netzob/Model/Vocabulary/Messages/L3NetworkMessage.py
 
 # external import
-from scapy.all import Packet
+from scapy.packet import Packet
 
 # netzob import
 from netzob.Common.Utils.Decorators import typeCheck
 from netzob.Model.Vocabulary.Messages.L2NetworkMessage import L2NetworkMessage
 
 
+_layers_loaded = False
+
+
+def loadLayers():
+    """Load the scapy layers payloads are dissected with. Importing scapy.all takes seconds, thus
+    it is done only once a payload is searched for or dissected again.
+    """
+
+    global _layers_loaded
+    if not _layers_loaded:
+        # external import
+        from scapy.all import load_layer
+        load_layer("http")
+        load_layer("dns")
+        load_layer("tls")
+        load_layer("dhcp")
+        _layers_loaded = True
+
+
 class WithPayloadMessage(L2NetworkMessage):
     """Definition of a message with payload that can be parsed
     """
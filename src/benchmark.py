@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+
+"""
+Benchmark l2pre on synthetic captures of increasing size (see synthetic.py): run the analysis for
+each size in a fresh process, record throughput, CPU time and memory per stage and check that the
+known format of the synthetic protocol is recovered. The import time of the command line and the
+heavy dependencies is measured as well.
+"""
+
+# system import
+import argparse
+import json
+from multiprocessing import get_context
+from os import makedirs
+from os.path import abspath, dirname, exists, join
+from resource import getrusage, RUSAGE_SELF
+import subprocess
+import sys
+from tempfile import mkdtemp
+from time import strftime, time
+
+# internal import
+from synthetic import SyntheticProtocol, checkFormat, writeCapture
+
+
+IMPORTS = ['l2pre', 'Pipeline', 'PayloadFinder', 'exportFunctions', 'netzob', 'scapy.all',
+           'IPython']
+"""Modules whose import time is measured, l2pre is the command line only."""
+
+
+def importTime(module):
+    """Measure the import time of module in a fresh interpreter with -X importtime.
+
+    :return: cumulative import time in seconds, None if module can not be imported
+    """
+
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import ' + module],
+                             cwd=dirname(abspath(__file__)), stdout=subprocess.DEVNULL,
+                             stderr=subprocess.PIPE, universal_newlines=True)
+    if process.returncode != 0:
+        return None
+    # lines are 'import time: self [us] | cumulative | package', the module itself comes last
+    for line in reversed(process.stderr.splitlines()):
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == module:
+            return int(fields[1]) / 1e6
+    return None
+
+
+def importTimes():
+    """Measure the import time of IMPORTS and the runtime of 'l2pre.py --help'.
+
+    :return: dict module: seconds (None if it can not be imported)
+    """
+
+    times = {module: importTime(module) for module in IMPORTS}
+    start = time()
+    process = subprocess.run([sys.executable, 'l2pre.py', '--help'], cwd=dirname(abspath(__file__)),
+                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    times['l2pre.py --help'] = time() - start if process.returncode == 0 else None
+    return times
+
+
+def generateCaptures(work_dir, size, args):
+    """Write the synthetic captures of a benchmark run, reused if they exist already.
+
+    :return: tuple (list of paths, known format)
+    """
+
+    paths = []
+    protocols = []
+    for i_capture in range(args.captures):
+        # captures differ in the channel, which the context analysis should find
+        protocol = SyntheticProtocol(stations=args.stations, seq_size=args.seq_size,
+                                     checksum=args.checksum, channel=1 + 5 * i_capture,
+                                     seed=args.seed + i_capture)
+        path = join(work_dir, 'synthetic_{}_s{}_q{}_{}_{}.pcapng'.format(
+            size, args.stations, args.seq_size, args.checksum or 'none', i_capture))
+        if not exists(path):
+            writeCapture(path, protocol, size)
+        paths.append(path)
+        protocols.append(protocol)
+
+    return paths, protocols[0].truth()
+
+
+def runSize(job):
+    """Analyze the synthetic captures of one size, run in a fresh process.
+
+    :param job: tuple (size, paths, truth, args)
+    :return: dict with the results
+    """
+
+    size, paths, truth, args = job
+
+    # internal import
+    from Pipeline import Pipeline
+    from Profiler import profiler
+
+    profiler.reset()
+    profiler.enable(trace_memory=args.trace_memory)
+    pipeline = Pipeline(paths, layer=1, memory_limit=args.memory_limit, sample_size=args.sample)
+    start = time()
+    cluster = pipeline.run()
+    runtime = time() - start
+
+    frames = size * len(paths)
+    stages = {}
+    for step in profiler.report()['steps']:
+        stages[step['step']] = {
+            'wall': step['wall'],
+            'cpu': step['cpu'],
+            'messages': step['messages'],
+            'frames_per_s': step['messages'] / step['wall'] if step['wall'] else None,
+            'dissections': step.get('dissections', 0),
+            'peak_mib': step['peak_mib'],
+            'rss_exit_mib': step['rss_exit_mib'],
+            'rss_delta_mib': step['rss_delta_mib'],
+        }
+
+    differences = checkFormat(cluster, truth)
+    return {
+        'frames': frames,
+        'captures': len(paths),
+        'runtime': runtime,
+        'frames_per_s': frames / runtime if runtime else None,
+        'rss_mib': getrusage(RUSAGE_SELF).ru_maxrss / 1024,
+        'symbols': len(cluster),
+        'recovered': not differences,
+        'differences': differences,
+        'stages': stages,
+    }
+
+
+def _mib(value):
+    """Format a size in MiB that is None if it could not be measured."""
+    return "{:.1f}".format(value) if value is not None else "-"
+
+
+def printResults(results):
+    """Print an overview of the results of all sizes."""
+
+    print("\n{:>10} {:>10} {:>12} {:>10} {:>9}  {}".format(
+        "frames", "runtime", "frames/s", "RSS MiB", "symbols", "format"))
+    for result in results:
+        print("{:>10} {:9.2f}s {:12.0f} {:10.1f} {:>9}  {}".format(
+            result['frames'], result['runtime'], result['frames_per_s'] or 0, result['rss_mib'],
+            result['symbols'], "recovered" if result['recovered'] else
+            "DIFFERS: " + "; ".join(result['differences'])))
+
+    # slowest stages of the biggest run
+    stages = results[-1]['stages']
+    print("\nStages of the run with {} frames:".format(results[-1]['frames']))
+    for name, stage in stages.items():
+        if '/' in name:
+            continue
+        print("  {:<10} {:8.2f}s {:12.0f} frames/s {:>10} MiB RSS after the stage, {:>8} MiB "
+              "more than before".format(name, stage['wall'], stage['frames_per_s'] or 0,
+                                        _mib(stage['rss_exit_mib']), _mib(stage['rss_delta_mib'])))
+
+
+def printImportTimes(times):
+    """Print the import times measured by importTimes()."""
+
+    print("\nImport times:")
+    for module, seconds in times.items():
+        print("  {:<20} {}".format(module, "{:8.3f}s".format(seconds) if seconds is not None else
+                                   "    (not importable)"))
+
+
+def main(args):
+
+    import_times = importTimes()
+    printImportTimes(import_times)
+
+    work_dir = args.work_dir or mkdtemp(prefix='l2pre_benchmark_')
+    makedirs(work_dir, exist_ok=True)
+
+    jobs = []
+    for size in args.sizes:
+        print("Generate {} captures of {} frames in '{}'...".format(args.captures, size, work_dir))
+        paths, truth = generateCaptures(work_dir, size, args)
+        jobs.append((size, paths, truth, args))
+
+    # a fresh process per size, so that the peak memory of a run is not the one of a bigger run
+    results = []
+    with get_context('fork').Pool(1, maxtasksperchild=1) as pool:
+        for result in pool.imap(runSize, jobs):
+            results.append(result)
+            print("\n{} frames analyzed in {:.2f}s ({:.0f} frames/s), format {}.".format(
+                result['frames'], result['runtime'], result['frames_per_s'] or 0,
+                "recovered" if result['recovered'] else "differs"))
+
+    printResults(results)
+
+    makedirs('reports', exist_ok=True)
+    path = args.output or 'reports/benchmark_{}.json'.format(strftime('%Y%m%d-%H%M%S'))
+    with open(path, 'w') as f:
+        json.dump({'parameters': {'stations': args.stations, 'seq_size': args.seq_size,
+                                  'checksum': args.checksum, 'captures': args.captures,
+                                  'seed': args.seed, 'sample': args.sample,
+                                  'memory_limit': args.memory_limit},
+                   'import_times': import_times, 'results': results}, f, indent=2)
+    print("\nResults written to '{}'.".format(path))
+
+    return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Benchmark l2pre on synthetic captures")
+
+    parser.add_argument('-n', '--sizes', nargs='+', type=int, default=[1000, 10000, 100000], \
+            metavar='FRAMES', help='frames per capture of each run, defaults to 1000 10000 100000')
+    parser.add_argument('-c', '--captures', type=int, default=2, \
+            help='number of captures per run (differing in context), defaults to 2')
+    parser.add_argument('--stations', type=int, default=8, \
+            help='number of stations, defaults to 8')
+    parser.add_argument('--seq-size', type=int, choices=(1, 2), default=2, \
+            help='size of the sequence fields in bytes, defaults to 2')
+    parser.add_argument('--checksum', choices=('crc32', 'adler32'), \
+            help='append a checksum to every frame')
+    parser.add_argument('--seed', type=int, default=0, \
+            help='seed of the generator, defaults to 0')
+    parser.add_argument('-d', '--work-dir', \
+            help='directory for the generated captures (reused between runs), defaults to a ' + \
+            'temporary folder')
+    parser.add_argument('-m', '--memory-limit', type=int, metavar='MiB', \
+            help='passed to the pipeline, see l2pre.py --memory-limit')
+    parser.add_argument('-s', '--sample', type=int, metavar='N', \
+            help='passed to the pipeline, see l2pre.py --sample')
+    parser.add_argument('--trace-memory', action='store_true', \
+            help='record the peak of Python allocations per stage as well (slow)')
+    parser.add_argument('-o', '--output', metavar='JSON', \
+            help='file to write the results to, defaults to reports/benchmark_<time>.json')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+"""
+Check the dissection cache of l2pre_fms.py against live tshark: the messages of a capture are
+dissected by tshark and loaded from the cache (an entry is recorded first if there is none), and
+the dissections as well as the FMS of the inferred format have to be the same for every message.
+Without tshark, only the entry of the capture is loaded and its FMS printed, which needs
+--allow-any-version as the entry may be recorded with any version of tshark.
+
+    ./src/check_dissection_cache.py -nt --dissection-cache fixtures/dissections \
+            input/ethernet/test1.pcapng
+"""
+
+# system import
+import argparse
+from argparse import Namespace
+from statistics import mean
+import sys
+
+# internal import
+from DissectionCache import DissectionCache, captureHash, tsharkVersion
+from l2pre_fms import loadCapture, prepareMessages, scoreFMS
+from Pipeline import Pipeline
+from utils import import_messages
+
+
+def captureFMS(pcap, specimens, comparator, args):
+    """Infer the format of pcap and return the FMS of its messages in the order of the capture,
+    None for messages without score.
+    """
+
+    messages_list = import_messages([pcap], importLayer=args.layer)
+    symbols = Pipeline([pcap], layer=args.layer, no_tunnel=args.no_tunnel).run(messages_list)
+    prepareMessages(symbols, specimens)
+    scores = scoreFMS([comparator], [specimens], symbols, args.jobs)[0]
+    return [scores[m].score if m in scores else None for m in specimens.messagePool.keys()]
+
+
+def compareDissections(specimens, live, cached_specimens, cached):
+    """Return the differences between the dissections of two comparators of the same capture."""
+
+    differences = []
+    messages = zip(specimens.messagePool.values(), cached_specimens.messagePool.values())
+    for i, (m, cached_m) in enumerate(messages):
+        pm = live.parsedMessages.get(m)
+        cached_pm = cached.parsedMessages.get(cached_m)
+        if (pm is None) != (cached_pm is None):
+            differences.append("message {}: {} live, {} cached".format(
+                i, "dissected" if pm else "not dissected",
+                "dissected" if cached_pm else "not dissected"))
+        elif pm is not None:
+            if pm.getFieldSequence() != cached_pm.getFieldSequence():
+                differences.append("message {}: fields {} live, {} cached".format(
+                    i, pm.getFieldSequence(), cached_pm.getFieldSequence()))
+            if str(pm.messagetype) != str(cached_pm.messagetype):
+                differences.append("message {}: type {} live, {} cached".format(
+                    i, pm.messagetype, cached_pm.messagetype))
+    return differences
+
+
+def main(args):
+
+    tshark = tsharkVersion()
+    cache = DissectionCache(args.dissection_cache, args.allow_any_version)
+    failed = False
+    for pcap in args.files:
+        if tshark is None and cache.find(captureHash(pcap), args.layer) is None:
+            print("{}: tshark is not installed and '{}' has no dissections of it.".format(
+                pcap, args.dissection_cache))
+            failed = True
+            continue
+
+        options = dict(layer=args.layer, omit_payload=args.omit_payload,
+                       dissection_cache=args.dissection_cache,
+                       allow_any_version=args.allow_any_version)
+        cached_specimens, cached = loadCapture(pcap, Namespace(no_dissection_cache=False,
+                                                               **options))
+        cached_fms = captureFMS(pcap, cached_specimens, cached, args)
+        scored = [score for score in cached_fms if score is not None]
+        print("{}: mean FMS {:.3f} of {} messages with cached dissections".format(
+            pcap, mean(scored) if scored else 0, len(scored)))
+        if tshark is None:
+            print("{}: tshark is not installed, the comparison with live dissections is "
+                  "skipped.".format(pcap))
+            continue
+
+        specimens, live = loadCapture(pcap, Namespace(no_dissection_cache=True, **options))
+        differences = compareDissections(specimens, live, cached_specimens, cached)
+        live_fms = captureFMS(pcap, specimens, live, args)
+        differences.extend("message {}: FMS {} live, {} cached".format(i, score, cached_score)
+                           for i, (score, cached_score) in enumerate(zip(live_fms, cached_fms))
+                           if score != cached_score)
+
+        for difference in differences:
+            print("{}: {}".format(pcap, difference))
+        print("{}: {} messages compared with {}, {} differences".format(
+            pcap, len(live_fms), tshark, len(differences)))
+        failed = failed or bool(differences)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Check that the dissection cache gives the same dissections and FMS as '
+                    'live tshark.')
+
+    parser.add_argument('files', help='pcap/pcapng files to check', metavar='PCAPs', nargs='+')
+    parser.add_argument('-l', '--layer', default=1, type=int, \
+            help='Layer to import, defaults to 1 (use 2 if importing stuff in Radiotap header)')
+    parser.add_argument('-nt', '--no-tunnel', action='store_true', default=False, \
+            help='Do not look for Ethernet frames while searching for payloads')
+    parser.add_argument('-p', '--omit-payload', action='store_true', \
+            help='Ignore payload during format comparison')
+    parser.add_argument('--dissection-cache', default='fixtures/dissections', metavar='DIR', \
+            help='Directory of the dissection cache, an entry is recorded if there is none yet, ' + \
+            'defaults to fixtures/dissections')
+    parser.add_argument('--allow-any-version', action='store_true', \
+            help='Without tshark installed, use dissections recorded with any version of tshark')
+    parser.add_argument('-j', '--jobs', type=int, default=1, metavar='N', \
+            help='Number of processes calculating the FMS, defaults to 1')
+
+    args = parser.parse_args()
+
+    sys.exit(main(args))
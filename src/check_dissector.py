@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+
+"""
+Check the Wireshark dissector generated for a model saved with --save-model: the Lua source is
+executed (with lupa) against a minimal mock of Wireshark's Lua API, every message of the model is
+dissected and the symbol and field ranges found by the dissector are compared with the model.
+With --checksum, crc32 and adler32 fields are validated as well and a frame with a broken checksum
+has to be reported. Neither Wireshark nor netzob are needed.
+
+    ./src/check_dissector.py --checksum fixtures/models/synthetic
+"""
+
+# system import
+import argparse
+import json
+from os.path import join
+import sys
+
+# external import
+import numpy as np
+
+# internal import
+from exportWireshark import luaDissector, protoFieldNames
+
+
+LUA_WIRESHARK = '''
+bit = {
+    band = function(a, b) return (a & b) & 0xFFFFFFFF end,
+    bxor = function(a, b) return (a ~ b) & 0xFFFFFFFF end,
+    rshift = function(a, n) return (a & 0xFFFFFFFF) >> n end,
+}
+expert = { group = { CHECKSUM = 1 }, severity = { WARN = 1 } }
+ProtoExpert = { new = function(abbr, text) return { abbr = abbr, text = text } end }
+ProtoField = { bytes = function(abbr, name) return { abbr = abbr, name = name } end }
+wtap = { USER0 = 45 }
+Pref = { bool = function(label, default, descr) return default end }
+
+registered = nil
+heuristics = {}
+DissectorTable = { get = function(name)
+    return { add = function(self, key, proto) registered = proto end }
+end }
+
+function Proto(name, desc)
+    return { name = name, desc = desc, prefs = {},
+             register_heuristic = function(self, list, fn) table.insert(heuristics, fn) end }
+end
+
+local ByteArray = {}
+ByteArray.__index = ByteArray
+function ByteArray:get_index(i) return self.s:byte(i + 1) end
+ByteArray.__tostring = function(self)
+    return (self.s:gsub('.', function(c) return string.format('%02X', c:byte()) end))
+end
+
+local Tvb = {}
+Tvb.__index = Tvb
+local function newTvb(s, offset, length)
+    return setmetatable({ s = s, offset = offset, length = length }, Tvb)
+end
+function Tvb:len() return self.length end
+function Tvb:range(offset, length)
+    offset = offset or 0
+    length = length or self.length - offset
+    if offset < 0 or length < 0 or offset + length > self.length then
+        error("range out of bounds")
+    end
+    return newTvb(self.s, self.offset + offset, length)
+end
+Tvb.__call = Tvb.range
+function Tvb:bytes()
+    return setmetatable({ s = self.s:sub(self.offset + 1, self.offset + self.length) }, ByteArray)
+end
+function Tvb:le_uint()
+    local value = 0
+    for i = self.length - 1, 0, -1 do
+        value = value * 256 + self.s:byte(self.offset + i + 1)
+    end
+    return value
+end
+
+local result
+local Item = {}
+Item.__index = Item
+function Item:add(field, range, label)
+    if field.abbr then
+        table.insert(result.items, { field.abbr, range.offset,
+                                     range.s:sub(range.offset + 1, range.offset + range.length) })
+    end
+    return setmetatable({}, Item)
+end
+function Item:add_proto_expert_info(ef)
+    result.experts = result.experts + 1
+end
+
+function dissect(s)
+    result = { items = {}, experts = 0 }
+    local pinfo = { cols = {} }
+    registered.dissector(newTvb(s, 0, #s), pinfo, setmetatable({}, Item))
+    return pinfo.cols.info, result.items, result.experts
+end
+
+function claimed(s, enabled)
+    registered.prefs.heuristic = enabled
+    for _, heuristic in ipairs(heuristics) do
+        result = { items = {}, experts = 0 }
+        if heuristic(newTvb(s, 0, #s), { cols = {} }, setmetatable({}, Item)) then
+            return true
+        end
+    end
+    return false
+end
+'''
+"""Mock of the parts of Wireshark's Lua API used by the generated dissector, dissect(s) returns
+the info column, the field items as { abbr, offset, value } and the number of expert infos,
+claimed(s, enabled) whether a heuristic dissector claims s with its preference set to enabled."""
+
+
+def modelInfos(path):
+    """Read the symbols of a model (see Model.save_model()) as symbol infos like
+    exportFunctions.symbolInfo(), without netzob. Field values are sliced at the field offsets.
+    """
+
+    with open(join(path, 'model.json')) as modelfile:
+        model = json.load(modelfile)
+    index = np.load(join(path, 'messages.npz'))
+    with open(join(path, 'messages.bin'), 'rb') as f:
+        buffer = f.read()
+
+    offsets = index['offsets']
+    lengths = index['lengths']
+    refs = index['refs_messages']
+    infos = []
+    position = 0
+    for layout in model['symbols']:
+        count = layout['messages'] or 0
+        rows = []
+        for i in refs[position:position+count]:
+            data = buffer[offsets[i]:offsets[i]+lengths[i]]
+            row = [data[f['start']:f['start']+f['maxsize']] for f in layout['fields'][:-1]]
+            row.append(data[layout['fields'][-1]['start']:])
+            rows.append(row)
+        position += count
+
+        fields = []
+        for i_field, field in enumerate(layout['fields']):
+            first = rows[0][i_field] if rows else b''
+            if field['name'] == "Frame_type" and layout['frame_type'] is not None:
+                first = bytes.fromhex(layout['frame_type'])
+            fields.append({'name': field['name'], 'minsize': field['minsize'],
+                           'maxsize': field['maxsize'], 'start': field['start'],
+                           'end': field['start'] + field['maxsize'], 'first': first})
+        infos.append({'name': layout['name'], 'fields': fields, 'rows': rows})
+
+    return infos
+
+
+def _expected(info, abbrs, data):
+    """Return field items (abbr, offset, value) the dissector should show for data of info."""
+
+    items = []
+    fields = info['fields']
+    for i, field in enumerate(fields):
+        start = field['start']
+        if start >= len(data):
+            break
+        end = start + field['maxsize']
+        if (i == len(fields) - 1 and field['minsize'] != field['maxsize']) or end > len(data):
+            end = len(data)
+        if end > start:
+            items.append(('l2pre.' + abbrs[field['name']], start, data[start:end]))
+    return items
+
+
+def checkDissector(infos, validate_checksum=False):
+    """Generate the dissector of infos, dissect every message of every symbol with it and compare
+    the result with the model. The heuristic dissector has to claim every message once enabled.
+
+    :return: (number of messages dissected, list of problems found)
+    """
+
+    try:
+        from lupa import LuaRuntime
+    except ImportError:
+        raise ImportError("The dissector check needs lupa to run Lua, install it with "
+                          "'pip3 install lupa'")
+
+    source = luaDissector(infos, validate_checksum=validate_checksum)
+    lua = LuaRuntime(encoding=None)
+    lua.execute(LUA_WIRESHARK)
+    lua.execute(source)
+    dissect = lua.globals().dissect
+    claimed = lua.globals().claimed
+
+    abbrs = protoFieldNames(infos)
+    problems = []
+    count = 0
+    for info in infos:
+        if not any(field['name'] == "Frame_type" for field in info['fields']):
+            print("{}: no frame type field, not dispatched by the dissector".format(info['name']))
+            continue
+        checksum = [i for i, field in enumerate(info['fields'])
+                    if field['name'] in ("crc32", "adler32")]
+        for row in info['rows']:
+            data = b''.join(row)
+            count += 1
+            name, items, experts = dissect(data)
+            name = name.decode() if name is not None else None
+            if name != info['name']:
+                problems.append("{}: message {} dissected as {}".format(info['name'], data.hex(),
+                                                                        name))
+                continue
+            found = [(item[1].decode(), item[2], item[3]) for item in items.values()]
+            expected = _expected(info, abbrs, data)
+            if found != expected:
+                problems.append("{}: message {} dissected as fields {}, expected {}".format(
+                    info['name'], data.hex(), found, expected))
+            # the heuristic dissector claims messages of the model only if it is enabled
+            if claimed(data, False) or not claimed(data, True):
+                problems.append("{}: message {} not claimed by the heuristic dissector as "
+                                "selected in its preferences".format(info['name'], data.hex()))
+            if validate_checksum and experts:
+                problems.append("{}: message {} has a bad checksum".format(info['name'],
+                                                                           data.hex()))
+
+        # the dissector needs to notice a broken checksum
+        if validate_checksum and checksum and info['rows']:
+            start = info['fields'][checksum[-1]]['start']
+            data = bytearray(b''.join(info['rows'][0]))
+            if len(data) >= start + 4:
+                data[start] ^= 0xFF
+                if dissect(bytes(data))[2] != 1:
+                    problems.append("{}: broken checksum of message {} not reported".format(
+                        info['name'], data.hex()))
+
+    return count, problems
+
+
+def main(args):
+
+    failed = False
+    for path in args.models:
+        count, problems = checkDissector(modelInfos(path), args.checksum)
+        for problem in problems:
+            print("{}: {}".format(path, problem))
+        print("{}: {} messages dissected, {} problems".format(path, count, len(problems)))
+        failed = failed or bool(problems)
+
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Check the Wireshark dissector generated for saved models by dissecting '
+                    'their messages without Wireshark.')
+
+    parser.add_argument('models', nargs='+', metavar='MODEL', \
+            help='directories of models saved with --save-model')
+    parser.add_argument('--checksum', action='store_true', \
+            help='generate the dissector with validation of crc32 and adler32 fields')
+
+    args = parser.parse_args()
+
+    sys.exit(main(args))
@@ -1,170 +1,387 @@
 # system import
-from os.path import isdir
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+import json
+import numpy as np
+from os import remove, replace
+from os.path import basename, isdir
 from shutil import copyfile
-from time import strftime
+from time import strftime, time
 
 # netzob import
-from netzob.Export.WiresharkDissector.WiresharkDissector import WiresharkDissector
 from netzob.Model.Vocabulary.Messages.L2NetworkMessage import L2NetworkMessage
 
-def exportPF(cluster):
-    """Export inferred protocol information to folder 'reports'
+# internal import
+from AlignmentCache import alignments
+from SymbolRenderer import SymbolRenderer
+from exportWireshark import luaDissector
+from ModelCompiler import ModelCompiler
+from utils import fieldOffsets, import_messages
+
+
+CHECKSUMS = ("crc32", "adler32")
+"""Names of checksum fields with a known algorithm."""
+
+MAX_VALUES = 32
+"""Maximum number of known values per field in the boofuzz template."""
+
+
+def symbolInfo(symbol, rows=False, max_values=None):
+    """Collect everything the exporters need to know about a symbol as plain data, so that every
+    symbol needs to be analyzed only once and the result can be handed over to other processes.
+
+    Field values are sliced at the field offsets. Only if there are variable-size fields in front
+    of the last field, the offsets are not exact and netzob's (cached) alignment is used instead.
+
+    :param rows: keep the field values of every message, only needed to print the messages
+    :param max_values: number of most frequent values kept per field, all if None
+    :return: dict with name, l2Protocol, number of messages, list of field dicts (name, minsize,
+    maxsize, start, end, first value, values as list of (value, count) ordered by count), rows of
+    field values (None unless requested) and the checksum algorithm if the last field is a known
+    checksum
     """
 
+    offsets = fieldOffsets(symbol)
+    sizes = [field.domain.dataType.size for field in symbol.fields]
+
+    if any(minsize != maxsize for minsize, maxsize in sizes[:-1]):
+        cells = alignments.cells(symbol)
+    else:
+        cells = []
+        for m in symbol.messages:
+            data = m.data
+            row = [data[start:end] for _, start, end in offsets[:-1]]
+            row.append(data[offsets[-1][1]:])
+            cells.append(row)
+
+    fields = []
+    for i_field, (field, start, end) in enumerate(offsets):
+        column = [row[i_field] for row in cells]
+        fields.append({
+            'name': field.name,
+            'minsize': int(sizes[i_field][0]/8),
+            'maxsize': int(sizes[i_field][1]/8),
+            'start': start,
+            'end': end,
+            'first': column[0] if column else b'',
+            'values': Counter(column).most_common(max_values),
+        })
+
+    l2Protocol = None
+    if symbol.messages and isinstance(symbol.messages[0], L2NetworkMessage):
+        l2Protocol = symbol.messages[0].l2Protocol
+
+    return {
+        'name': symbol.name,
+        'l2Protocol': l2Protocol,
+        'messages': len(symbol.messages),
+        'orig_messages': len(getattr(symbol, 'orig_messages', symbol.messages)),
+        'fields': fields,
+        'rows': cells if rows else None,
+        'checksum': fields[-1]['name'] if fields and fields[-1]['name'] in CHECKSUMS else None,
+    }
+
+
+class AtomicWriter(object):
+    """Context manager for a buffered file that only replaces path once it is written completely.
+    The temporary file is removed if writing fails.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def __enter__(self):
+        self.file = open(self.path + '.tmp', 'w', buffering=2**20)
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.file.close()
+        if exc_type is None:
+            replace(self.path + '.tmp', self.path)
+        else:
+            remove(self.path + '.tmp')
+
+
+def writePF(infos, path):
+    """Write human-readable protocol format of the symbol infos to path"""
+
     # TODO something more than simple symbol print? Regex? Some bright idea?
 
-    # create file name based on date and time
-    fname = 'protocol_format_' + strftime("%Y-%m-%d_%H%M%S") + '.txt'
+    renderer = SymbolRenderer()
 
-    # open file
-    if isdir('reports'):
-        with open('reports/' + fname, 'a+') as formatfile:
-            formatfile.write("Protocol Format")
-            for symbol in cluster:
-                formatfile.write("\n\n{}: {} unique messages\n".format(symbol.name, \
-                                                                       len(symbol.messages)))
-                formatfile.write(str(symbol))
+    with AtomicWriter(path) as formatfile:
+        formatfile.write("Protocol Format")
+        for info in infos:
+            formatfile.write("\n\n{}: {} unique messages\n".format(info['name'], info['messages']))
+            header = [field['name'] for field in info['fields']]
+            rows = ([repr(value.hex()) for value in row] for row in info['rows'])
+            renderer.writeTable(header, rows, formatfile)
 
-    print("\nProtocol format exported to \'reports/{}\'.".format(fname))
+    return path
 
-    return
 
+def fuzzValueTables(infos, max_values=MAX_VALUES):
+    """Collect the distinct values of all Address fields as value tables. Tables with the same
+    values are shared by all fields and symbols.
 
-def exportWiresharkDissector(cluster):
-    """Export a Wireshark dissector written in lua (based on netzob exporter)
+    :param max_values: maximum number of values per table, the most frequent values are kept
+    :return: tuple (dict of table name and tuple of values, dict of (symbol name, field index)
+    and table name)
     """
 
-    # create file name based on date and time
-    fname = 'wireshark_dissector_' + strftime("%Y-%m-%d_%H%M%S") + '.lua'
+    tables = {} # values: table name
+    field_tables = {}
+    for info in infos:
+        for i_field, field in enumerate(info['fields']):
+            if field['name'] != "Address" or len(field['values']) < 2:
+                continue
+            # values are ordered by frequency already
+            values = tuple(value for value, _ in field['values'][:max_values])
+            if values not in tables:
+                tables[values] = "ADDRESS_VALUES_{}".format(len(tables))
+            field_tables[(info['name'], i_field)] = tables[values]
 
-    # open file
-    if isdir('reports'):
-        WiresharkDissector.dissectSymbols(cluster,'reports/'+fname)
+    return {name: values for values, name in tables.items()}, field_tables
+
+
+def writeFuzz(infos, path, max_values=MAX_VALUES):
+    """Write boofuzz template of the symbol infos to path
+
+    :param max_values: maximum number of known values per Address field
+    """
+
+    tables, field_tables = fuzzValueTables(infos, max_values)
+
+    with AtomicWriter(path) as template:
+
+        # write import
+        template.write("from boofuzz import Request, Block, Static, Bytes, Checksum, Group\n\n")
+
+        # write value tables, shared by all requests
+        if tables:
+            template.write("# known values of fields, most frequent first\n")
+            for name, values in tables.items():
+                template.write("{} = {}\n".format(name, repr(values)))
+            template.write("\n")
+
+        # write request for each symbol
+        for info in infos:
+
+            # start request
+            template.write("{} = Request(children=(\n".format(info['name']))
+            intendation = "    "
+
+            # Add Radiotap header first, if protocol traces had one, too
+            if info['l2Protocol'] == "Radiotap":
+                radiotap = b"\x00\x00\x08\x00\x00\x00\x00\x00"
+                template.write("    Static(name=\"Radiotap\", " + \
+                               "default_value={}),\n".format(repr(radiotap)))
+
+            # look if there is a checksum at the end
+            if info['checksum']:
+                template.write(intendation + "Block(\"Fields\", children=(\n")
+                intendation += "    "
+
+            # go through all fields and write chunks
+            addr_cnt = 1
+            seq_cnt = 1
+            other_field_cnt = 1
+            for i_field, field in enumerate(info['fields']):
+
+                if field['name'] == "Frame_type":
+                    primitive = "Static"
+                    args = ["name=\"{}\"".format(field['name']),
+                            # only one possible value per symbol
+                            "default_value={!r}".format(field['first'])]
+
+                elif field['name'] == "Address":
+                    args = ["name=\"Address-{}\"".format(addr_cnt)]
+                    addr_cnt += 1
+                    table = field_tables.get((info['name'], i_field))
+                    if table is None:
+                        primitive = "Static"
+                        args.append("default_value={!r}".format(field['first']))
+                    else:
+                        primitive = "Group"
+                        args.append("values={}".format(table))
+
+                elif field['name'] == "SEQ":
+                    primitive = "Bytes"
+                    args = ["name=\"SEQ-{}\"".format(seq_cnt),
+                            "default_value={!r}".format(field['first']),
+                            "size={}".format(field['maxsize']),
+                            "fuzzable=False"]
+                    seq_cnt += 1
+
+                elif field['name'] in CHECKSUMS and field is info['fields'][-1]:
+                    break
+
+                # unknown field, fuzz it!
+                #elif field.name == "Field": TODO
+
+                # context-related field, define known values and fuzz TODO
+                else:
+                    primitive = "Bytes"
+                    # start with the most frequent value
+                    default = field['values'][0][0] if field['values'] else field['first']
+                    args = ["name=\"{}{}\"".format(field['name'], other_field_cnt),
+                            "default_value={!r}".format(default)]
+                    other_field_cnt += 1
+                    if field['minsize'] == field['maxsize']:
+                        args.append("size={}".format(field['maxsize']))
+                    else:
+                        args.append("max_len={}".format(field['maxsize']))
+
+                # write chunk
+                template.write(intendation + "{}({}),\n".format(primitive, ", ".join(args)))
+
+            if info['checksum']:
+                intendation = intendation[4:]
+                template.write(intendation + ")),\n")
+                # add Checksum field now
+                args = ["name=\"{}\"".format(field['name']),
+                        "block_name=\"Fields\"",
+                        "algorithm=\"{}\"".format(info['checksum'])]
+
+                # write checksum chunk
+                template.write(intendation + "Checksum({}),\n".format(", ".join(args)))
+
+            # close request
+            template.write("))\n\n")
+
+        # write list of all symbols for easier usage
+        template.write("frames = [\n")
+        for info in infos:
+            template.write("    " + info['name'] + ",\n")
+        template.write("]\n")
 
-    print("\nWireshark dissector exported to \'reports/{}\'.".format(fname))
+    return path
+
+
+def writeWiresharkDissector(infos, path, validate_checksum=False):
+    """Write Lua dissector of the symbol infos to path, see check_dissector.py to check it"""
+
+    source = luaDissector(infos, basename(path), validate_checksum)
+    with AtomicWriter(path) as dissector:
+        dissector.write(source)
+
+    return path
+
+
+def _select(infos, rows=False, values=False):
+    """Return copies of infos with the rows and field values only if an exporter needs them, as
+    the infos are handed over to the process of every exporter.
+    """
+    return [dict(info, rows=info['rows'] if rows else None,
+                 fields=[dict(field, values=field['values'] if values else None)
+                         for field in info['fields']])
+            for info in infos]
+
+
+def exportAll(cluster, pf=False, bf=False, ws=False, ws_checksum=False):
+    """Export the inferred protocol in all selected formats to folder 'reports'. Every symbol is
+    analyzed once (see symbolInfo()), afterwards the writers run concurrently.
+
+    :param ws_checksum: let the Wireshark dissector validate crc32 and adler32 fields
+    """
+
+    if not isdir('reports'):
+        print("\nFolder 'reports' does not exist, nothing exported.")
+        return
+
+    # create file names based on date and time
+    stamp = strftime("%Y-%m-%d_%H%M%S")
+    pf_file = 'reports/protocol_format_' + stamp + '.txt'
+    bf_file = 'reports/boofuzz_template_' + stamp + '.py'
+    ws_file = 'reports/wireshark_dissector_' + stamp + '.lua'
+
+    # only the protocol format prints every message, the other exporters need the first and the
+    # most frequent values
+    infos = [symbolInfo(symbol, rows=pf, max_values=MAX_VALUES)
+             for symbol in cluster] if pf or bf or ws else []
+
+    with ProcessPoolExecutor() as processes:
+        jobs = []
+        if pf:
+            jobs.append(("Protocol format", processes.submit(writePF, _select(infos, rows=True),
+                                                             pf_file)))
+        if bf:
+            jobs.append(("Boofuzz template", processes.submit(writeFuzz,
+                                                              _select(infos, values=True),
+                                                              bf_file)))
+        if ws:
+            jobs.append(("Wireshark dissector", processes.submit(writeWiresharkDissector,
+                                                                 _select(infos), ws_file,
+                                                                 ws_checksum)))
+
+        for title, job in jobs:
+            print("\n{} exported to \'{}\'.".format(title, job.result()))
+
+    # copy to src/boofuzz_template.py as this is imported by src/fuzz.py
+    if bf and isdir('src'):
+        copyfile(bf_file, 'src/boofuzz_template.py')
 
     return
 
 
+def exportPF(cluster):
+    """Export inferred protocol information to folder 'reports'
+    """
+    exportAll(cluster, pf=True)
+
+
+def exportWiresharkDissector(cluster):
+    """Export a Wireshark dissector written in lua
+    """
+    exportAll(cluster, ws=True)
+
+
 def exportFuzz(cluster):
     """Export a template to be used for fuzzing attempts based on inferred protocol information
     """
+    exportAll(cluster, bf=True)
 
-    # create file name based on date and time
-    new_template = 'reports/boofuzz_template_' + strftime("%Y-%m-%d_%H%M%S") + '.py'
 
-    # open file
-    if isdir('reports'):
-        with open(new_template, 'a+') as template:
+def exportLabels(cluster, files, layer=1):
+    """Label the frames of further captures with the compiled model and export the columnar
+    table of every capture as .npz file (see ModelCompiler.parse())
+    """
 
-            # write import
-            template.write("from boofuzz import Request, Block, Static, Bytes, Checksum\n\n")
+    if not isdir('reports'):
+        print("\nFolder 'reports' does not exist, nothing exported.")
+        return
 
-            # write request for each symbol
-            for symbol in cluster:
+    compiler = ModelCompiler.fromCluster(cluster)
+    stamp = strftime("%Y-%m-%d_%H%M%S")
 
-                symbol.encodingFunctions = [] # remove encoding function
+    for i_file, messages in enumerate(import_messages(files, importLayer=layer)):
+        frames = [m.data for m in messages]
+        start = time()
+        table = compiler.parse(frames, checksums=True)
+        runtime = time() - start
+        known = int((table['symbol'] >= 0).sum())
+        print("\n{}: {} of {} frames labeled ({:.0f} frames/s)".format(
+            files[i_file], known, len(frames), len(frames) / runtime if runtime else 0))
 
-                # start request
-                template.write("{} = Request(children=(\n".format(symbol.name))
-                intendation = "    "
+        fname = 'reports/labels_{}_{}.npz'.format(stamp, i_file)
+        np.savez_compressed(fname, names=np.array(compiler.names), **table)
+        print("Labels exported to \'{}\'.".format(fname))
 
-                # Add Radiotap header first, if protocol traces had one, too
-                if isinstance(symbol.messages[0], L2NetworkMessage) and \
-                        symbol.messages[0].l2Protocol == "Radiotap":
-                    radiotap = b"\x00\x00\x08\x00\x00\x00\x00\x00"
-                    template.write("    Static(name=\"Radiotap\", " + \
-                                   "default_value={}),\n".format(str(radiotap)))
+    return
 
-                # look if there is a checksum at the end
-                if symbol.fields[-1].name == "crc32" or symbol.fields[-1].name == "adler32":
-                    template.write(intendation + "Block(\"Fields\", children=(\n")
-                    intendation += "    "
 
-                # go through all fields and write chunks
-                addr_cnt = 1
-                seq_cnt = 1
-                other_field_cnt = 1
-                for field in symbol.fields:
+def exportTimeline(timeline, changes):
+    """Export per-window symbol layouts and format changes of a windowed inference as JSON
+    """
 
-                    if field.name == "Frame":
-                        primitive = "Static"
-                        args = "name=\"" + field.name + "\""
-                        # only one possible value per symbol
-                        args += ", default_value={}".format(field.getValues()[0])
-
-                    elif field.name == "Address":
-                        args = "name=\"" + "Address-" + str(addr_cnt) + "\""
-                        addr_cnt += 1
-                        values = set(field.getValues())
-                        if len(values) == 1:
-                            primitive = "Static"
-                            args += ", default_value=" + str(*values)
-                        else:
-                            primitive = "Group"
-                            args += ", values=["
-                            for val in values:
-                                args += str(val) + ", "
-                            args = args[:-1] # remove last colon
-                            args += "]"
-
-                    elif field.name == "SEQ":
-                        primitive = "Bytes"
-                        args = "name=\"" + "SEQ-" + str(seq_cnt) + "\""
-                        seq_cnt += 1
-                        args += ", default_value={}".format(field.getValues()[0])
-                        _, maxs = field.domain.dataType.size
-                        args += ", size=" + str(int(maxs/8))
-                        args += ", fuzzable=False"
-
-                    elif (field.name == "crc32" or field.name == "adler32") and \
-                            field == symbol.fields[-1]:
-                        break
-
-                    # unknown field, fuzz it!
-                    #elif field.name == "Field": TODO
-
-                    # context-related field, define known values and fuzz TODO
-                    else:
-                        primitive = "Bytes"
-                        args = "name=\"" + field.name + str(other_field_cnt) + "\""
-                        other_field_cnt += 1
-                        args += ", default_value={}".format(field.getValues()[0])
-                        mins, maxs = field.domain.dataType.size
-                        if mins == maxs:
-                            args += ", size=" + str(int(maxs/8))
-                        else:
-                            args += ", max_length=" + str(int(maxs/8))
-
-                    # write chunk
-                    template.write(intendation + "{}({}),\n".format(primitive, args))
-
-                if symbol.fields[-1].name == "crc32" or symbol.fields[-1].name == "adler32":
-                    intendation = intendation[4:]
-                    template.write(intendation + ")),\n")
-                    # add Checksum field now
-                    primitive = "Checksum"
-                    args = "name=\"" + field.name + "\""
-                    args += ", block_name=\"Fields\""
-                    args += ", algorithm=\"{}\"".format(symbol.fields[-1].name)
-
-                    # write checksum chunk
-                    template.write(intendation + "{}({}),\n".format(primitive, args))
-
-                # close request
-                template.write("))\n\n")
-
-            # write list of all symbols for easier usage
-            template.write("frames = [")
-            for symbol in cluster:
-                template.write("    " + symbol.name + ",\n")
-            template.write("]")
-
-    print("\nBoofuzz template exported to {}.".format(new_template))
+    # create file name based on date and time
+    fname = 'format_timeline_' + strftime("%Y-%m-%d_%H%M%S") + '.json'
 
-    # copy to src/boofuzz_template.py as this is imported by src/fuzz.py
-    if isdir('src'):
-        active_template = 'src/boofuzz_template.py'
-        copyfile(new_template, active_template)
+    # open file
+    if isdir('reports'):
+        with AtomicWriter('reports/' + fname) as timelinefile:
+            json.dump({'windows': timeline, 'changes': changes}, timelinefile, indent=1)
+
+    print("\nFormat timeline exported to \'reports/{}\'.".format(fname))
 
     return
@@ -0,0 +1,253 @@
+# system import
+import re
+
+
+CHECKSUM_ALGORITHMS = ("crc32", "adler32")
+"""Checksum fields that can be validated by the dissector."""
+
+
+LUA_KEYWORDS = {'and', 'break', 'do', 'else', 'elseif', 'end', 'false', 'for', 'function', 'goto',
+                'if', 'in', 'local', 'nil', 'not', 'or', 'repeat', 'return', 'then', 'true', 'until',
+                'while'}
+"""Reserved words of Lua, not usable as field abbreviation."""
+
+
+def protoFieldName(field_name):
+    """Return abbreviation of the ProtoField of a field name, e.g. 'Frame_type' -> 'frame_type'.
+    It is used as Lua identifier, thus names starting with a digit or being a keyword of Lua are
+    prefixed, e.g. '5GHz' -> 'f_5ghz'.
+    """
+    abbr = re.sub(r'[^a-z0-9_]', '_', field_name.lower()).strip('_') or 'field'
+    if abbr[0].isdigit() or abbr in LUA_KEYWORDS:
+        abbr = 'f_' + abbr
+    return abbr
+
+
+def protoFieldNames(infos):
+    """Return dict field name: unique abbreviation (see protoFieldName()) of all fields of the
+    symbol infos, different names with the same abbreviation are numbered.
+    """
+    abbrs = {}
+    for info in infos:
+        for field in info['fields']:
+            name = field['name']
+            if name in abbrs:
+                continue
+            abbr = base = protoFieldName(name)
+            i = 2
+            while abbr in abbrs.values():
+                abbr = "{}_{}".format(base, i)
+                i += 1
+            abbrs[name] = abbr
+    return abbrs
+
+
+def _frameType(info):
+    """Return (offset, size, value) of the frame type field of a symbol info, None if missing."""
+    for field in info['fields']:
+        if field['name'] == "Frame_type":
+            return field['start'], field['end'] - field['start'], field['first']
+    return None
+
+
+LUA_HEADER = '''-- Wireshark dissector of the protocol inferred by l2pre
+--
+-- Load with: wireshark -X lua_script:{filename}
+-- Frames are dissected if captured with one of link_layer_types (USER0 is DLT 147). Frames of
+-- other link-layer types are offered to the heuristic dissector by the dissectors in
+-- heuristic_lists, enable it in the preferences of l2pre (Edit > Preferences > Protocols).
+
+local link_layer_types = {{ wtap.USER0 }}
+local heuristic_lists = {{ "eth" }}
+
+local l2pre = Proto("l2pre", "Protocol inferred by l2pre")
+local bit = bit32 or bit
+
+local validate_checksum = {validate}
+
+'''
+
+LUA_FUNCTIONS = '''
+local ef_bad_checksum = ProtoExpert.new("l2pre.checksum.bad", "Bad checksum",
+                                        expert.group.CHECKSUM, expert.severity.WARN)
+l2pre.experts = { ef_bad_checksum }
+
+local crc_table = {}
+for i = 0, 255 do
+    local c = i
+    for _ = 1, 8 do
+        if bit.band(c, 1) == 1 then
+            c = bit.bxor(bit.rshift(c, 1), 0xEDB88320)
+        else
+            c = bit.rshift(c, 1)
+        end
+    end
+    crc_table[i] = c
+end
+
+local function unsigned(value)
+    if value < 0 then
+        return value + 4294967296
+    end
+    return value
+end
+
+local function crc32(bytes, len)
+    local c = 0xFFFFFFFF
+    for i = 0, len - 1 do
+        c = bit.bxor(bit.rshift(c, 8), crc_table[bit.band(bit.bxor(c, bytes:get_index(i)), 0xFF)])
+    end
+    return unsigned(bit.bxor(c, 0xFFFFFFFF))
+end
+
+local function adler32(bytes, len)
+    local a, b = 1, 0
+    for i = 0, len - 1 do
+        a = (a + bytes:get_index(i)) % 65521
+        b = (b + a) % 65521
+    end
+    return b * 65536 + a
+end
+
+local checksum_functions = { crc32 = crc32, adler32 = adler32 }
+
+l2pre.prefs.heuristic = Pref.bool("Dissect frames of other link-layer types", false,
+                                  "Claim frames of known frame type handed over by the " ..
+                                  "dissectors in heuristic_lists")
+
+-- find symbol by the value of its frame type field
+local function findSymbol(tvb)
+    local len = tvb:len()
+    for _, d in ipairs(dispatch) do
+        if len >= d.offset + d.size then
+            local symbol = d.symbols[tostring(tvb:range(d.offset, d.size):bytes()):lower()]
+            if symbol then
+                return symbol
+            end
+        end
+    end
+    return nil
+end
+
+function l2pre.dissector(tvb, pinfo, tree)
+    local len = tvb:len()
+    local symbol = findSymbol(tvb)
+
+    pinfo.cols.protocol = "l2pre"
+    if not symbol then
+        tree:add(l2pre, tvb(), "l2pre, unknown frame type")
+        return
+    end
+    pinfo.cols.info = symbol.name
+
+    local subtree = tree:add(l2pre, tvb(), "l2pre, " .. symbol.name)
+    for i, f in ipairs(symbol.fields) do
+        local pfield, offset, minsize, maxsize = f[1], f[2], f[3], f[4]
+        if offset >= len then
+            break
+        end
+        -- last field of variable size takes the rest of the frame
+        local size = maxsize
+        if (i == #symbol.fields and minsize ~= maxsize) or offset + size > len then
+            size = len - offset
+        end
+        if size > 0 then
+            local item = subtree:add(pfield, tvb(offset, size))
+            if validate_checksum and symbol.checksum_field == i and offset >= 1 and size == 4 then
+                local calculated = checksum_functions[symbol.checksum](tvb:range(0, offset):bytes(),
+                                                                        offset)
+                if calculated ~= tvb(offset, 4):le_uint() then
+                    item:add_proto_expert_info(ef_bad_checksum)
+                end
+            end
+        end
+    end
+end
+
+-- claims frames of a known frame type that reach the offset of the last field of their symbol
+local function heuristic(tvb, pinfo, tree)
+    if not l2pre.prefs.heuristic then
+        return false
+    end
+    local symbol = findSymbol(tvb)
+    if not symbol or tvb:len() < symbol.fields[#symbol.fields][2] then
+        return false
+    end
+    l2pre.dissector(tvb, pinfo, tree)
+    return true
+end
+
+local wtap_encap = DissectorTable.get("wtap_encap")
+for _, encap in ipairs(link_layer_types) do
+    wtap_encap:add(encap, l2pre)
+end
+for _, list in ipairs(heuristic_lists) do
+    l2pre:register_heuristic(list, heuristic)
+end
+'''
+
+
+def luaDissector(infos, filename='l2pre.lua', validate_checksum=False):
+    """Generate source of a Lua dissector for Wireshark from symbol infos (see
+    exportFunctions.symbolInfo()). The symbols are found by a table lookup of the value of their
+    frame type field, all field offsets are precomputed.
+
+    :param infos: list of symbol infos
+    :param filename: name of the file, used in the usage hint only
+    :param validate_checksum: generate dissector validating crc32 and adler32 fields
+    :return: source code of the dissector
+    """
+
+    lua = [LUA_HEADER.format(filename=filename, validate=str(bool(validate_checksum)).lower())]
+
+    # one ProtoField per field name, shared by all symbols
+    abbrs = protoFieldNames(infos)
+    lua.append("local pf = {\n")
+    for name, abbr in abbrs.items():
+        lua.append("    {} = ProtoField.bytes(\"l2pre.{}\", \"{}\"),\n".format(abbr, abbr, name))
+    lua.append("}\n")
+    lua.append("l2pre.fields = {{ {} }}\n\n".format(
+        ", ".join("pf." + abbr for abbr in abbrs.values())))
+
+    # symbols grouped by position of their frame type field
+    dispatch = {} # (offset, size): [infos]
+    for info in infos:
+        frame_type = _frameType(info)
+        if frame_type is None:
+            continue
+        offset, size, _ = frame_type
+        dispatch.setdefault((offset, size), []).append(info)
+
+    lua.append("-- symbols by frame type: fields as { ProtoField, offset, minsize, maxsize }\n")
+    lua.append("local dispatch = {\n")
+    for (offset, size), group in dispatch.items():
+        lua.append("    {{ offset = {}, size = {}, symbols = {{\n".format(offset, size))
+        keys = set()
+        for info in group:
+            key = _frameType(info)[2].hex()
+            if key in keys: # symbols of different traces that could not be merged
+                lua.append("        -- {} omitted, same frame type as a previous symbol\n".format(
+                    info['name']))
+                continue
+            keys.add(key)
+            lua.append("        [\"{}\"] = {{\n".format(key))
+            lua.append("            name = \"{}\",\n".format(info['name']))
+            checksum = [(i+1, field['name']) for i, field in enumerate(info['fields'])
+                        if field['name'] in CHECKSUM_ALGORITHMS]
+            if checksum:
+                lua.append("            checksum = \"{}\", checksum_field = {},\n".format(
+                    checksum[-1][1], checksum[-1][0]))
+            lua.append("            fields = {\n")
+            for field in info['fields']:
+                lua.append("                {{ pf.{}, {}, {}, {} }},\n".format(
+                    abbrs[field['name']], field['start'], field['minsize'],
+                    field['maxsize']))
+            lua.append("            },\n")
+            lua.append("        },\n")
+        lua.append("    } },\n")
+    lua.append("}\n")
+
+    lua.append(LUA_FUNCTIONS)
+
+    return ''.join(lua)
+
@@ -2,10 +2,16 @@
 
 # system import
 import argparse
+from concurrent.futures import ProcessPoolExecutor
+from os import chdir, makedirs
+from os.path import abspath, join
+import sqlite3
+from time import strftime
 
 # others
 from boofuzz.connections.raw_l2_socket_connection import RawL2SocketConnection 
-from boofuzz import Session, Target
+from boofuzz import FuzzLoggerText, Session, Target
+from boofuzz.fuzz_logger_db import FuzzLoggerDb
 from boofuzz.monitors.base_monitor import BaseMonitor
 
 # internal import
@@ -13,53 +19,401 @@ from boofuzz_template import *
 
 
 # imports for IEEE80211Monitor
-from scapy.all import sniff
+from collections import deque
+from scapy.all import AsyncSniffer
+import socket
+from threading import Event, Thread
 from time import time
 
 class IEEE80211Monitor(BaseMonitor):
-    def __init__(self, interface, stop_filter, timeout=0.5):
+    """Checks after every test case if the target is still alive, i.e. if it sent a frame matching
+    stop_filter. A single sniffer runs in the background for the whole session and keeps the last
+    frames in a ring buffer, post_send() only waits until a matching frame arrived or the timeout
+    is over.
+
+    :param interface: interface to sniff on
+    :param stop_filter: function returning True for frames showing that the target is alive
+    :param timeout: seconds to wait for a matching frame after a test case was sent
+    :param buffer_size: number of frames to keep in the ring buffer
+    :param opened_socket: scapy socket to sniff on instead of the interface, e.g. for tests
+    """
+
+    def __init__(self, interface, stop_filter, timeout=0.5, buffer_size=1024, opened_socket=None):
+        super().__init__()
         self.interface = interface
         self.stop_filter = stop_filter
         self.timeout = timeout
+        self.opened_socket = opened_socket
+        self.frames = deque(maxlen=buffer_size) # (time received, frame)
+        self.sniffer = None
+        self._match = Event()
+        self._last_match = 0.0
+        self._sent = 0.0
+        self.latency = None # seconds between the last test case and the answer of the target
         return
 
-    def post_send(self, target=None, fuzz_data_logger=None, session=None):
+    def _received(self, frame):
+        now = time()
+        self.frames.append((now, frame))
+        if self.stop_filter(frame):
+            self._last_match = now
+            self._match.set()
+
+    def start(self):
+        """Start the background sniffer, done by pre_send() if not called before."""
+        if self.sniffer is not None:
+            return
+        if self.opened_socket is not None:
+            self.sniffer = AsyncSniffer(opened_socket=self.opened_socket, prn=self._received,
+                                        store=False)
+        else:
+            self.sniffer = AsyncSniffer(iface=self.interface, prn=self._received, store=False)
+        self.sniffer.start()
 
-        oldtime = time()
+    def stop(self):
+        """Stop the background sniffer."""
+        if self.sniffer is not None:
+            if self.sniffer.running:
+                self.sniffer.stop()
+            self.sniffer = None
 
-        # sniff for one second, stop if stop_filter applied to a sniffed packet
-        sniff(iface=self.interface, stop_filter=self.stop_filter, timeout=1)
+    def alive(self):
+        # called by boofuzz before fuzzing, so start sniffing now
+        self.start()
+        return self.sniffer.running
 
-        if time() - oldtime > self.timeout: # it took too long, it seems the target is/was down
-            return False
-        else:
+    def recent(self, since):
+        """Return frames received after the given time from the ring buffer."""
+        return [frame for received, frame in list(self.frames) if received >= since]
+
+    def pre_send(self, target=None, fuzz_data_logger=None, session=None):
+        self.start()
+        # set before clearing, a frame matching in between must not count for this test case
+        self._sent = time()
+        self._match.clear()
+
+    def post_send(self, target=None, fuzz_data_logger=None, session=None):
+
+        # wait for a matching frame received after the test case was sent, the event might have
+        # been set by a frame received before
+        deadline = time() + self.timeout
+        while self._last_match < self._sent:
+            remaining = deadline - time()
+            if remaining <= 0:
+                break
+            self._match.wait(remaining)
+            self._match.clear()
+        if self._last_match >= self._sent:
+            self.latency = self._last_match - self._sent
             return True
+        self.latency = None
 
+        # it took too long, it seems the target is/was down
+        if fuzz_data_logger is not None:
+            fuzz_data_logger.log_info("No frame of the target within {}s".format(self.timeout))
+        return False
 
-def main(args):
+
+class ModelMonitor(IEEE80211Monitor):
+    """Checks if the target is alive like IEEE80211Monitor, but frames are read from a raw socket
+    and classified with the model inferred by l2pre (see ModelCompiler.parseFrame()) instead of
+    being dissected by scapy. The target is alive if it sends a frame of a known symbol, optionally
+    limited to some symbols and to frames containing the address of the target. The number of
+    frames per symbol is counted, see liveness().
+
+    :param compiler: ModelCompiler of the model, e.g. load_model(path).compiler()
+    :param alive_types: names of symbols showing that the target is alive, all known symbols if
+    None
+    :param address: address of the target (bytes), frames without it in an Address field are
+    ignored
+    :param radiotap: frames start with a Radiotap header that is not part of the model
+    :param sock: socket to read frames from instead of the interface, e.g. for tests
+    """
+
+    def __init__(self, interface, compiler, alive_types=None, address=None, timeout=0.5,
+                 buffer_size=1024, radiotap=False, sock=None):
+        super().__init__(interface, None, timeout, buffer_size)
+        self.compiler = compiler
+        self.alive_types = set(alive_types) if alive_types else None
+        self.address = address
+        self.radiotap = radiotap
+        self.sock = sock
+        self.stats = {} # symbol name (None if unknown): [frames, alive frames, time of last frame]
+        self._running = False
+        self._thread = None
+        self._own_sock = False # socket opened by start(), closed by stop()
+        return
+
+    def _received(self, data):
+        now = time()
+        self.frames.append((now, data))
+
+        if self.radiotap and len(data) >= 4:
+            data = data[int.from_bytes(data[2:4], 'little'):]
+        name, fields = self.compiler.parseFrame(data)
+        alive = name is not None and (self.alive_types is None or name in self.alive_types)
+        if alive and self.address is not None:
+            alive = any(value == self.address for label, value in fields.items()
+                        if label.startswith("Address-"))
+
+        stats = self.stats.setdefault(name, [0, 0, 0.0])
+        stats[0] += 1
+        stats[2] = now
+        if alive:
+            stats[1] += 1
+            self._last_match = now
+            self._match.set()
+
+    def _read(self):
+        while self._running:
+            try:
+                data, address = self.sock.recvfrom(65535)
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            # the packet socket sees the test cases sent by the fuzzer as well
+            if isinstance(address, tuple) and address[2] == socket.PACKET_OUTGOING:
+                continue
+            self._received(data)
+
+    def start(self):
+        """Start reading frames in the background, done by pre_send() if not called before."""
+        if self._running:
+            return
+        if self.sock is None:
+            self.sock = socket.socket(socket.AF_PACKET, socket.SOCK_RAW, socket.htons(0x0003))
+            self.sock.bind((self.interface, 0))
+            self._own_sock = True
+        self.sock.settimeout(0.2)
+        self._running = True
+        self._thread = Thread(target=self._read, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Stop reading frames and close the socket opened by start()."""
+        self._running = False
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        if self._own_sock:
+            self.sock.close()
+            self.sock = None
+            self._own_sock = False
+
+    def alive(self):
+        # called by boofuzz before fuzzing, so start reading now
+        self.start()
+        return self._running
+
+    def liveness(self):
+        """Return statistics per symbol (None for unknown frames) as dict with number of frames,
+        number of frames showing that the target is alive and time of the last frame.
+        """
+        return {name: {'frames': frames, 'alive': alive, 'last': last}
+                for name, (frames, alive, last) in self.stats.items()}
+
+    @staticmethod
+    def printLiveness(liveness):
+        """Print statistics returned by liveness()."""
+        print("\nFrames received per symbol:")
+        for name, stats in sorted(liveness.items(), key=lambda item: -item[1]['frames']):
+            print("  {:<30} {:>8} frames, {:>8} showing the target alive".format(
+                name or "(unknown)", stats['frames'], stats['alive']))
+
+
+def stopFilter(frame):
+    """Frames showing that the target is alive (control frames of IEEE 802.11)."""
+    return getattr(frame, 'type', None) == 3
+
+
+def createSession(interface, index_start=1, index_end=None, web_port=26000, model=None,
+                  db_filename=None):
+    """Create a boofuzz session sending on interface, with its own monitor.
+
+    :param model: dict with path of a model saved by l2pre.py --save-model and the arguments of
+    ModelMonitor (alive_types, address, radiotap), IEEE80211Monitor is used if None
+    :param db_filename: additionally log all test cases to this database, see failedTestCases()
+    :return: tuple (session, monitor)
+    """
 
     # define monitors
-    #monitors = None
-    stop_filter = lambda x: x.type == 3
-    monitors = [IEEE80211Monitor(args.interface, stop_filter)]
+    if model is not None:
+        # netzob is needed for models only
+        from Model import load_model
+        options = dict(model)
+        compiler = load_model(options.pop('path')).compiler()
+        monitor = ModelMonitor(interface, compiler, **options)
+    else:
+        monitor = IEEE80211Monitor(interface, stopFilter)
+    monitors = [monitor]
+
+    fuzz_loggers = None
+    if db_filename is not None:
+        fuzz_loggers = [FuzzLoggerText(), FuzzLoggerDb(db_filename=db_filename)]
 
     # create session
     session = Session(
         target=Target(
-            connection=RawL2SocketConnection(args.interface,
+            connection=RawL2SocketConnection(interface,
                                              send_timeout=5.0,
                                              recv_timeout=5.0,
                                              ethernet_proto=0,
                                              mtu=2500,
                                              has_framecheck=True),
-            monitors=monitors))
+            monitors=monitors),
+        index_start=index_start,
+        index_end=index_end,
+        web_port=web_port,
+        fuzz_loggers=fuzz_loggers)
+
+    return session, monitor
+
 
-    # include all frames in boofuzz_template
-    for frame in frames:
+def failedTestCases(db_filename):
+    """Return the failed test cases logged to a result database.
+
+    :return: dict test case index: list of descriptions
+    """
+    failures = {}
+    database = sqlite3.connect(db_filename)
+    for index, description in database.execute(
+            "SELECT test_case_index, description FROM steps WHERE type = 'fail'"):
+        failures.setdefault(index, []).append(description)
+    database.close()
+    return failures
+
+
+def distributeWork(interfaces, split):
+    """Distribute frames (split='frames') or test case indices (split='index') among interfaces.
+    Interfaces left without work are not used.
+
+    :return: list of (interface, frames, index_start, index_end)
+    """
+
+    if split == 'frames':
+        workers = min(len(interfaces), len(frames))
+        return [(interface, frames[i_worker::workers], 1, None)
+                for i_worker, interface in enumerate(interfaces[:workers])]
+
+    # the session connects all frames to its root, thus the mutations simply add up
+    total = sum(frame.get_num_mutations() for frame in frames)
+    per_worker = -(-total // len(interfaces))
+    work = []
+    for i_worker, interface in enumerate(interfaces):
+        index_start = i_worker * per_worker + 1
+        index_end = min(total, (i_worker + 1) * per_worker)
+        if index_start <= index_end:
+            work.append((interface, frames, index_start, index_end))
+    return work
+
+
+def fuzzWorker(i_worker, interface, worker_frames, index_start, index_end, work_dir, model=None):
+    """Fuzz on one interface as one of several workers, see distributeWork().
+
+    :return: dict with interface, path of the result database and failed test cases
+    """
+
+    # boofuzz names its database by the start time, every worker needs an own results folder
+    worker_dir = join(work_dir, "worker-{}".format(i_worker))
+    makedirs(worker_dir)
+    chdir(worker_dir)
+
+    db_filename = join(worker_dir, 'results.db')
+    session, monitor = createSession(interface, index_start, index_end, web_port=26000 + i_worker,
+                                     model=model, db_filename=db_filename)
+    for frame in worker_frames:
         session.connect(frame)
 
-    # start fuzzing
-    session.fuzz()
+    try:
+        session.fuzz()
+    finally:
+        monitor.stop()
+
+    return {
+        'interface': interface,
+        'database': db_filename,
+        'failures': failedTestCases(db_filename),
+        'liveness': monitor.liveness() if model is not None else None,
+    }
+
+
+def mergeResults(results, work_dir):
+    """Combine the result databases of all workers into one database with an additional column
+    for the interface and write the crash list of all workers.
+
+    :return: path of the combined database
+    """
+
+    path = join(work_dir, 'combined.db')
+    combined = sqlite3.connect(path)
+    combined.execute("CREATE TABLE cases (interface text, name text, number integer, "
+                     "timestamp TEXT)")
+    combined.execute("CREATE TABLE steps (interface text, test_case_index integer, type text, "
+                     "description text, data blob, timestamp TEXT, is_truncated BOOLEAN)")
+    for result in results:
+        combined.execute("ATTACH DATABASE ? AS worker", (result['database'],))
+        combined.execute("INSERT INTO cases SELECT ?, * FROM worker.cases", (result['interface'],))
+        combined.execute("INSERT INTO steps SELECT ?, * FROM worker.steps", (result['interface'],))
+        combined.commit()
+        combined.execute("DETACH DATABASE worker")
+    combined.close()
+
+    with open(join(work_dir, 'crashes.txt'), 'w') as crashfile:
+        for result in results:
+            for case, descriptions in sorted(result['failures'].items()):
+                crashfile.write("{} #{}: {}\n".format(result['interface'], case,
+                                                      " | ".join(descriptions)))
+
+    return path
+
+
+def main(args):
+
+    model = None
+    if args.model:
+        model = {'path': args.model, 'alive_types': args.alive_types,
+                 'address': bytes.fromhex(args.address) if args.address else None,
+                 'radiotap': args.radiotap}
+
+    if len(args.interface) == 1:
+        session, monitor = createSession(args.interface[0], model=model)
+
+        # include all frames in boofuzz_template
+        for frame in frames:
+            session.connect(frame)
+
+        # start fuzzing
+        try:
+            session.fuzz()
+        finally:
+            monitor.stop()
+
+        if model is not None:
+            monitor.printLiveness(monitor.liveness())
+
+        return
+
+    # one worker process per interface, results are combined afterwards
+    work_dir = abspath(join('boofuzz-results', 'parallel-' + strftime("%Y-%m-%d_%H%M%S")))
+    work = distributeWork(args.interface, args.split)
+    workers = len(work)
+    if workers < len(args.interface):
+        print("\nWARNING: Not enough {} to fuzz for all interfaces, not using {}.".format(
+            args.split, ', '.join(args.interface[workers:])))
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        jobs = [pool.submit(fuzzWorker, i, *worker, work_dir, model)
+                for i, worker in enumerate(work)]
+        results = [job.result() for job in jobs]
+
+    path = mergeResults(results, work_dir)
+    failures = sum(len(result['failures']) for result in results)
+    print("\n{} failed test cases on {} interfaces, results combined in '{}'.".format(
+        failures, workers, path))
+    for result in results:
+        if result['liveness'] is not None:
+            print("\n{}:".format(result['interface']), end='')
+            ModelMonitor.printLiveness(result['liveness'])
 
     return
 
@@ -68,8 +422,21 @@ if __name__ == '__main__':
 
     parser = argparse.ArgumentParser(description="Fuzzing with boofuzz")
 
-    parser.add_argument('-i', '--interface', required=True, \
-            help='Interface to transmit and receive packets')
+    parser.add_argument('-i', '--interface', required=True, nargs='+', \
+            help='Interface to transmit and receive packets, several interfaces with identical ' + \
+            'devices are fuzzed in parallel')
+    parser.add_argument('--split', choices=['frames', 'index'], default='frames', \
+            help='distribute frames or test case indices among the interfaces, defaults to frames')
+
+    parser.add_argument('-m', '--model', metavar='DIR', \
+            help='check if the target is alive with a model saved by l2pre.py --save-model ' + \
+            'instead of waiting for IEEE 802.11 control frames')
+    parser.add_argument('--alive-types', nargs='+', metavar='SYMBOL', \
+            help='symbols of the model showing that the target is alive, defaults to all')
+    parser.add_argument('--address', metavar='HEX', \
+            help='address of the target, only frames containing it show that it is alive')
+    parser.add_argument('--radiotap', action='store_true', \
+            help='received frames start with a Radiotap header')
 
     # TODO check if args.interface is a valid socket
 
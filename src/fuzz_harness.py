@@ -0,0 +1,207 @@
+#!/usr/bin/env python
+
+"""
+Measure the throughput of fuzzing with a boofuzz template exported by l2pre without any hardware:
+the frames are sent to an in-process stand-in of the device that answers on a socket pair, which
+is sniffed by the IEEE80211Monitor of fuzz.py. Reports test cases per second, the latency of the
+monitor and where the time is spent (mutation, rendering, I/O, waiting for the monitor).
+"""
+
+# system import
+import argparse
+from importlib.util import module_from_spec, spec_from_file_location
+from os import chdir
+import socket
+from statistics import mean, median
+import sys
+from tempfile import mkdtemp
+from time import perf_counter
+
+# others
+from boofuzz import Session, Target
+from boofuzz.connections.itarget_connection import ITargetConnection
+from scapy.all import SimpleSocket
+
+
+ACK = b'\xd4\x00\x00\x00'
+"""Frame sent by the stand-in target to show that it is alive."""
+
+
+class StandInSocket(SimpleSocket):
+    """Scapy socket on the monitor's end of the socket pair. Marked as blocking, so that scapy adds
+    a control pipe to stop the sniffer, select() on it would never return otherwise.
+    """
+    nonblocking_socket = False
+
+
+class StandInTarget(ITargetConnection):
+    """In-process stand-in of a device. Every frame sent to it is answered with a response frame on
+    a socket pair, the other end of the pair can be sniffed by a monitor. With a compiled model
+    (see ModelCompiler), only frames of a known symbol are answered, like a device ignoring frames
+    it does not understand.
+    """
+
+    def __init__(self, compiler=None, response=ACK, header=0):
+        """
+        :param compiler: ModelCompiler to classify sent frames with, answer all frames if None
+        :param response: frame to answer with
+        :param header: number of bytes in front of the frames that are not part of the model,
+        e.g. the Radiotap header
+        """
+        self.compiler = compiler
+        self.response = response
+        self.header = header
+        self.device, self.monitor_end = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.io_time = 0.0
+        self.sent = 0
+        self.answered = 0
+
+    def open(self):
+        pass
+
+    def close(self):
+        pass
+
+    def recv(self, max_bytes):
+        return b''
+
+    def send(self, data):
+        start = perf_counter()
+        self.sent += 1
+        if self.compiler is None or self.compiler.parseFrame(data[self.header:])[0] is not None:
+            self.device.send(self.response)
+            self.answered += 1
+        self.io_time += perf_counter() - start
+        return len(data)
+
+    @property
+    def info(self):
+        return "stand-in target"
+
+
+def loadTemplate(path):
+    """Import a boofuzz template exported by l2pre from path. It is registered as
+    'boofuzz_template', so that fuzz.py uses it as well.
+    """
+    spec = spec_from_file_location('boofuzz_template', path)
+    template = module_from_spec(spec)
+    spec.loader.exec_module(template)
+    sys.modules['boofuzz_template'] = template
+    return template
+
+
+def timed(function, timings, key):
+    """Wrap function to add its runtime to timings[key]."""
+    def wrapper(*args, **kwargs):
+        start = perf_counter()
+        result = function(*args, **kwargs)
+        timings[key] += perf_counter() - start
+        return result
+    return wrapper
+
+
+def run(template, cases, compiler=None, timeout=0.5, header=0):
+    """Fuzz the stand-in target with the frames of template.
+
+    :param cases: maximum number of test cases
+    :return: dict with the results (see printResults())
+    """
+
+    # fuzz.py imports the template that is loaded already
+    from fuzz import IEEE80211Monitor
+
+    target = StandInTarget(compiler, header=header)
+    monitor = IEEE80211Monitor(None, lambda frame: bytes(frame) == ACK, timeout=timeout,
+                               opened_socket=StandInSocket(target.monitor_end))
+
+    timings = {'render': 0.0, 'monitor': 0.0}
+    latencies = []
+    post_send = monitor.post_send
+    def monitored(*args, **kwargs):
+        start = perf_counter()
+        alive = post_send(*args, **kwargs)
+        timings['monitor'] += perf_counter() - start
+        if monitor.latency is not None:
+            latencies.append(monitor.latency)
+        return alive
+    monitor.post_send = monitored
+
+    session = Session(target=Target(connection=target, monitors=[monitor]), index_end=cases,
+                      web_port=None, keep_web_open=False, fuzz_loggers=[],
+                      receive_data_after_each_request=False)
+    for frame in template.frames:
+        frame.render = timed(frame.render, timings, 'render')
+        session.connect(frame)
+
+    monitor.start()
+    start = perf_counter()
+    try:
+        session.fuzz()
+    finally:
+        total = perf_counter() - start
+        monitor.stop()
+
+    return {
+        'cases': target.sent,
+        'answered': target.answered,
+        'total': total,
+        'render': timings['render'],
+        'io': target.io_time,
+        'monitor': timings['monitor'],
+        'latencies': latencies,
+    }
+
+
+def printResults(results):
+    """Print the results of run()."""
+
+    total = results['total']
+    other = total - results['render'] - results['io'] - results['monitor']
+    print("\n{} test cases in {:.3f}s: {:.1f} cases/s ({} answered by the target)".format(
+        results['cases'], total, results['cases'] / total if total else 0, results['answered']))
+    if results['latencies']:
+        latencies = sorted(results['latencies'])
+        print("Monitor latency: mean {:.3f}ms, median {:.3f}ms, max {:.3f}ms".format(
+            mean(latencies) * 1000, median(latencies) * 1000, latencies[-1] * 1000))
+    for name, value in (("Mutation and bookkeeping", other), ("Rendering", results['render']),
+                        ("I/O", results['io']), ("Monitor", results['monitor'])):
+        print("{:<25} {:8.3f}s {:5.1f}%".format(name, value, 100 * value / total if total else 0))
+
+
+def main(args):
+
+    template = loadTemplate(args.template)
+    compiler = None
+    if args.model:
+        # netzob is needed for models only
+        from Model import load_model
+        compiler = load_model(args.model).compiler()
+
+    # boofuzz writes its result database to the working directory
+    chdir(mkdtemp(prefix='l2pre_fuzz_'))
+
+    results = run(template, args.cases, compiler, args.timeout, args.header)
+    printResults(results)
+
+    return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description="Measure fuzzing throughput with a stand-in target")
+
+    parser.add_argument('-t', '--template', default='src/boofuzz_template.py', \
+            help='boofuzz template exported by l2pre, defaults to src/boofuzz_template.py')
+    parser.add_argument('-n', '--cases', type=int, default=1000, \
+            help='number of test cases to run, defaults to 1000')
+    parser.add_argument('-m', '--model', metavar='DIR', \
+            help='model saved by l2pre.py --save-model, the target answers known frames only')
+    parser.add_argument('--header', type=int, default=0, metavar='BYTES', \
+            help='bytes in front of the frames not covered by the model, e.g. 8 for the ' + \
+            'Radiotap header of the template')
+    parser.add_argument('--timeout', type=float, default=0.5, \
+            help='timeout of the monitor in seconds, defaults to 0.5')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -2,82 +2,170 @@
 
 # system import
 import argparse
-from IPython import embed
 import sys
-from time import time
 
+# internal import
+from Profiler import profiler
+from stages import STAGES
 
-# netzob import
-from netzob.Model.Vocabulary.Functions.EncodingFunctions.TypeEncodingFunction import TypeEncodingFunction
-from netzob.Model.Vocabulary.Types.HexaString import HexaString
+# netzob, scapy, IPython and the exporters take seconds to import, thus they are imported only
+# once their feature is used
 
-# internal import
-from exportFunctions import *
-from FeatureExtraction import FeatureExtraction
-from PayloadFinder import PayloadFinder
-from utils import import_messages
 
+def createPipeline(args):
+    """Create the pipeline of the analysis as selected by args."""
+
+    # internal import
+    from Pipeline import Pipeline
 
-def analyze(messages_list: list, args):
+    return Pipeline(args.files,
+                    layer=args.layer,
+                    no_tunnel=args.no_tunnel,
+                    work_dir=getattr(args, 'work_dir', None),
+                    memory_limit=getattr(args, 'memory_limit', None),
+                    sample_size=getattr(args, 'sample', None))
 
-    print("\nTry to find and cut off payloads with known protocols...")
-    inference_start_time = time()
 
-    messages_list_without_payload = []
-    finder = PayloadFinder()
-    for msgs in messages_list:
-        messages_list_without_payload.append(finder.findPayload(msgs, omit_ether=args.no_tunnel))
+def analyze(messages_list: list, args, pipeline=None):
+    """Run the stages of the analysis as selected by args. If messages_list is None, the files
+    given in args are imported first.
+    """
 
-    print("\nStart feature detection...")
-    features = FeatureExtraction(messages_list_without_payload)
-    cluster = features.execute()
+    if pipeline is None:
+        pipeline = createPipeline(args)
+    cluster = pipeline.run(messages_list,
+                           from_stage=getattr(args, 'from_stage', None),
+                           to_stage=getattr(args, 'to_stage', None),
+                           resume=getattr(args, 'resume', False))
 
-    inference_runtime = time() - inference_start_time
-    print('\nProtocol inferred in {:.3f}s'.format(inference_runtime))
+    print('\nProtocol inferred in {:.3f}s'.format(pipeline.inferenceRuntime()))
 
     return cluster
 
 
-def main(args):
+def analyzeWindows(args):
+    """Run the analysis per time window and export the changes of the format over time."""
+
+    # internal import
+    from exportFunctions import exportTimeline
+    from utils import import_messages
+    from WindowedInference import WindowedInference
 
     print("\nImport PCAP files...")
-    # import packets (each item on list 'messages' contains the messages of one file)
     messages_list = import_messages(args.files, importLayer=args.layer)
 
-    # do the magic for layer 2 protocol reversing
-    cluster = analyze(messages_list, args)
-
-    # print symbols (omitting messages if there are too many)
-    for symbol in cluster:
-        msgs_backup = None
-        print("\n{}: {} unique messages (of {} messages)".format(
-            symbol.name, str(len(symbol.messages)), str(len(symbol.orig_messages))))
-        # omit messages to have a nicer print...
-        if len(symbol.messages) > 30:
-            msgs_backup = symbol.messages
-            symbol.messages = symbol.messages[0:30] # cut off long messages
-            print("(only showing 30 here)")
-        symbol.addEncodingFunction(TypeEncodingFunction(HexaString))
-        print(symbol)
-        # restore messages
-        if msgs_backup:
-            symbol.messages = list(msgs_backup)
-
-    # optionally start interactive session
-    if args.interactive:
+    windowed = WindowedInference(window=args.window, adaptive=args.adaptive_window,
+                                 no_tunnel=args.no_tunnel, memory_limit=args.memory_limit,
+                                 sample_size=args.sample)
+    timeline = windowed.execute(messages_list)
+    changes = windowed.changes(timeline)
+    windowed.printChanges(changes)
+    exportTimeline(timeline, changes)
+
+    return
+
+
+def main(args):
+
+    if args.window or args.adaptive_window:
+        analyzeWindows(args)
+        return
+
+    # netzob import
+    from netzob.Model.Vocabulary.Functions.EncodingFunctions.TypeEncodingFunction import TypeEncodingFunction
+    from netzob.Model.Vocabulary.Types.HexaString import HexaString
+
+    # internal import
+    from Model import load_model, save_model
+    from SymbolRenderer import SymbolRenderer
+
+    if args.load_snapshot:
+        # restore a session saved before and continue with the interactive session directly
+        print("\nLoad snapshot from '{}'...".format(args.load_snapshot))
+        model = load_model(args.load_snapshot)
+        cluster = model.cluster()
+        summary = model.manifest
+        payload_offsets = model.payload_offsets
+        timings = summary.get('timings', {})
+        for symbol in cluster:
+            symbol.addEncodingFunction(TypeEncodingFunction(HexaString))
+        print("{} symbols of {} restored, inspect 'cluster', 'model' and 'timings'.".format(
+            len(cluster), ', '.join(summary.get('files', []))))
+        # others
+        from IPython import embed
+        from exportFunctions import exportFuzz, exportPF, exportWiresharkDissector
         embed()
 
-    # optionally export human-readable presentation (protocol format) to file
-    if args.export_pf:
-        exportPF(cluster)
+    else:
+        if args.load_model:
+            # continue with a model saved before instead of inferring the protocol again
+            print("\nLoad model from '{}'...".format(args.load_model))
+            model = load_model(args.load_model)
+            cluster = model.cluster()
+            summary = model.manifest
+            payload_offsets = model.payload_offsets
+
+        else:
+            # do the magic for layer 2 protocol reversing
+            pipeline = createPipeline(args)
+            cluster = analyze(None, args, pipeline)
+
+            # stopped before the last stage, there is nothing to show or export yet
+            if args.to_stage and args.to_stage != STAGES[-1]:
+                print("\nStopped after stage '{}', results are stored in '{}'.".format(
+                    args.to_stage, args.work_dir))
+                return
+
+            summary = pipeline.summary()
+            payload_offsets = pipeline.finder.known_offsets
+            if args.save_model:
+                save_model(cluster, args.save_model, payload_offsets, summary)
+                print("\nModel saved to '{}'.".format(args.save_model))
+
+        # print symbols (omitting messages if there are too many)
+        renderer = SymbolRenderer(max_rows=args.rows, col_width=args.col_width,
+                                  compact=args.compact)
+        for symbol in cluster:
+            print("\n{}: {} unique messages (of {} messages)".format(
+                symbol.name, str(len(symbol.messages)), str(len(symbol.orig_messages))))
+            if hasattr(symbol, 'assigned_messages'):
+                print("({} messages of the whole capture assigned)".format(
+                    len(symbol.assigned_messages)))
+            # omit messages to have a nicer print...
+            if not args.compact and len(symbol.messages) > args.rows:
+                print("(only showing {} here)".format(args.rows))
+            renderer.render(symbol)
+            # hex output for print(symbol) in interactive session
+            symbol.addEncodingFunction(TypeEncodingFunction(HexaString))
 
-    # optionally export boofuzz template
-    if args.export_bf:
-        exportFuzz(cluster)
+        # optionally start interactive session
+        if args.interactive:
+            # others
+            from IPython import embed
+            from exportFunctions import exportFuzz, exportPF, exportWiresharkDissector
+            embed()
 
-    # optionally export wireshark dissector
-    if args.export_ws:
-        exportWiresharkDissector(cluster)
+    # store the session including changes made in the interactive session
+    if args.save_snapshot:
+        save_model(cluster, args.save_snapshot, payload_offsets, summary)
+        print("\nSnapshot saved to '{}', continue with --load-snapshot.".format(
+            args.save_snapshot))
+
+    # optionally export human-readable presentation (protocol format), boofuzz template and
+    # wireshark dissector, all selected formats are written concurrently
+    if args.export_pf or args.export_bf or args.export_ws:
+        # internal import
+        from exportFunctions import exportAll
+        with profiler.step('export'):
+            exportAll(cluster, pf=args.export_pf, bf=args.export_bf, ws=args.export_ws,
+                      ws_checksum=args.ws_checksum)
+
+    # optionally label further captures with the compiled model
+    if args.label:
+        # internal import
+        from exportFunctions import exportLabels
+        with profiler.step('label'):
+            exportLabels(cluster, args.label, layer=args.layer)
 
     return
 
@@ -87,7 +175,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(description="Layer 2 Protocol Reverse Engineering")
 
     parser.add_argument('files', help='pcap/pcapng files with network traffic to be analyzed', \
-                        metavar='PCAPs', nargs='+')
+                        metavar='PCAPs', nargs='*')
     parser.add_argument('-l', '--layer', default=1, type=int, \
             help='Layer to import, defaults to 1 (use 2 if importing stuff in Radiotap header)')
     parser.add_argument('-nt', '--no-tunnel', action='store_true', default=False, \
@@ -101,6 +189,50 @@ if __name__ == '__main__':
             help='export protocol format')
     parser.add_argument('-w', '--export-ws', action='store_true', \
             help='export wireshark dissector')
+    parser.add_argument('--ws-checksum', action='store_true', \
+            help='let the exported wireshark dissector validate crc32 and adler32 fields')
+    parser.add_argument('--label', nargs='+', metavar='PCAP', \
+            help='label the frames of further captures with the inferred model and export them ' + \
+            'as columnar table')
+    parser.add_argument('--save-model', metavar='DIR', \
+            help='save the inferred model to DIR')
+    parser.add_argument('--load-model', metavar='DIR', \
+            help='load a model saved with --save-model instead of inferring the protocol again')
+    parser.add_argument('--save-snapshot', metavar='DIR', \
+            help='save the session to DIR when done (after the interactive session, if any)')
+    parser.add_argument('--load-snapshot', metavar='DIR', \
+            help='restore a session saved with --save-snapshot and start an interactive session')
+    parser.add_argument('--rows', type=int, default=30, \
+            help='number of messages to print per symbol, defaults to 30')
+    parser.add_argument('--col-width', type=int, \
+            help='cut off printed values longer than COL_WIDTH')
+    parser.add_argument('--compact', action='store_true', \
+            help='print a summary per field instead of the messages of each symbol')
+    parser.add_argument('-d', '--work-dir', \
+            help='directory to store checkpoints of every analysis stage in')
+    parser.add_argument('-r', '--resume', action='store_true', \
+            help='continue after the last stage stored in WORK_DIR')
+    parser.add_argument('--from-stage', choices=STAGES, \
+            help='first stage to run, needs a checkpoint of the previous stage in WORK_DIR')
+    parser.add_argument('--to-stage', choices=STAGES, \
+            help='last stage to run')
+    parser.add_argument('-m', '--memory-limit', type=int, metavar='MiB', \
+            help='keep message data on disk (in WORK_DIR or a temporary folder) if it exceeds MiB')
+    parser.add_argument('-s', '--sample', type=int, metavar='N', \
+            help='infer the format on a stratified sample of N messages per PCAP and assign all ' + \
+            'messages afterwards')
+    parser.add_argument('--window', type=float, metavar='SECONDS', \
+            help='infer the format per time window of SECONDS and report changes of the format')
+    parser.add_argument('--adaptive-window', type=int, metavar='N', \
+            help='infer the format per time window of about N messages (ending at pauses) and ' + \
+            'report changes of the format')
+    parser.add_argument('--profile', metavar='JSON', \
+            help='record wall time, CPU time, messages, scapy dissections and resident memory ' + \
+            'of every stage and step and write them to JSON')
+    parser.add_argument('--profile-memory', action='store_true', \
+            help='record the peak of Python allocations per step as well (slow)')
+    parser.add_argument('--profile-stats', metavar='FILE', \
+            help='run cProfile and write its statistics to FILE (read with pstats)')
 
     args = parser.parse_args()
 
@@ -109,4 +241,24 @@ if __name__ == '__main__':
                 "Radiotap header, not recommended otherwise), but still you do not expect " + \
                 "tunneled traffic, this is unusual, but proceeding nevertheless...")
 
+    if not args.files and not args.load_model and not args.load_snapshot:
+        parser.error("PCAPs are needed unless a model or snapshot is loaded")
+    if args.load_model and args.load_snapshot:
+        parser.error("--load-model and --load-snapshot can not be used together")
+    if (args.resume or args.from_stage or args.to_stage) and not args.work_dir:
+        parser.error("--resume, --from-stage and --to-stage need a --work-dir")
+    if args.window and args.adaptive_window:
+        parser.error("--window and --adaptive-window can not be used together")
+
+    if args.profile or args.profile_stats:
+        profiler.enable(trace_memory=args.profile_memory, cprofile=bool(args.profile_stats))
+
     main(args)
+
+    if args.profile:
+        profiler.printReport()
+        profiler.write(args.profile)
+        print("\nProfile written to '{}'.".format(args.profile))
+    if args.profile_stats:
+        profiler.dumpStats(args.profile_stats)
+        print("cProfile statistics written to '{}'.".format(args.profile_stats))
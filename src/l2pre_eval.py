@@ -0,0 +1,206 @@
+#!/usr/bin/env python
+
+"""
+Evaluate l2pre for a grid of heuristic parameters (see Pipeline.PARAMETERS) on a corpus of
+captures. The captures are imported and dissected by tshark once, the payload stage is run once
+per distinct set of its parameters, and every configuration then runs the remaining stages in a
+worker process forked from this state. Writes a table of FMS, runtime and peak memory per
+configuration.
+"""
+
+# system import
+import argparse
+import csv
+from itertools import product
+from multiprocessing import get_context
+from os import cpu_count, makedirs
+from resource import getrusage, RUSAGE_SELF
+from statistics import mean
+from time import process_time, strftime, time
+
+# internal import
+from l2pre_fms import loadCapture, prepareMessages, scoreFMS
+from Pipeline import Pipeline, PARAMETERS
+from PayloadFinder import PayloadFinder
+from utils import import_messages
+
+
+_corpus = None
+"""Imported messages, outputs of the payload stage and comparators inherited by the workers."""
+
+
+def parseGrid(specs):
+    """Parse parameter values given as 'name=value,value,...'. Values are converted to the type of
+    the default of the parameter.
+
+    :return: dict mapping parameter names to lists of values
+    """
+
+    grid = {}
+    for spec in specs:
+        name, _, values = spec.partition('=')
+        if name not in PARAMETERS or not values:
+            raise ValueError("Invalid grid '{}', use NAME=VALUE,... with NAME one of {}".format(
+                spec, list(PARAMETERS)))
+        default = getattr(PARAMETERS[name], name)
+        grid[name] = [type(default)(value) for value in values.split(',')]
+    return grid
+
+
+def configurations(grid):
+    """Return a list with a dict of parameters for every combination of the values in grid."""
+    names = list(grid)
+    return [dict(zip(names, values)) for values in product(*(grid[name] for name in names))]
+
+
+def payloadKey(config):
+    """Return the parameters of config used by the payload stage, configurations with the same
+    key share the output of the payload stage.
+    """
+    return tuple(sorted((name, value) for name, value in config.items()
+                        if PARAMETERS[name] is PayloadFinder))
+
+
+def prepareCorpus(args, configs):
+    """Import and dissect the captures and run the payload stage for every distinct payload key of
+    configs.
+
+    :return: dict with 'payloads' {payload key: (messages_list, runtime)}, 'specimens' and
+    'comparators'
+    """
+
+    print("Import PCAP files...")
+    messages_list = import_messages(args.files, importLayer=args.layer)
+
+    payloads = {}
+    for key in sorted({payloadKey(config) for config in configs}):
+        pipeline = Pipeline(args.files, layer=args.layer, no_tunnel=args.no_tunnel,
+                            parameters=dict(key))
+        state = pipeline.run(messages_list, to_stage='payload')
+        payloads[key] = (state, pipeline.timings['payload'])
+
+    print("\nLoad messages for FMS...")
+    specimens = []
+    comparators = []
+    for pcap in args.files:
+        loader, comparator = loadCapture(pcap, args)
+        specimens.append(loader)
+        comparators.append(comparator)
+
+    return {'payloads': payloads, 'specimens': specimens, 'comparators': comparators}
+
+
+def evaluate(config):
+    """Run the stages after the payload stage with config and calculate the FMS, run in a fresh
+    worker process forked from the prepared corpus.
+
+    :return: dict of config and its results
+    """
+
+    args = _corpus['args']
+    # ru_maxrss of the forked process starts at the size of the parent
+    rss_start = getrusage(RUSAGE_SELF).ru_maxrss
+    start = time()
+    cpu_start = process_time()
+
+    messages_list, payload_runtime = _corpus['payloads'][payloadKey(config)]
+    pipeline = Pipeline(args.files, layer=args.layer, no_tunnel=args.no_tunnel,
+                        parameters=config)
+    result = dict(config)
+    try:
+        symbols = pipeline.run(messages_list, from_stage='address')
+        runtime = pipeline.inferenceRuntime() + payload_runtime
+        cpu = process_time() - cpu_start
+
+        prepareMessages(symbols, _corpus['specimens'])
+        fms = scoreFMS(_corpus['comparators'], _corpus['specimens'], symbols, workers=1)
+        scores = [score.score for scores in fms for score in scores.values()]
+        result.update(fms=mean(scores) if scores else 0.0, messages=len(scores),
+                      symbols=len(symbols), error='')
+    except Exception as e:
+        runtime = time() - start + payload_runtime
+        cpu = process_time() - cpu_start
+        result.update(fms=None, messages=0, symbols=0, error=repr(e))
+
+    result.update(runtime=runtime, cpu=cpu,
+                  peak_mib=(getrusage(RUSAGE_SELF).ru_maxrss - rss_start) / 1024)
+    return result
+
+
+def writeResults(results, names):
+    """Write results to reports/eval_<time>.csv and print them sorted by FMS.
+
+    :param names: names of the parameters of the grid
+    :return: path of the CSV file
+    """
+
+    columns = names + ['fms', 'messages', 'symbols', 'runtime', 'cpu', 'peak_mib', 'error']
+    makedirs('reports', exist_ok=True)
+    path = 'reports/eval_{}.csv'.format(strftime('%Y%m%d-%H%M%S'))
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(results)
+
+    widths = [max(len(name), 8) for name in names]
+    print("\n" + " | ".join(name.ljust(w) for name, w in zip(names, widths)) +
+          " |   FMS  | runtime |  peak MiB")
+    for result in sorted(results, key=lambda r: -1 if r['fms'] is None else r['fms'],
+                         reverse=True):
+        fms = "failed" if result['fms'] is None else "{:.4f}".format(result['fms'])
+        print(" | ".join(str(result[name]).ljust(w) for name, w in zip(names, widths)) +
+              " | {:>6} | {:6.2f}s | {:9.1f}".format(fms, result['runtime'], result['peak_mib']))
+    print("\nResults written to '{}'.".format(path))
+
+    return path
+
+
+def main(args):
+    global _corpus
+
+    grid = parseGrid(args.grid)
+    configs = configurations(grid)
+    print("Evaluate {} configurations on {} captures...".format(len(configs), len(args.files)))
+
+    _corpus = prepareCorpus(args, configs)
+    _corpus['args'] = args
+
+    # a fresh process per configuration, so that the stages do not change the shared corpus
+    workers = min(args.jobs or cpu_count() or 1, len(configs))
+    with get_context('fork').Pool(workers, maxtasksperchild=1) as pool:
+        results = pool.map(evaluate, configs, chunksize=1)
+
+    writeResults(results, list(grid))
+
+    return
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Evaluate l2pre with a grid of heuristic parameters on a corpus of captures: '
+                    'Write a table with FMS, runtime and peak memory per configuration.')
+
+    parser.add_argument('files', help='pcap/pcapng files with network traffic to be analyzed', \
+                        metavar='PCAPs', nargs='+')
+    parser.add_argument('-g', '--grid', nargs='+', default=[], metavar='NAME=VALUES', \
+            help='values of a parameter separated by commas, e.g. separator=0.1,0.2,0.3. ' + \
+            'Parameters: ' + ', '.join(PARAMETERS))
+    parser.add_argument('-l', '--layer', default=1, type=int, \
+            help='Layer to import, defaults to 1 (use 2 if importing stuff in Radiotap header)')
+    parser.add_argument('-nt', '--no-tunnel', action='store_true', default=False, \
+            help='Do not look for Ethernet frames while searching for payloads')
+    parser.add_argument('-p', '--omit-payload', action='store_true', \
+            help='Ignore payload during format comparison. Useful for protocols with big payload.')
+    parser.add_argument('-j', '--jobs', type=int, metavar='N', \
+            help='Number of configurations evaluated in parallel, defaults to the number of CPUs')
+    parser.add_argument('--dissection-cache', default='cache/dissections', metavar='DIR', \
+            help='Directory of the dissection cache of tshark, defaults to cache/dissections')
+    parser.add_argument('--no-dissection-cache', action='store_true', \
+            help='Always run tshark, do not read or write the dissection cache')
+    parser.add_argument('--allow-any-version', action='store_true', \
+            help='Without tshark installed, use dissections recorded with any version of tshark')
+
+    args = parser.parse_args()
+
+    main(args)
@@ -8,8 +8,13 @@ adopted to test l2pre with Fomat Match Score (FMS)
 
 # system import
 import argparse
-from IPython import embed
-from time import time
+from concurrent.futures import ProcessPoolExecutor
+import csv
+from multiprocessing import get_context
+from os import cpu_count, makedirs
+from os.path import basename
+from statistics import mean
+from time import strftime, time
 
 # nemere import
 from nemere.validation.dissectorMatcher import MessageComparator, DissectorMatcher
@@ -18,35 +23,70 @@ from nemere.utils import reportWriter
 
 # netzob import
 from netzob.Model.Vocabulary.Field import Field
+from netzob.Model.Vocabulary.Symbol import Symbol
+from netzob.Model.Vocabulary.Messages.AbstractMessage import AbstractMessage
 from netzob.Model.Vocabulary.Types.Raw import Raw
 
 # internal import
 from utils import import_messages
 from l2pre import analyze
+from Model import load_model
+from DissectionCache import DissectionCache
 
 
 debug = False
 """Some modules and methods contain debug output that can be activated by this flag."""
 
 
+_scoring = None
+"""Comparators and symbols inherited by the worker processes of scoreFMS()."""
+
+
+def indexSpecimens(specimens):
+    """Index the messages of the specimens by their data and date, so that each message of l2pre
+    is matched in constant time.
+
+    :param specimens: SpecimenLoader or list of SpecimenLoaders of several captures
+    :return: dict mapping (data, date) to a list of the specimen messages with that data and date,
+    the list contains more than one message if a frame was captured twice at the same time
+    """
+    if not isinstance(specimens, list):
+        specimens = [specimens]
+    index = {}
+    for loader in specimens:
+        for specmsg in loader.messagePool.keys():
+            index.setdefault((specmsg.data, specmsg.date), []).append(specmsg)
+    return index
+
+
 def prepareMessages(symbols, specimens):
     """Restores content of symbol.messages to the original, not deduplicated messages, including the
     payload and appends a payload field to symbol.fields. Afterwards, connect the message object of
     the comparator to the symbol, so that it is able to compare the format.
+
+    :param specimens: SpecimenLoader or list of SpecimenLoaders of all captures analyzed
     """
 
+    index = indexSpecimens(specimens)
+    captures = ', '.join(loader.pcapFileName for loader in
+                         (specimens if isinstance(specimens, list) else [specimens]))
+    used = {} # number of specimen messages already matched per key
+
     def applySpecimenMessage(sym):
         # match specimenloader logic by using their message object
         newmsgs = []
         for m in sym.messages:
-            newmsg = None
-            for specmsg in specimens.messagePool.keys():
-                if m.data == specmsg.data and m.date == specmsg.date:
-                    newmsg = specmsg
-                    break
-            if not newmsg:
-                raise
-            newmsgs.append(newmsg)
+            # the specimen message contains the payload that l2pre cut off
+            data = m.data + m.payload_data if m.payload else m.data
+            key = (data, m.date)
+            candidates = index.get(key)
+            if not candidates:
+                raise ValueError("no message of {} matches message from {} of {} with data {}".format(
+                    captures, m.date, sym.name, data.hex()))
+            # assign duplicates to different specimen messages as long as there are some left
+            i = used.get(key, 0)
+            newmsgs.append(candidates[min(i, len(candidates) - 1)])
+            used[key] = i + 1
         sym.messages = newmsgs
 
     # restore original messages, as l2pre normally only outputs the unique ones
@@ -56,69 +96,185 @@ def prepareMessages(symbols, specimens):
         else:
             raise ValueError("orig_messages do not exist")
 
-    # restore payload data by adding a field to symbol and appending payload data again
+    # restore payload data by adding a field to symbol, the data itself is restored by using the
+    # messages of the specimens
     for sym in symbols:
 
         # check if payloads exist and what the max size is (for payload field)
-        payloads = []
-        for m in sym.messages:
-            if m.payload:
-                payloads.append(m.payload_data)
-        if payloads:
-            max_payload_size = max([len(pl) for pl in payloads])
-        else:
-            applySpecimenMessage(sym)
-            continue
-        max_payload_size *= 8 # bits, not bytes
+        payload_sizes = [len(m.payload_data) for m in sym.messages if m.payload]
+        if payload_sizes:
+            # create and add payload field
+            max_payload_size = max(payload_sizes) * 8 # bits, not bytes
+            payload_field = Field(Raw(nbBytes=(0, max_payload_size)))
+            sym.fields.append(payload_field)
 
-        # create and add payload field
-        payload_field = Field(Raw(nbBytes=(0, max_payload_size)))
-        sym.fields.append(payload_field)
+        applySpecimenMessage(sym)
 
-        # append payload data to message.data
-        for m in sym.messages:
-            if m.payload:
-                m.data += m.payload_data
 
-        applySpecimenMessage(sym)
+def loadCapture(pcap, args):
+    """Load the messages of pcap for the FMS and dissect them with tshark (or the dissection
+    cache).
+
+    :return: tuple (specimens, comparator)
+    """
+
+    specimens = SpecimenLoader(pcap, layer=args.layer, relativeToIP=False)
+    if args.no_dissection_cache:
+        comparator = MessageComparator(specimens, pcap=pcap, omitPayload=args.omit_payload,
+                                       failOnUndissectable=False, debug=debug)
+    else:
+        cache = DissectionCache(args.dissection_cache, args.allow_any_version)
+        with cache.dissections(pcap, specimens, args.layer):
+            comparator = MessageComparator(specimens, pcap=pcap, omitPayload=args.omit_payload,
+                                           failOnUndissectable=False, debug=debug)
+        if cache.hit:
+            print("Loaded dissections of tshark for '{}' from '{}'.".format(
+                pcap, args.dissection_cache))
+
+    return specimens, comparator
+
+
+def _scoreChunk(jobs):
+    """Calculate the FMS of the messages in jobs, run in a worker process of scoreFMS().
+
+    :param jobs: list of (capture index, symbol index, message index)
+    :return: list of (job, FormatMatchScore, stripped attributes), the scores do not reference the
+    message and symbol, the attributes that did are restored by scoreFMS()
+    """
+
+    comparators, symbols = _scoring
+    scores = []
+    for i_capture, i_sym, i_msg in jobs:
+        symbol = symbols[i_sym]
+        score = DissectorMatcher(comparators[i_capture], symbol, symbol.messages[i_msg]).calcFMS()
+        # do not send netzob objects back to the main process
+        stripped = {attr: isinstance(value, Symbol) for attr, value in vars(score).items()
+                    if isinstance(value, (AbstractMessage, Symbol))}
+        for attr in stripped:
+            setattr(score, attr, None)
+        scores.append(((i_capture, i_sym, i_msg), score, stripped))
+    return scores
+
+
+def scoreFMS(comparators, specimens, symbols, workers=None):
+    """Calculate the FMS of every message of symbols in parallel worker processes.
+
+    :param comparators: MessageComparator per capture
+    :param specimens: SpecimenLoader per capture, to find the capture of each message
+    :param workers: number of worker processes, defaults to the number of CPUs
+    :return: list with a dict mapping messages to their FormatMatchScore per capture
+    """
+    global _scoring
+
+    capture_of = {id(specmsg): i for i, loader in enumerate(specimens)
+                  for specmsg in loader.messagePool.keys()}
+    jobs = [(capture_of[id(m)], i_sym, i_msg) for i_sym, sym in enumerate(symbols)
+            for i_msg, m in enumerate(sym.messages)]
+
+    workers = workers or cpu_count() or 1
+    # forked workers inherit comparators and symbols instead of receiving them pickled
+    _scoring = (comparators, symbols)
+    if workers == 1 or len(jobs) < 2 * workers:
+        results = _scoreChunk(jobs)
+    else:
+        size = -(-len(jobs) // (4 * workers))
+        chunks = [jobs[i:i + size] for i in range(0, len(jobs), size)]
+        with ProcessPoolExecutor(max_workers=workers, mp_context=get_context('fork')) as pool:
+            results = [result for chunk in pool.map(_scoreChunk, chunks) for result in chunk]
+    _scoring = None
+
+    fms = [{} for _ in comparators]
+    for (i_capture, i_sym, i_msg), score, stripped in results:
+        symbol = symbols[i_sym]
+        message = symbol.messages[i_msg]
+        for attr, is_symbol in stripped.items():
+            setattr(score, attr, symbol if is_symbol else message)
+        fms[i_capture][message] = score
+
+    return fms
+
+
+def writeMergedReport(fms, specimens, symbols, inference_runtime):
+    """Write the FMS of all messages of all captures to one CSV file in reports/ and print the
+    mean FMS per capture and overall.
+
+    :return: path of the CSV file
+    """
+
+    makedirs('reports', exist_ok=True)
+    path = 'reports/fms_{}.csv'.format(strftime('%Y%m%d-%H%M%S'))
+    symbol_of = {id(m): sym.name for sym in symbols for m in sym.messages}
+    overall = []
+    with open(path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        writer.writerow(['capture', 'symbol', 'date', 'fms', 'inference_runtime'])
+        for loader, scores in zip(specimens, fms):
+            values = []
+            for message, score in scores.items():
+                writer.writerow([basename(loader.pcapFileName), symbol_of.get(id(message)),
+                                 message.date, score.score, inference_runtime])
+                values.append(score.score)
+            overall.extend(values)
+            print("{}: mean FMS {:.3f} of {} messages".format(
+                basename(loader.pcapFileName), mean(values) if values else 0, len(values)))
+    print("All captures: mean FMS {:.3f} of {} messages, written to '{}'".format(
+        mean(overall) if overall else 0, len(overall), path))
+
+    return path
 
 
 def main(args):
 
     print("Load messages...")
     # for FMS stuff
-    # TODO import multiple files in SpecimenLoader and everywhere else, basically...
-    specimens = SpecimenLoader(args.files[0], layer=args.layer,
-                               relativeToIP=False)
-    comparator = MessageComparator(specimens, pcap=args.files[0], omitPayload=args.omit_payload,
-                               failOnUndissectable=False, debug=debug)
-    # for l2pre
-    messages_list = import_messages(args.files, importLayer=args.layer)
-
-    print("Infer protocol via l2pre tool...")
+    specimens = []
+    comparators = []
+    for pcap in args.files:
+        loader, comparator = loadCapture(pcap, args)
+        specimens.append(loader)
+        comparators.append(comparator)
+
     inference_title = 'l2pre_inferred'
-    inference_start_time = time()
-    symbols = analyze(messages_list, args)
-    inference_runtime = time() - inference_start_time
+    if args.load_model:
+        print("Load protocol inferred by l2pre from '{}'...".format(args.load_model))
+        messages_list = None
+        model = load_model(args.load_model)
+        symbols = model.cluster()
+        inference_runtime = model.manifest.get('runtime', 0)
+    else:
+        # for l2pre
+        messages_list = import_messages(args.files, importLayer=args.layer)
+
+        print("Infer protocol via l2pre tool...")
+        inference_start_time = time()
+        symbols = analyze(messages_list, args)
+        inference_runtime = time() - inference_start_time
 
     # prepare messages to have the format, the comparator expects
     prepareMessages(symbols, specimens)
 
-    # print inference results
-    comparator.pprintInterleaved(symbols)
+    # print inference results, the comparator only knows the messages of its capture
+    if len(comparators) == 1:
+        comparators[0].pprintInterleaved(symbols)
 
     # calc FMS per message
     print("\nCalculate FMS...\n")
-    fms = DissectorMatcher.symbolListFMS(comparator, symbols)
+    fms = scoreFMS(comparators, specimens, symbols, args.jobs)
 
-    # write report
-    reportWriter.writeReport(fms, inference_runtime, specimens, comparator, inference_title)
+    # write report per capture and the merged one
+    for loader, comparator, scores in zip(specimens, comparators, fms):
+        reportWriter.writeReport(scores, inference_runtime, loader, comparator, inference_title)
+    if len(specimens) > 1:
+        writeMergedReport(fms, specimens, symbols, inference_runtime)
 
     if args.interactive:
+        message2quality = {m: score for scores in fms for m, score in scores.items()}
         print("Start interactive session...\n")
-        print('Loaded PCAP in: specimens, comparator, messages_list')
+        print('Loaded PCAPs in: specimens, comparators, messages_list')
         print('Inferred messages in: symbols')
         print('FMS of messages in: message2quality')
+        # others
+        from IPython import embed
         embed()
 
     return
@@ -142,6 +298,20 @@ if __name__ == '__main__':
             help='Ignore payload during format comparison. Useful for protocols with big payload.')
     parser.add_argument('-i', '--interactive', action='store_true', \
             help='Start interactive session after automatic protocol reversing')
+    parser.add_argument('--load-model', metavar='DIR', \
+            help='Evaluate a model saved by l2pre.py --save-model instead of inferring the ' + \
+            'protocol again')
+
+    parser.add_argument('--dissection-cache', default='cache/dissections', metavar='DIR', \
+            help='Directory to store the dissections of tshark in, so that they are reused when ' + \
+            'evaluating the same capture again, defaults to cache/dissections')
+    parser.add_argument('--no-dissection-cache', action='store_true', \
+            help='Always run tshark, do not read or write the dissection cache')
+    parser.add_argument('--allow-any-version', action='store_true', \
+            help='Without tshark installed, use dissections recorded with any version of tshark')
+
+    parser.add_argument('-j', '--jobs', type=int, metavar='N', \
+            help='Number of processes calculating the FMS, defaults to the number of CPUs')
 
     args = parser.parse_args()
 
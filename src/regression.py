@@ -0,0 +1,343 @@
+#!/usr/bin/env python
+
+"""
+Regression runner: analyze the bundled captures in input/ and fixed synthetic datasets (see
+synthetic.py), and compare the inferred symbol layouts exactly against a baseline kept in the
+repository and the runtime and peak memory of every stage with tolerances against a baseline of
+this machine. The layouts of synthetic datasets are checked against their known format as well.
+Reports behavioral and performance regressions and exits with status 1 if there are any. Record a
+new baseline with --update after intended changes.
+"""
+
+# system import
+import argparse
+import json
+from multiprocessing import get_context
+from os import cpu_count, makedirs
+from os.path import exists, join
+import platform
+from resource import getrusage, RUSAGE_SELF
+import sys
+from tempfile import gettempdir
+from time import strftime, time
+
+# internal import
+from synthetic import SyntheticProtocol, checkFormat, writeCapture
+
+
+BASELINE = 'regression_baseline.json'
+"""Default path of the baseline of the symbol layouts, relative to the repository. It is part of
+the repository, update it together with intended changes of the inferred layouts."""
+
+PERFORMANCE = 'regression_performance.json'
+"""Default path of the baseline of runtime and memory, relative to the repository. The numbers
+are only comparable on the same machine, thus it is recorded locally and not committed."""
+
+DATASETS = {
+    'ethernet': {'files': ['input/ethernet/test1.pcapng', 'input/ethernet/test2.pcapng'],
+                 'layer': 1, 'no_tunnel': True},
+    'iPCF': {'files': ['input/iPCF/iPCF_1.pcapng', 'input/iPCF/iPCF_2.pcapng'],
+             'layer': 2, 'no_tunnel': False},
+    'BLE': {'files': ['input/BLE/ble.pcapng'], 'layer': 1, 'no_tunnel': True},
+    'synthetic-crc32': {'synthetic': {'frames': 2000, 'captures': 2, 'stations': 8,
+                                      'seq_size': 2, 'checksum': 'crc32'},
+                        'layer': 1, 'no_tunnel': False},
+    'synthetic-seq1': {'synthetic': {'frames': 2000, 'captures': 2, 'stations': 4,
+                                     'seq_size': 1, 'checksum': 'adler32'},
+                       'layer': 1, 'no_tunnel': False},
+}
+"""Datasets of the regression suite. Synthetic datasets are generated with fixed seeds."""
+
+
+def _protocol(spec, i_capture):
+    """Return the SyntheticProtocol of capture i_capture of a synthetic dataset."""
+    return SyntheticProtocol(stations=spec['stations'], seq_size=spec['seq_size'],
+                             checksum=spec['checksum'], channel=1 + 5 * i_capture, seed=i_capture)
+
+
+def datasetFiles(dataset, synthetic_dir):
+    """Return the captures of dataset, synthetic captures are generated if they do not exist."""
+
+    if 'files' in dataset:
+        return dataset['files']
+
+    spec = dataset['synthetic']
+    files = []
+    for i_capture in range(spec['captures']):
+        path = join(synthetic_dir, 'regression_{}_s{}_q{}_{}_{}.pcapng'.format(
+            spec['frames'], spec['stations'], spec['seq_size'], spec['checksum'], i_capture))
+        if not exists(path):
+            writeCapture(path, _protocol(spec, i_capture), spec['frames'])
+        files.append(path)
+    return files
+
+
+def datasetTruth(dataset):
+    """Return the known format of a synthetic dataset (see SyntheticProtocol.truth()), None for
+    captures."""
+    if 'synthetic' not in dataset:
+        return None
+    return _protocol(dataset['synthetic'], 0).truth()
+
+
+def runDataset(job):
+    """Analyze a dataset, run in a fresh process.
+
+    :param job: tuple (name, files, layer, no_tunnel, truth)
+    :return: dict with the layouts of the symbols (or the error), the differences to the known
+    format (synthetic datasets only) and runtime and memory per stage
+    """
+
+    name, files, layer, no_tunnel, truth = job
+
+    # internal import
+    from ModelCompiler import symbolLayouts
+    from Pipeline import Pipeline
+    from Profiler import profiler
+
+    profiler.reset()
+    profiler.enable()
+    start = time()
+    try:
+        cluster = Pipeline(files, layer=layer, no_tunnel=no_tunnel).run()
+        layouts = [{'name': layout['name'],
+                    'fields': [[field['name'], field['start'], field['minsize'], field['maxsize']]
+                               for field in layout['fields']]}
+                   for layout in symbolLayouts(cluster)]
+        format_differences = checkFormat(cluster, truth) if truth is not None else None
+        error = None
+    except Exception as e:
+        layouts = None
+        format_differences = None
+        error = repr(e)
+
+    stages = {step['step']: {'wall': step['wall'], 'rss_exit_mib': step['rss_exit_mib'],
+                             'rss_delta_mib': step['rss_delta_mib']}
+              for step in profiler.report()['steps'] if '/' not in step['step']}
+    return {
+        'files': files,
+        'layouts': layouts,
+        'format': format_differences,
+        'error': error,
+        'runtime': time() - start,
+        'rss_mib': getrusage(RUSAGE_SELF).ru_maxrss / 1024,
+        'stages': stages,
+    }
+
+
+def compareLayouts(name, baseline, result):
+    """Return the behavioral differences of the result of a dataset to its baseline. Failing and
+    the differences to the known format of a synthetic dataset are differences in any case.
+    """
+
+    if result['error'] is not None:
+        return ["{}: failed with {}".format(name, result['error'])]
+    differences = ["{}: format of synthetic protocol not recovered, {}".format(name, difference)
+                   for difference in result['format'] or []]
+    if baseline is None or baseline['layouts'] == result['layouts']:
+        return differences
+
+    expected = {layout['name']: layout['fields'] for layout in baseline['layouts']}
+    inferred = {layout['name']: layout['fields'] for layout in result['layouts']}
+    for symbol in sorted(set(expected) - set(inferred)):
+        differences.append("{}: symbol {} missing".format(name, symbol))
+    for symbol in sorted(set(inferred) - set(expected)):
+        differences.append("{}: unexpected symbol {}".format(name, symbol))
+    for symbol in sorted(set(expected) & set(inferred)):
+        if expected[symbol] != inferred[symbol]:
+            differences.append("{}: fields of {} changed from {} to {}".format(
+                name, symbol, _fields(expected[symbol]), _fields(inferred[symbol])))
+    if len(differences) == len(result['format'] or []):
+        differences.append("{}: order of symbols changed".format(name))
+    return differences
+
+
+def _fields(fields):
+    """Return fields [name, start, minsize, maxsize] as short text, e.g. 'Address@2:6'."""
+    return ' '.join('{}@{}:{}'.format(name, start, minsize if minsize == maxsize else
+                                      '{}-{}'.format(minsize, maxsize))
+                    for name, start, minsize, maxsize in fields)
+
+
+def comparePerformance(name, baseline, result, time_tolerance, memory_tolerance, min_time):
+    """Return the performance regressions of the result of a dataset compared to its baseline.
+
+    :param time_tolerance: allowed relative increase of the runtime of a stage
+    :param memory_tolerance: allowed relative increase of the resident memory after a stage and
+    of the peak memory
+    :param min_time: runtime increases below this many seconds are ignored as noise
+    """
+
+    regressions = []
+    for stage, measured in result['stages'].items():
+        reference = baseline['stages'].get(stage)
+        if reference is None:
+            continue
+        if measured['wall'] > reference['wall'] * (1 + time_tolerance) and \
+                measured['wall'] - reference['wall'] > min_time:
+            regressions.append("{}: stage {} took {:.2f}s instead of {:.2f}s ({:+.0f}%)".format(
+                name, stage, measured['wall'], reference['wall'],
+                100 * (measured['wall'] / reference['wall'] - 1)))
+        # the resident memory after the stage, the peak of the process hides all but the biggest
+        rss, reference_rss = measured.get('rss_exit_mib'), reference.get('rss_exit_mib')
+        if rss is not None and reference_rss and rss > reference_rss * (1 + memory_tolerance):
+            regressions.append("{}: stage {} left {:.1f} MiB resident instead of {:.1f} MiB "
+                               "({:+.1f} MiB during the stage, {:+.1f} MiB before)".format(
+                name, stage, rss, reference_rss, measured['rss_delta_mib'],
+                reference['rss_delta_mib']))
+    if result['rss_mib'] > baseline['rss_mib'] * (1 + memory_tolerance):
+        regressions.append("{}: peak memory {:.1f} MiB instead of {:.1f} MiB ({:+.0f}%)".format(
+            name, result['rss_mib'], baseline['rss_mib'],
+            100 * (result['rss_mib'] / baseline['rss_mib'] - 1)))
+    return regressions
+
+
+def machine():
+    """Return a description of this machine, runtimes are only comparable on the same one."""
+    return {'platform': platform.platform(), 'python': platform.python_version(),
+            'processor': platform.processor(), 'cpus': cpu_count()}
+
+
+def _load(path):
+    """Return the baseline stored at path, an empty one if there is none yet."""
+    if not exists(path):
+        return {'datasets': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _store(baseline, path):
+    baseline['recorded'] = strftime('%Y-%m-%d %H:%M:%S')
+    with open(path, 'w') as f:
+        json.dump(baseline, f, indent=2)
+    print("Baseline written to '{}'.".format(path))
+
+
+def main(args):
+
+    names = args.datasets or list(DATASETS)
+    for name in names:
+        if name not in DATASETS:
+            raise ValueError("Unknown dataset '{}', use one of {}".format(name, list(DATASETS)))
+
+    jobs = []
+    for name in names:
+        dataset = DATASETS[name]
+        jobs.append((name, datasetFiles(dataset, args.synthetic_dir), dataset['layer'],
+                     dataset['no_tunnel'], datasetTruth(dataset)))
+
+    # a fresh process per dataset, so that the peak memory is the one of the dataset
+    results = {}
+    with get_context('fork').Pool(1, maxtasksperchild=1) as pool:
+        for (name, *_), result in zip(jobs, pool.imap(runDataset, jobs)):
+            print("{}: {} in {:.2f}s, {:.1f} MiB".format(
+                name, "failed ({})".format(result['error']) if result['error'] else
+                "{} symbols".format(len(result['layouts'])), result['runtime'],
+                result['rss_mib']))
+            results[name] = result
+
+    if args.update or args.update_performance:
+        # failed datasets and formats known to be wrong are never recorded as expected behavior
+        wrong = [line for name, result in results.items()
+                 for line in compareLayouts(name, None, result)]
+        for line in wrong:
+            print("Not recorded, " + line)
+        recorded = {name: result for name, result in results.items()
+                    if not compareLayouts(name, None, result)}
+
+        print()
+        if args.update:
+            layouts = _load(args.baseline)
+            layouts['datasets'].update({name: {'files': result['files'],
+                                               'layouts': result['layouts']}
+                                        for name, result in recorded.items()})
+            _store(layouts, args.baseline)
+        performance = _load(args.performance)
+        if performance.get('machine') != machine():
+            performance = {'datasets': {}}
+        performance['datasets'].update({name: {'runtime': result['runtime'],
+                                               'rss_mib': result['rss_mib'],
+                                               'stages': result['stages']}
+                                        for name, result in recorded.items()})
+        performance['machine'] = machine()
+        _store(performance, args.performance)
+        return 1 if wrong else 0
+
+    if not exists(args.baseline):
+        print("\nNo baseline found at '{}', record one with --update.".format(args.baseline))
+        return 1
+    layouts = _load(args.baseline)
+    performance = _load(args.performance)
+    if not exists(args.performance):
+        print("\nNo performance baseline of this machine at '{}', record one with " \
+              "--update-performance.".format(args.performance))
+    elif performance.get('machine') != machine():
+        print("\nWARNING: The performance baseline was recorded on another machine ({}), it is " \
+              "not comparable. Record it again with --update-performance.".format(
+                  performance.get('machine')))
+        performance = {'datasets': {}}
+
+    behavioral = []
+    performance_regressions = []
+    for name, result in results.items():
+        reference = layouts['datasets'].get(name)
+        if reference is None:
+            print("No layout baseline for dataset '{}', checking the known format only.".format(
+                name))
+        behavioral.extend(compareLayouts(name, reference, result))
+        reference = performance['datasets'].get(name)
+        if reference is not None and result['error'] is None:
+            performance_regressions.extend(comparePerformance(
+                name, reference, result, args.time_tolerance, args.memory_tolerance,
+                args.min_time))
+
+    print("\nBehavioral regressions:" if behavioral else "\nNo behavioral regressions.")
+    for line in behavioral:
+        print("  " + line)
+    print("Performance regressions:" if performance_regressions else \
+          "No performance regressions.")
+    for line in performance_regressions:
+        print("  " + line)
+
+    makedirs('reports', exist_ok=True)
+    path = 'reports/regression_{}.json'.format(strftime('%Y%m%d-%H%M%S'))
+    with open(path, 'w') as f:
+        json.dump({'baseline': args.baseline, 'performance_baseline': args.performance,
+                   'behavioral': behavioral, 'performance': performance_regressions,
+                   'results': results}, f, indent=2)
+    print("\nReport written to '{}'.".format(path))
+
+    return 1 if behavioral or performance_regressions else 0
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(
+        description='Run l2pre on the bundled and synthetic datasets and compare symbol layouts, '
+                    'runtime and memory against a stored baseline.')
+
+    parser.add_argument('datasets', nargs='*', metavar='DATASET', \
+            help='datasets to run, defaults to all: ' + ', '.join(DATASETS))
+    parser.add_argument('-b', '--baseline', default=BASELINE, \
+            help='baseline of the symbol layouts, defaults to ' + BASELINE)
+    parser.add_argument('-p', '--performance', default=PERFORMANCE, \
+            help='baseline of runtime and memory of this machine, defaults to ' + PERFORMANCE)
+    parser.add_argument('-u', '--update', action='store_true', \
+            help='record the layouts and the performance of the datasets as new baseline instead ' \
+                 'of comparing')
+    parser.add_argument('--update-performance', action='store_true', \
+            help='record the performance of the datasets on this machine only')
+    parser.add_argument('--time-tolerance', type=float, default=0.5, \
+            help='allowed relative increase of the runtime of a stage, defaults to 0.5')
+    parser.add_argument('--memory-tolerance', type=float, default=0.2, \
+            help='allowed relative increase of the resident memory after each stage and of the ' + \
+            'peak memory, defaults to 0.2')
+    parser.add_argument('--min-time', type=float, default=0.5, metavar='SECONDS', \
+            help='ignore runtime increases below SECONDS, defaults to 0.5')
+    parser.add_argument('--synthetic-dir', default=join(gettempdir(), 'l2pre_regression'), \
+            help='directory for the generated synthetic captures')
+
+    args = parser.parse_args()
+
+    makedirs(args.synthetic_dir, exist_ok=True)
+    sys.exit(main(args))
@@ -0,0 +1,4 @@
+STAGES = ['import', 'payload', 'address', 'cluster', 'seq', 'context', 'dedup']
+"""Ordered names of the stages of an analysis, kept apart from Pipeline so that the command line
+can be parsed without importing netzob.
+"""
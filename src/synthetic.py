@@ -0,0 +1,358 @@
+# system import
+import json
+from os import makedirs
+from os.path import join
+import random
+import struct
+from zlib import adler32, crc32
+
+# external import
+import numpy as np
+
+# others
+from yaml import safe_dump
+
+
+LINKTYPE_USER0 = 147
+"""Link type of the generated captures, the exported Wireshark dissector registers on it as well."""
+
+AP = 0
+"""Index of the station sending beacons, all other stations talk to it or to each other."""
+
+FRAME_TYPES = {
+    'beacon': b'\x80\x00',
+    'data': b'\x08\x01',
+    'control': b'\x1c\x00',
+}
+"""Frame type values (first two bytes) of the synthetic protocol."""
+
+
+class SyntheticProtocol(object):
+    """Generates frames of a configurable layer 2 protocol resembling IEEE 802.11, whose format is
+    known (see truth()), to benchmark l2pre and check that the format is recovered:
+
+        Frame_type (2) | Address (6) | Address (6) | Address (6) | SEQ (1 or 2) | body | trailer
+
+    The addresses are receiver, sender and the access point (station AP). Every sender counts its
+    own sequence number. Beacons contain the channel (context information, see context()), data
+    frames an Ethernet/IP/UDP/DNS payload of the sender, control frames a status byte and a random
+    value. An optional crc32 or adler32 trailer (little endian) covers the rest of the frame.
+
+    >>> protocol = SyntheticProtocol(stations=8, checksum='crc32')
+    >>> writeCapture('synthetic.pcapng', protocol, 10000)
+    """
+
+    def __init__(self, stations=8, seq_size=2, checksum=None, payload_ratio=0.3, beacon_ratio=0.1,
+                 channel=6, seed=0, context_key='channel'):
+        """
+        :param stations: number of stations, at least 2
+        :param seq_size: size of the sequence fields in bytes, 1 or 2
+        :param checksum: None, 'crc32' or 'adler32'
+        :param payload_ratio: share of data frames carrying an Ethernet payload
+        :param beacon_ratio: share of beacons
+        :param channel: channel announced by beacons, differs between captures
+        :param seed: seed of the random generator, the same seed generates the same frames
+        :param context_key: name of the channel in the context information
+        """
+        if stations < 2:
+            raise ValueError("At least two stations are needed")
+        if seq_size not in (1, 2):
+            raise ValueError("seq_size needs to be 1 or 2")
+        if checksum not in (None, 'crc32', 'adler32'):
+            raise ValueError("Unknown checksum '{}'".format(checksum))
+
+        self.stations = stations
+        self.seq_size = seq_size
+        self.checksum = checksum
+        self.payload_ratio = payload_ratio
+        self.beacon_ratio = beacon_ratio
+        self.channel = channel
+        self.seed = seed
+        self.context_key = context_key
+
+        rng = random.Random(seed)
+        self.addresses = [bytes([0x02, 0x1f, 0x3a]) + bytes(rng.randrange(256) for _ in range(3))
+                          for _ in range(stations)]
+        self.ips = ['10.0.{}.{}'.format(i // 250, i % 250 + 2) for i in range(stations)]
+        self._payloads = None
+
+    @property
+    def header_size(self):
+        """Size of the header in front of the body."""
+        return 2 + 3 * 6 + self.seq_size
+
+    @property
+    def payload_offset(self):
+        """Offset of the Ethernet payload in data frames."""
+        return self.header_size + 1
+
+    def payloads(self):
+        """Return a list of Ethernet/IP/UDP/DNS payloads per station, built once with scapy."""
+
+        if self._payloads is None:
+            # scapy is needed only if payloads are generated
+            from scapy.all import DNS, DNSQR, Ether, IP, UDP
+            names = ['example.org', 'splone.com', 'www.google.de', 'update.local']
+            self._payloads = []
+            for i, address in enumerate(self.addresses):
+                gateway = self.addresses[AP]
+                self._payloads.append([bytes(
+                    Ether(src=':'.join('{:02x}'.format(b) for b in address),
+                          dst=':'.join('{:02x}'.format(b) for b in gateway)) /
+                    IP(src=self.ips[i], dst='8.8.8.8') /
+                    UDP(sport=40000 + i, dport=53) /
+                    DNS(id=i, rd=1, qd=DNSQR(qname=name))) for name in names])
+        return self._payloads
+
+    def frames(self, n, start=1600000000.0, interval=0.001):
+        """Generate n frames.
+
+        :return: generator of (timestamp, frame)
+        """
+
+        rng = random.Random(self.seed)
+        seq_mask = (1 << (8 * self.seq_size)) - 1
+        seqs = [rng.randrange(seq_mask + 1) for _ in range(self.stations)]
+        broadcast = b'\xff' * 6
+        payloads = self.payloads() if self.payload_ratio > 0 else None
+
+        for i in range(n):
+            r = rng.random()
+            if r < self.beacon_ratio:
+                kind = 'beacon'
+                sender = AP
+                receiver = broadcast
+            else:
+                kind = 'data' if r < self.beacon_ratio + self.payload_ratio else 'control'
+                sender = rng.randrange(self.stations)
+                other = rng.randrange(self.stations - 1)
+                receiver = self.addresses[other if other < sender else other + 1]
+
+            seqs[sender] = (seqs[sender] + 1) & seq_mask
+            frame = bytearray(FRAME_TYPES[kind])
+            frame += receiver
+            frame += self.addresses[sender]
+            frame += self.addresses[AP]
+            frame += seqs[sender].to_bytes(self.seq_size, byteorder='little')
+
+            if kind == 'beacon':
+                frame.append(self.channel)
+                frame += b'\x64\x00' # beacon interval
+                frame += rng.getrandbits(64).to_bytes(8, byteorder='little') # timestamp
+            elif kind == 'data':
+                frame.append(0x01) # flags
+                frame += rng.choice(payloads[sender])
+            else:
+                frame.append(rng.choice((0x00, 0x01, 0x02))) # status
+                frame += rng.getrandbits(32).to_bytes(4, byteorder='little')
+
+            if self.checksum == 'crc32':
+                frame += crc32(frame).to_bytes(4, byteorder='little')
+            elif self.checksum == 'adler32':
+                frame += adler32(frame).to_bytes(4, byteorder='little')
+
+            yield start + i * interval, bytes(frame)
+
+    def context(self):
+        """Return the context information of a capture, as stored in its .yaml file."""
+        return {self.context_key: self.channel, 'stations': self.stations}
+
+    def layouts(self):
+        """Return the complete format per frame type (hex) as symbol layouts like
+        ModelCompiler.symbolLayouts() (but with the frame type as hex), named like l2pre would name
+        them. The channel of beacons is named after the context information, payloads of data
+        frames are cut off.
+        """
+
+        header = [("Frame_type", 2), ("Address", 6), ("Address", 6), ("Address", 6),
+                  ("SEQ", self.seq_size)]
+        bodies = {
+            'beacon': [(self.context_key, 1), ("Field", 10)],
+            'data': [("Field", 1)],
+            'control': [("Field", 5)],
+        }
+        layouts = {}
+        for kind, frame_type in FRAME_TYPES.items():
+            fields = header + bodies[kind]
+            if self.checksum is not None and kind != 'data':
+                fields = fields + [(self.checksum, 4)]
+            start = 0
+            layout = []
+            for name, size in fields:
+                layout.append({'name': name, 'start': start, 'minsize': size, 'maxsize': size})
+                start += size
+            layouts[frame_type.hex()] = {'name': "Symbol_" + frame_type.hex(),
+                                         'frame_type': frame_type.hex(), 'fields': layout}
+        return layouts
+
+    def truth(self):
+        """Return the known format per frame type (hex) as dict with the offsets of the address
+        and sequence fields and the checksum algorithm (only known for frames without payload, as
+        l2pre cuts off the trailer together with the payload).
+        """
+
+        seq = 2 + 3 * 6
+        return {frame_type.hex(): {
+                    'addresses': [2, 8, 14],
+                    'seq': seq,
+                    'seq_size': self.seq_size,
+                    'checksum': self.checksum if kind != 'data' else None,
+                } for kind, frame_type in FRAME_TYPES.items()
+                if kind != 'data' or self.payload_ratio > 0}
+
+
+def writePcapng(path, frames, linktype=LINKTYPE_USER0):
+    """Write frames to a pcapng file with a single interface.
+
+    :param frames: iterable of (timestamp, frame)
+    :return: number of frames written
+    """
+
+    count = 0
+    with open(path, 'wb') as f:
+        # section header block
+        f.write(struct.pack('<IIIHHq', 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1))
+        f.write(struct.pack('<I', 28))
+        # interface description block
+        f.write(struct.pack('<IIHHII', 1, 20, linktype, 0, 0xFFFF, 20))
+        for timestamp, frame in frames:
+            padding = -len(frame) % 4
+            length = 32 + len(frame) + padding
+            usec = int(round(timestamp * 1e6))
+            # enhanced packet block
+            f.write(struct.pack('<IIIIIII', 6, length, 0, usec >> 32, usec & 0xFFFFFFFF,
+                                len(frame), len(frame)))
+            f.write(frame)
+            f.write(b'\x00' * padding)
+            f.write(struct.pack('<I', length))
+            count += 1
+    return count
+
+
+def writeCapture(path, protocol, n, start=1600000000.0):
+    """Write n frames of protocol to path and its context information to path + '.yaml'.
+
+    :return: number of frames written
+    """
+    count = writePcapng(path, protocol.frames(n, start=start))
+    with open(path + '.yaml', 'w') as f:
+        safe_dump(protocol.context(), f)
+    return count
+
+
+def checkFormat(cluster, truth):
+    """Compare the inferred symbols with the known format of the synthetic protocol.
+
+    :param truth: known format as returned by SyntheticProtocol.truth()
+    :return: list of differences, empty if the format was recovered
+    """
+
+    # internal import
+    from ModelCompiler import symbolLayouts
+
+    differences = []
+    layouts = {}
+    for layout in symbolLayouts(cluster):
+        if layout['frame_type'] is not None:
+            layouts.setdefault(layout['frame_type'].hex(), layout)
+
+    for frame_type, expected in truth.items():
+        layout = layouts.get(frame_type)
+        if layout is None:
+            differences.append("{}: no symbol found".format(frame_type))
+            continue
+        starts = {field['start']: field for field in layout['fields']}
+
+        for offset in expected['addresses']:
+            field = starts.get(offset)
+            if field is None or field['name'] != "Address":
+                differences.append("{}: no address field at {}".format(frame_type, offset))
+
+        # a two-byte sequence field might be detected as two fields of one byte
+        seq_fields = [field for field in layout['fields'] if field['name'] == "SEQ" and
+                      expected['seq'] <= field['start'] < expected['seq'] + expected['seq_size']]
+        if not seq_fields:
+            differences.append("{}: no sequence field at {}".format(frame_type, expected['seq']))
+
+        if expected['checksum'] is not None and \
+                not any(field['name'] == expected['checksum'] for field in layout['fields']):
+            differences.append("{}: no {} field".format(frame_type, expected['checksum']))
+
+    for frame_type in layouts:
+        if frame_type not in truth:
+            differences.append("{}: unexpected symbol".format(frame_type))
+
+    return differences
+
+
+def writeModel(path, protocol, n, start=1600000000.0):
+    """Write n frames of protocol as model of l2pre (see Model.save_model()) with the known format
+    of protocol (see SyntheticProtocol.layouts()), e.g. as fixture of the exporters. netzob is not
+    needed.
+
+    :return: number of frames written
+    """
+
+    layouts = protocol.layouts()
+    members = {frame_type: [] for frame_type in layouts} # frame type: message indices
+    data = []
+    payloads = [] # (message index, payload data)
+    dates = []
+    for timestamp, frame in protocol.frames(n, start=start):
+        frame_type = frame[:2].hex()
+        members[frame_type].append(len(data))
+        if frame[:2] == FRAME_TYPES['data']:
+            payloads.append((len(data), frame[protocol.payload_offset:]))
+            frame = frame[:protocol.payload_offset]
+        data.append(frame)
+        dates.append(timestamp)
+
+    # message bytes as MessageStore, payload data after the data of all messages
+    values = data + [payload for _, payload in payloads]
+    lengths = np.array([len(v) for v in values], dtype=np.int64)
+    offsets = np.zeros(len(values), dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths[:-1])
+    payload_rows = np.full(len(data), -1, dtype=np.int64)
+    payload_classes = np.full(len(data), -1, dtype=np.int32)
+    for i_payload, (i_message, _) in enumerate(payloads):
+        payload_rows[i_message] = len(data) + i_payload
+        payload_classes[i_message] = 0
+
+    makedirs(path, exist_ok=True)
+    with open(join(path, 'messages.bin'), 'wb') as f:
+        f.write(b''.join(values))
+    refs = np.array([i for frame_type in sorted(members) for i in members[frame_type]],
+                    dtype=np.int64)
+    np.savez(join(path, 'messages.npz'),
+             offsets=offsets, lengths=lengths, payload_rows=payload_rows,
+             dates=np.array(dates, dtype=np.float64),
+             l2Protocols=np.full(len(data), -1, dtype=np.int32), payload_classes=payload_classes,
+             contexts=np.zeros(len(data), dtype=np.int32),
+             refs_messages=refs, refs_orig_messages=refs,
+             refs_dedup_messages=np.array([], dtype=np.int64))
+
+    symbols = []
+    for frame_type in sorted(members):
+        layout = dict(layouts[frame_type])
+        checksums = [f['name'] for f in layout['fields'] if f['name'] in ('crc32', 'adler32')]
+        layout['checksum'] = checksums[-1] if checksums else None
+        layout['messages'] = layout['orig_messages'] = len(members[frame_type])
+        layout['dedup_messages'] = None
+        symbols.append(layout)
+
+    model = {
+        'version': 1,
+        'manifest': {'files': [], 'synthetic': {'stations': protocol.stations,
+                                                'seq_size': protocol.seq_size,
+                                                'checksum': protocol.checksum,
+                                                'seed': protocol.seed, 'frames': n}},
+        'payload_offsets': [protocol.payload_offset],
+        'l2Protocols': [],
+        'payload_classes': ['scapy.layers.l2:Ether'],
+        'contexts': [protocol.context()],
+        'symbols': symbols,
+    }
+    with open(join(path, 'model.json'), 'w') as modelfile:
+        json.dump(model, modelfile, indent=1)
+
+    return len(data)
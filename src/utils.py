@@ -44,3 +44,20 @@ def printFields(symbol):
     """
     for field in symbol.fields:
         print(field.name, ": ", field.domain.dataType.size)
+
+@typeCheck(Symbol)
+def fieldOffsets(symbol):
+    """Auxiliary function to calculate byte positions of all fields of a given symbol without
+    parsing the messages. Positions are based on the maximum size of the fields, thus they are only
+    exact for fields that follow fixed-size fields.
+
+    :return: list of tuples (field, start, end)
+    """
+    offsets = []
+    start = 0
+    for field in symbol.fields:
+        _, max_size = field.domain.dataType.size
+        end = start + int(max_size/8)
+        offsets.append((field, start, end))
+        start = end
+    return offsets